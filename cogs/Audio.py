@@ -12,19 +12,32 @@ into the source.
 Note: Limitation of Discord Voice API: it requires 48khz, 16bit 2 channel audio
 to play with a min lengh of 20ms.
 
-Monitor Process - process loop occurs every .1 seconds (can be configured)
+Event driven, there is no polling loop. write() runs on the voice_recv reader thread 
+and only queues a frame descriptor (Frame_Queue, single producer / single consumer), the 
+buffers, vad, deadlines and every dispatch are handled on the event loop.
     
-    Record - This works by storing all audio data in a dict[user_id:audio_data]. 
-        if the speaker has stopped speaking for .2 seconds(com_end_speaking_delay), it will check the audio lenght
+    Record - This works by storing all audio data in a dict[user_id:StreamData]. Each
+        speaker has a fixed size PCM_Ring_Buffer that is allocated once, utterances are
+        written into it without copies and copied once when handed off to STT.
+        Every packet re-arms a per speaker deadline on the event loop (call_at). If
+        the speaker has stopped speaking for .2 seconds(com_end_speaking_delay) or the vad 
+        ended the turn, the deadline fires and it will check the audio lenght
             if less than .5 sec, discard (com_min_audio_len)
-            else, dispatch a STT_event to be processed
+            else, add it to queues.audio_in to be processed
+        Long turns are handed off in segments: once com_segment_len of audio is 
+        buffered the next pause of com_segment_pause closes a segment, it goes to STT
+        right away while the speaker keeps talking. All segments of a turn share one
+        Discord_Message and turn_id (numbered by segment), the STT cog joins the text
+        when the last one (final) is in.
         when the speaker has spoken for more than .1 seconds and audio is playin
             it allows the bot to be talked over (bot stops playing audio)
     
-    Play - Audio TTS events are caught and put in a deque. The monitor checks the
-        deque and starts playing the audio (discord.py does this via a seperate thread)
-        If interruped, deque is counted and the number of sentences is dispatched as an event
-        and the deque is cleared
+    Play - TTS puts audio in queues.audio_out and dispatches TTS_play. On that event
+        the sentences are appended to one long lived PCM_Stream_Source, discord.py 
+        plays it on a seperate thread and the sentences run back to back. When it runs 
+        dry it sends silence, after .5 sec the player is paused until TTS adds more.
+        If interruped, the buffered audio is dropped (silent from the next 20ms frame)
+        and the exact playback position is dispatched as an event
 
 Configuation expected in the .env config file
     com_voice_channel - str - the name of the voice channel to join
@@ -34,6 +47,41 @@ Configuation expected in the .env config file
     com_end_speaking_delay(int in ms) - the amount of time to wait after a user stops 
         speaking before processing audio
 
+    com_max_audio_len(int in ms, default 30000) - longest utterance kept per speaker, 
+        sizes the per speaker ring buffer (2x this length of 48khz stereo audio)
+
+    com_segment_len(int in ms, default 10000, 0 disables) - audio buffered before a turn
+        is split at the next pause. Without a pause it is split when the ring buffer
+        is full (com_max_audio_len), so a monologue is never truncated and the per
+        speaker memory stays at the ring buffer.
+
+    com_segment_pause(int in ms, default 100) - silence within a turn that closes a
+        segment, shorter than com_end_speaking_delay (needs com_vad)
+
+    com_vad(0/1, default 1) - frame level voice activity detection. Every 20ms frame is
+        classified as speech or noise as it is written, noise before an utterance is
+        ignored and the turn ends com_end_speaking_delay after the last speech frame
+        (Discord keeps sending low level noise packets, so the packet timeout alone
+        runs long). Trailing noise is cut from the audio sent to STT.
+
+    com_vad_threshold(float in dBFS, default -45) - minimum frame energy for speech,
+        raised automatically on noisy mics
+
+    STT_streaming(0/1, default 0) - open the STT session on the first voice packet and
+        stream the audio while the user is still talking, on a connection borrowed from
+        the STT cog's pools (STT_connections, STT_servers). The Audio_Message then 
+        carries the STT_Stream and only AudioStop is left to send.
+
+    STT_resample(0/1, default 1) - streamed audio is converted to 16khz mono before it
+        is sent (see cogs/STT.py for the buffered path)
+
+    com_opus_decoders(int, default 0) - 0 lets voice_recv decode every speaker on its
+        packet thread. Above 0 the sink takes raw Opus (wants_opus) and decodes it on
+        that many Opus_Decoder_Pool threads, one decoder state per SSRC, for busy channels.
+
+    TTS_opus_encoders(int, default 0) - above 0 TTS sentences arrive as Opus packets 
+        and are played through Opus_Stream_Source, the player thread only sends them
+
     com_interrupt_time(int in ms), converted to float in seconds during init) - the 
         amount of time before the an event is sent to allow other processes to 
         react (i.e. if an LLM response is speaking and someone starts talking 
@@ -42,15 +90,19 @@ Configuation expected in the .env config file
 dispatched events:
 
     speaker_event - when a user stops speaking and after end_speaking_delay has 
-        passed. Data passed is
-            Discord_Message:  
-            audio_data : array.array
+        passed, the utterance is in queues.audio_in. Data passed is
+            audio_message: Audio_Message (Discord_Message and audio_data: memoryview)
+        segments of a long turn are sent the same way, audio_message.final is False
+        for all but the last one
     
-    speaker_interrupt - when someone starts talking in the channel
+    speaker_interrupt - when someone starts talking over the bot
         data passed is a Speaking_Interrupt object
-            num_sentences: int
-            member_id: int
-            member_name: str
+            num_sentences: int - queued sentences that did not start
+            user_id: int
+            user_name: str
+            disc_message: Discord_Message - the bot message that was cut off
+            sentences_heard: int - disc_message.sentences played in full
+            partial_fraction: float - share of the next sentence that was played
 
     speaker_interrupt_clear - message to notify the speaker has stopped talking. Data 
         passed
@@ -67,8 +119,7 @@ event listeners:
 
     on_ready: connects to the voice and text channels
 
-    on_TTS_play: adds audio data to the play deque. Expects
-        audio: io.BytesIO object
+    on_TTS_play: audio was added to queues.audio_out, moves it to the playback source
 
     on_voice_state_update: checks if a user has joined the voice channel
         and updates the members dict [member_id: StreamData]
@@ -77,36 +128,55 @@ event listeners:
         removes a member from the members dict
 
 '''
-import asyncio, time, array, time, logging, io
+import asyncio, time, logging, io
 from datetime import datetime
 
 from collections import defaultdict, deque
-from typing import TYPE_CHECKING, TypedDict, Union, Optional, Awaitable, TypeVar
-from concurrent.futures import Future as CFuture
+from typing import TYPE_CHECKING, TypedDict, Union, Optional
 
 import discord
-from discord.ext import commands, voice_recv, tasks
+from discord.ext import commands, voice_recv
 from discord.ext.voice_recv import AudioSink
 
 from scripts.discord_ext import Commands_Bot
-from scripts.datatypes import Discord_Message, Speaking_Interrupt, Audio_Message
+from scripts.datatypes import Discord_Message, Speaking_Interrupt, Audio_Message, Audio_Out
+from scripts.audio_buffer import PCM_Ring_Buffer, Frame_Queue
+from scripts.audio_vad import Energy_VAD
+from scripts.STT_wfw import STT_Stream, stt_rate
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.audio_opus import Opus_Decoder_Pool
+from scripts.audio_playback import Stream_Source, PCM_Stream_Source, Opus_Stream_Source, Playback_Position
 
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-T = TypeVar('T')
-
 MemberOrUser = Union[discord.Member, discord.User]
 
 class StreamData(TypedDict):
-    buffer: array.array = array.array('B')#[int]
-    last_time: time = None
+    buffer: PCM_Ring_Buffer = None
+    last_time: float = None
     ssrc: int = None
     member: str = None
     member_id: int = None
     iterrupt_sent: bool = False
     last_sequence: int = None
     start_time: float = None
+    stt_stream: STT_Stream = None
+    vad: Energy_VAD = None
+    speech_bytes: int = 0
+    message: Discord_Message = None # set once the first segment of the turn is handed off
+    turn_id: int = None # of the turn message belongs to
+    segment: int = 0 # segments of the turn handed off so far
+
+class Voice_Frame(TypedDict):
+    '''descriptor handed from the voice_recv thread to the loop'''
+    user_id: int
+    member: str
+    ssrc: int
+    sequence: int
+    pcm: bytes
+    opus: bytes
+    time: float
 
 class Speech_To_Text_Sink(voice_recv.AudioSink):
     def __init__(self,
@@ -114,6 +184,15 @@ class Speech_To_Text_Sink(voice_recv.AudioSink):
                 min_audio_len: int = 500,
                 end_speaking_delay: int = 200,
                 interrupt_time: int = 100,
+                max_audio_len: int = 30000,
+                stt_streaming: bool = False,
+                stt_resample: bool = True,
+                vad: bool = True,
+                vad_threshold: float = -45.0,
+                opus_decoders: int = 0,
+                opus_playback: bool = False,
+                segment_len: int = 10000,
+                segment_pause: int = 100,
                 ):
         super().__init__()
         self.bot: Commands_Bot = bot
@@ -124,100 +203,263 @@ class Speech_To_Text_Sink(voice_recv.AudioSink):
         self.rate = discord.opus.Decoder.SAMPLING_RATE
 
         self.min_audio_length: int = min_audio_len # in msec
+        self.max_audio_length: int = max_audio_len # in msec
         self.end_speaking_delay: int = end_speaking_delay # in msec
         self.interrupt_time:float = interrupt_time / 1000
-        self.min_buffer_length = int(self.width * self.channels * self.min_audio_length * self.rate / 1000)
-        self.audio_packet_lenght = int(self.rate * self.width * self.channels / 20)
+        # Decoder.SAMPLE_SIZE is the size of a sample frame (all channels)
+        self.min_buffer_length = int(self.width * self.min_audio_length * self.rate / 1000)
+        self.max_buffer_length = int(self.width * self.max_audio_length * self.rate / 1000)
+        self.audio_packet_lenght = discord.opus.Decoder.FRAME_SIZE # 20ms
+        self.segment_length: int = min(segment_len, max_audio_len) # in msec, 0 disables
+        self.segment_buffer_length = int(self.width * self.segment_length * self.rate / 1000)
+        self.segment_pause_frames: int = max(1, segment_pause // 20)
         #self.audio_buffer_padding: float = .25 #attempt to padd the audio to see if it impoves speech recognition
 
+        self.stt_streaming: bool = stt_streaming
+        self.stt_resample: bool = stt_resample
+        self.vad_enabled: bool = vad
+        self.vad_threshold: float = vad_threshold
+        self.stt_host: str = self.bot.custom.config['STT_host']
+        self.stt_port: int = int(self.bot.custom.config['STT_port'])
+
         self.ignore_silence_packets: bool = True
         self.audio_buffer_dict: defaultdict[int, StreamData] = defaultdict(
-            lambda: StreamData(buffer=array.array('b'), last_time=None, member=None, ssrc=None, member_id=None)
+            lambda: StreamData(
+                buffer=PCM_Ring_Buffer(max_utterance_bytes=self.max_buffer_length, frame_bytes=self.width), 
+                vad=Energy_VAD(threshold_db=self.vad_threshold, hangover_ms=self.end_speaking_delay, 
+                        channels=self.channels),
+                last_time=None, member=None, ssrc=None, member_id=None,
+                stt_stream=None, speech_bytes=0, message=None, turn_id=None, segment=0)
             )
         self.play_queue:deque[io.BytesIO] = self.bot.custom.queues.audio_out
+        if opus_playback:
+            self.playback: Stream_Source = Opus_Stream_Source(on_idle=self._on_playback_idle)
+        else:
+            self.playback: Stream_Source = PCM_Stream_Source(on_idle=self._on_playback_idle)
+        self.closed: bool = False
         self.listeners: dict[int, str] = self.bot.custom.current_listeners
+        self.next_turn_id: int = 0
+
+        self.loop: asyncio.AbstractEventLoop = self.bot.loop
+        self.deadlines: dict[int, asyncio.TimerHandle] = {}
+        # voice_recv thread (or decoder threads) -> loop, ~10 seconds of a single speaker
+        self.frames: Frame_Queue = Frame_Queue(maxlen=500)
+        self.decoder_pool: Opus_Decoder_Pool = None
+        if opus_decoders > 0:
+            self.decoder_pool = Opus_Decoder_Pool(workers=opus_decoders, on_decoded=self._queue_frame)
+
+    def _arm_deadline(self, user_id: int, when: float, stage: str) -> None:
+        '''
+        (re)arms the end of speech deadline for a speaker, runs on the loop. 
+        Every accepted packet moves it, so it only fires after a real pause.
+        '''
+        handle = self.deadlines.pop(user_id, None)
+        if handle:
+            handle.cancel()
+        self.deadlines[user_id] = self.loop.call_at(when, self._on_deadline, user_id, stage)
+
+    def _on_deadline(self, user_id: int, stage: str) -> None:
+        '''
+        stage 'interrupt' - interrupt_time without a packet and not enough audio to 
+            process, the utterance is dropped and the interrupt cleared
+        stage 'end' - end_speaking_delay without a packet or the vad ended the 
+            turn, the utterance is handed to STT
+        '''
+        self.deadlines.pop(user_id, None)
+        sdata = self.audio_buffer_dict.get(user_id)
+        if (sdata is None) or (sdata['last_time'] == None):
+            return
 
-        self.monitor.start()
-
-    @tasks.loop(seconds=0.1)    
-    async def monitor(self):
-        #Check if there is audio in the play queue and if so, play it
-        if len(self.play_queue) > 0:
-            if not self.bot.voice_clients[0].is_playing():
-                try:
-                    audio_source = discord.PCMAudio(self.play_queue.popleft())
-                    self.bot.voice_clients[0].play(audio_source, 
-                            after=lambda e: print(f'Error:  {e}') if e else None)
-                except ValueError as e:
-                    logger.info(f'Error: {e}')
-        
-        #checking the audio buffer dict is empty 
-        if len(self.audio_buffer_dict) == 0:
-            logger.debug('STT Audio Buffer empty')
+        if stage == 'end':
+            self._end_utterance(sdata)
+        elif len(sdata['buffer']) < self.min_buffer_length:
+            logger.debug(f'speaker_interrupt_clear sent')
+            sdata['last_time'] = None
+            self._close_stream(sdata, cancel=True)
+            self.bot.dispatch(f'speaker_interrupt_clear', message = Speaking_Interrupt({
+                    "num_sentences" : 0,
+                    "user_id" : sdata["member_id"],
+                    "user_name" : sdata['member']
+                    }))
+        else:
+            self._arm_deadline(user_id, 
+                    sdata['last_time'] + self.end_speaking_delay / 1000, 'end')
+
+    def _hand_off(self, sdata: StreamData, audio_length: int, final: bool) -> None:
+        '''queues the current utterance (or segment of it) for STT and starts the next one'''
+        if sdata['message'] is None:
+            sdata['message'] = Discord_Message(
+                    user_name= sdata['member'].capitalize(),
+                    user_id = sdata['member_id'],
+                    bot_id = self.bot.custom.bot_id,
+                    bot_name = self.bot.custom.bot_name,
+                    listener_ids = set(self.listeners.keys()),
+                    listener_names = set(self.listeners.values()),
+                    timestamp_Audio_Start = sdata['start_time'],
+                    timestamp=datetime.now()
+                    )
+            sdata['turn_id'] = self.next_turn_id
+            sdata['segment'] = 0
+            self.next_turn_id += 1
+        message = sdata['message']
+        message.timestamp_Audio_End = datetime.now()
+        message.listener_ids.update(self.listeners.keys())
+        message.listener_names.update(self.listeners.values())
+        audio_message = Audio_Message(
+                audio_data=sdata['buffer'].finish(length=audio_length),
+                message=message,
+                stt_stream=self._close_stream(sdata),
+                final=final,
+                noise_floor_db=sdata['vad'].noise_floor_db if self.vad_enabled else None,
+                turn_id=sdata['turn_id'],
+                segment=sdata['segment'])
+        sdata['speech_bytes'] = 0
+        sdata['segment'] += 1
+        if final:
+            sdata['message'] = None
+        self.bot.custom.queues.audio_in.append(audio_message)
+        # STT starts on the event instead of its next tick
+        self.bot.dispatch('speaker_event', audio_message=audio_message)
+        logger.info(f'Audio added to STT queue for {sdata["member"]}{"" if final else " (segment)"}')
+
+    def _end_segment(self, sdata: StreamData) -> None:
+        '''
+        the speaker paused (or filled the buffer) in a long turn, the audio so far 
+        goes to STT and the turn continues in a new segment
+        '''
+        self._hand_off(sdata, len(sdata['buffer']), final=False)
+        if self.stt_streaming:
+            self._open_stream(sdata)
+
+    def _end_utterance(self, sdata: StreamData) -> None:
+        # trailing noise after the last speech frame is not sent to STT
+        audio_length = sdata['speech_bytes'] if self.vad_enabled else len(sdata['buffer'])
+        if (audio_length > self.min_buffer_length) or (sdata['message'] is not None):
+            # the last segment of a long turn goes too, however short, it closes the message
+            self._hand_off(sdata, audio_length, final=True)
+        else:
+            #this state should never occur
+            logger.info(f'buffer {audio_length} expected {self.min_buffer_length}')
+            self._close_stream(sdata, cancel=True)
+        #either case, setting the last_time to none will have the write method
+        #clear the data
+        sdata['last_time'] = None
+
+    def start_playback(self) -> None:
+        '''
+        moves the sentences TTS queued in queues.audio_out into the playback source 
+        and makes sure the player is running. The source is played once and never 
+        ends, so sentences follow each other without a gap.
+        '''
+        if self.closed or (self.voice_client is None):
             return
-                    
-        current_time = time.perf_counter()
-        for key in self.audio_buffer_dict.keys():
-            sdata = self.audio_buffer_dict[key]
-            if sdata['last_time'] == None:
+        while self.play_queue:
+            audio_out = self.play_queue.popleft()
+            if self.playback.is_opus():
+                audio = audio_out.get('opus')
+            else:
+                audio = audio_out['audio'].getbuffer() if audio_out['audio'] else None
+            if audio is None:
+                logger.info(f'Error: sentence does not match the playback format, skipped')
                 continue
-            time_diff = current_time - sdata['last_time']
-            logger.debug(f'time diff {time_diff:.3f} sdata last time {sdata["last_time"]:3f}')
-
-            #check for time diff for end of speaking delay (min_audio_len)
-            if time_diff > (self.end_speaking_delay / 1000):
-                if len(sdata['buffer']) > self.min_buffer_length:
-                    message = Discord_Message(
-                            user_name= sdata['member'].capitalize(),
-                            user_id = sdata['member_id'],
-                            listener_ids = set(self.listeners.keys()),
-                            listener_names = set(self.listeners.values()),
-                            timestamp_Audio_Start = sdata['start_time'],
-                            timestamp_Audio_End = datetime.now(),
-                            timestamp=datetime.now()
-                            )
-                    self.bot.custom.queues.audio_in.append(Audio_Message(audio_data=sdata['buffer'],message=message))
-                    logger.info(f'Audio added to TTS queue for {sdata["member"]}')
-                else:
-                    #this state should never occur
-                    logger.info(f'buffer {len(sdata["buffer"])} expected {self.min_buffer_length}')
-                #either case, setting the last_time to none will have the write method
-                #clear the data
-                sdata['last_time'] = None
-            #check if an interrupt was sent but not enough to process the audio
-            elif (time_diff > self.interrupt_time) and (len(sdata['buffer']) < self.min_buffer_length):
-                logger.debug(f'speaker_interrupt_clear sent')
-                sdata['last_time'] = None
-                self.bot.dispatch(f'speaker_interrupt_clear', message = Speaking_Interrupt({
-                        "num_sentences" : 0,
-                        "user_id" : sdata["member_id"],
-                        "user_name" : sdata['member']
-                        }))
-
-    @monitor.before_loop
-    async def before(self):
-        await self.bot.wait_until_ready()
-
-    @monitor.after_loop
-    async def after(self):
-        logger.debug('stt monitor stopped')
-
-    def _drop(self, user_id: int) -> None:
-        if user_id in self.audio_buffer_dict:
-            del self.audio_buffer_dict[user_id]
+            if 'continues' in audio_out:
+                # next piece of a sentence that is streamed from TTS
+                self.playback.append(audio, tag=audio_out['continues'], extend=True,
+                        complete=audio_out.get('complete', True))
+            else:
+                self.playback.append(audio, tag=audio_out, complete=audio_out.get('complete', True))
+        if not self.playback.buffered:
+            return
+        try:
+            if self.voice_client.is_paused():
+                self.voice_client.resume()
+            elif not self.voice_client.is_playing():
+                self.voice_client.play(self.playback, after=self._after_play)
+        except (ValueError, discord.ClientException) as e:
+            logger.info(f'Error: {e}')
+
+    def _on_playback_idle(self) -> None:
+        # player thread, the playback source has been sending silence for a while
+        self.loop.call_soon_threadsafe(self._pause_playback)
+
+    def _pause_playback(self) -> None:
+        # stops the speaking indicator and the silence packets until TTS has more audio
+        if self.playback.buffered or self.closed or (self.voice_client is None):
+            return
+        if self.voice_client.is_playing():
+            self.voice_client.pause()
 
-    @monitor
-    def _await(self, coro: Awaitable[T]) -> CFuture[T]:
-        assert self.client is not None
-        logger.info(f'stt sink _await')
-        return asyncio.run_coroutine_threadsafe(coro)#, self.client.loop)
+    def _after_play(self, error: Optional[Exception]) -> None:
+        # runs on the discord.py player thread, the player only ends on stop,
+        # disconnect or error. The next start_playback starts a new one.
+        if error:
+            logger.info(f'Error: {error}')
+
+    def _interrupt_message(self, position: Optional[Playback_Position], sdata: StreamData) -> Speaking_Interrupt:
+        '''
+        what the users heard of the bot message that was cut off, from the exact 
+        playback position. Sentences still in the play queue were not heard either.
+        '''
+        int_message = Speaking_Interrupt(
+                num_sentences=len(self.play_queue),
+                user_id=sdata['member_id'],
+                user_name=sdata['member'])
+        if position is None:
+            return int_message
+        int_message['num_sentences'] += len(position['pending'])
+        audio_out: Audio_Out = position['tag']
+        if (audio_out is None) or (audio_out['sentence_index'] is None):
+            return int_message
+        int_message['disc_message'] = audio_out['disc_message']
+        if position['played_bytes'] >= position['total_bytes']:
+            int_message['sentences_heard'] = audio_out['sentence_index'] + 1
+            int_message['partial_fraction'] = 0.0
+        else:
+            int_message['sentences_heard'] = audio_out['sentence_index']
+            int_message['partial_fraction'] = position['played_bytes'] / position['total_bytes']
+        return int_message
+
+    def _open_stream(self, sdata: StreamData) -> None:
+        # the stream borrows a connection from the STT cog's pools like buffered audio does
+        stt_cog = self.bot.get_cog('STT')
+        sdata['stt_stream'] = STT_Stream(
+                host=self.stt_host,
+                port=self.stt_port,
+                pool=stt_cog.pick_pool() if stt_cog else None,
+                input_rate=self.rate,
+                input_channels=self.channels,
+                input_width=self.width // self.channels,
+                loop=self.loop,
+                resampler=Polyphase_Resampler(
+                        input_rate=self.rate, 
+                        output_rate=stt_rate, 
+                        input_channels=self.channels) if self.stt_resample else None)
+
+    def _close_stream(self, sdata: StreamData, cancel: bool = False) -> Optional[STT_Stream]:
+        '''
+        sends the end of speech to the streaming STT session (or drops it), returns
+        the stream so the STT cog can wait on the transcript
+        '''
+        stt_stream = sdata['stt_stream']
+        sdata['stt_stream'] = None
+        if stt_stream is None:
+            return None
+        if cancel:
+            stt_stream.cancel()
+            return None
+        stt_stream.finish()
+        return stt_stream
 
     def wants_opus(self) -> bool:
-        #logger.debug(f'stt sink wants_opus')
-        return False
+        # with a decoder pool, voice_recv skips decoding and passes the raw opus
+        return self.decoder_pool is not None
 
     def write(self, user: Optional[MemberOrUser], data: voice_recv.VoiceData) -> None:
-
+        '''
+        runs on the voice_recv reader thread. Only builds the frame descriptor and 
+        queues it (or hands the opus to the decoder pool), everything else happens 
+        on the loop in _drain_frames
+        '''
         if self.ignore_silence_packets and isinstance(data.packet, voice_recv.SilencePacket):
             logger.info(f'stt sink write - self.ignore_silence and isinstance')
             return
@@ -226,52 +468,122 @@ class Speech_To_Text_Sink(voice_recv.AudioSink):
             logger.info(f'stt sink write - user none')
             return
 
-        sdata = self.audio_buffer_dict[user.id]
+        frame = Voice_Frame(
+                user_id=user.id,
+                member=data.source.name,
+                ssrc=data.packet.ssrc,
+                sequence=data.packet.sequence,
+                pcm=data.pcm,
+                opus=None,
+                time=self.loop.time())
+        if self.decoder_pool:
+            frame['opus'] = data.opus
+            self.decoder_pool.submit(frame)
+        else:
+            self._queue_frame(frame)
+
+    def _queue_frame(self, frame: Voice_Frame) -> None:
+        # voice_recv thread or a decoder thread
+        if self.frames.put(frame):
+            self.loop.call_soon_threadsafe(self._drain_frames)
+
+    def _drain_frames(self) -> None:
+        for frame in self.frames.drain():
+            self._process_frame(frame)
+        if self.frames.dropped:
+            logger.info(f'stt sink - {self.frames.dropped} frames dropped, the loop is falling behind')
+            self.frames.dropped = 0
+
+    def _process_frame(self, frame: Voice_Frame) -> None:
+        user_id = frame['user_id']
+        sdata = self.audio_buffer_dict[user_id]
+
+        speech = True
+        if self.vad_enabled:
+            turn_ended = sdata['vad'].end_of_turn
+            speech = sdata['vad'].process(frame['pcm'])
+            # noise before the utterance starts or after the end of turn is dropped
+            if not speech and ((sdata['last_time'] == None) or sdata['vad'].end_of_turn):
+                if (sdata['last_time'] != None) and not turn_ended:
+                    # the vad just ended the turn, hand it off now
+                    self._arm_deadline(user_id, self.loop.time(), 'end')
+                return
 
         if sdata['last_time'] == None:
-            del sdata['buffer'][:]
-            sdata['buffer'] = array.array('B')
-            sdata['member'] = data.source.name
-            sdata['ssrc'] = data.source.id
-            sdata['member_id'] = user.id
+            sdata['buffer'].start_utterance()
+            sdata['member'] = frame['member']
+            sdata['ssrc'] = frame['ssrc']
+            sdata['member_id'] = user_id
             sdata['iterrupt_sent'] = False
-            sdata['start_time'] = time.perf_counter()
-            sdata['last_sequence'] = data.packet.sequence
+            sdata['start_time'] = frame['time']
+            sdata['last_sequence'] = frame['sequence']
+            sdata['speech_bytes'] = 0
+            sdata['message'] = None
+            if self.stt_streaming:
+                self._open_stream(sdata)
 
-        #logger.info(f'{data.packet.sequence}')
         #discord does not trasmit silence packets, so we have to check for silence here
-        if data.packet.sequence > (sdata['last_sequence'] + 1):
-            missing_packets = data.packet.sequence - (sdata['last_sequence']+ 1)
-            sdata['buffer'].extend([0] * missing_packets * self.audio_packet_lenght)
-
-        sdata['buffer'].extend(data.pcm)
-        sdata['last_time'] = time.perf_counter()
-        sdata['last_sequence'] = data.packet.sequence
+        if frame['sequence'] > (sdata['last_sequence'] + 1):
+            missing_packets = frame['sequence'] - (sdata['last_sequence']+ 1)
+            silence = sdata['buffer'].fill_silence(missing_packets * self.audio_packet_lenght)
+            if sdata['stt_stream'] and silence:
+                sdata['stt_stream'].feed(bytes(silence))
+
+        if sdata['buffer'].write(frame['pcm']) and sdata['stt_stream']:
+            sdata['stt_stream'].feed(frame['pcm'])
+        if speech:
+            sdata['speech_bytes'] = len(sdata['buffer'])
+        sdata['last_time'] = frame['time']
+        sdata['last_sequence'] = frame['sequence']
+
+        if self.segment_length and self._segment_point(sdata, speech):
+            self._end_segment(sdata)
+
+        # short utterances get checked at interrupt_time, the rest at end_speaking_delay
+        if (len(sdata['buffer']) < self.min_buffer_length) and (sdata['message'] is None) \
+                and (self.interrupt_time < self.end_speaking_delay / 1000):
+            self._arm_deadline(user_id, sdata['last_time'] + self.interrupt_time, 'interrupt')
+        else:
+            self._arm_deadline(user_id, sdata['last_time'] + self.end_speaking_delay / 1000, 'end')
         
         # send an event to stop bot voice playback when someone speaks in
         # the channel
-        if (sdata['iterrupt_sent'] == False) and (len(self.play_queue) > 0):
-            if (time.perf_counter() - sdata['start_time']) > self.interrupt_time:
-                int_message = Speaking_Interrupt({
-                        "num_sentences=" : len(self.play_queue),
-                        "user_id" : sdata['member_id'],
-                        "user_name": sdata['member']
-                        })
+        if (sdata['iterrupt_sent'] == False) and (self.playback.buffered or self.play_queue):
+            if (frame['time'] - sdata['start_time']) > self.interrupt_time:
+                # the player keeps running, it sends silence from the next frame on
+                position = self.playback.clear()
+                int_message = self._interrupt_message(position, sdata)
+                self.play_queue.clear()
                 self.bot.dispatch('speaker_interrupt', message = int_message)
                 logger.debug(f'speaker_interrupt sent {int_message}')
-                
-                if self.voice_client.is_playing():
-                    self.voice_client.pause()
-                    self.play_queue.clear()
                 sdata['iterrupt_sent'] = True
 
-        logger.debug(f'stt sink write {user}')
+        logger.debug(f'stt sink frame {sdata["member"]}')
+
+    def _segment_point(self, sdata: StreamData, speech: bool) -> bool:
+        '''True when a long turn should be split after this frame'''
+        if len(sdata['buffer']) + self.audio_packet_lenght > sdata['buffer'].max_utterance_bytes:
+            # the next frame would be cut off
+            return True
+        return self.vad_enabled and (not speech) \
+                and (sdata['speech_bytes'] >= self.segment_buffer_length) \
+                and (sdata['vad'].silent_frames >= self.segment_pause_frames)
 
     def cleanup(self, *args, **kwargs) -> None:
         logger.debug(f'communications cleanup')
+        self.closed = True
         self.play_queue.clear()
-        if self.voice_client.is_playing():
-            self.voice_client.pause()
+        self.playback.clear()
+        if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            self.voice_client.stop()
+        for handle in self.deadlines.values():
+            handle.cancel()
+        self.deadlines.clear()
+        self.frames.clear()
+        if self.decoder_pool:
+            self.decoder_pool.close()
+        for sdata in self.audio_buffer_dict.values():
+            self._close_stream(sdata, cancel=True)
         if len(kwargs.keys()) > 0:
             for user_id in tuple(self.audio_buffer_dict.keys()):
                 self._drop(user_id)
@@ -281,8 +593,9 @@ class Speech_To_Text_Sink(voice_recv.AudioSink):
 
         buffer = data.get('buffer')
         if buffer:
-            # arrays don't have a clear function
-            del buffer[:]
+            buffer.clear()
+        if self.decoder_pool and (data.get('ssrc') is not None):
+            self.decoder_pool.drop(data['ssrc'])
             
         logger.info(f'stt sink _drop')
 
@@ -320,7 +633,16 @@ class Audio_Cog(commands.Cog):
                 bot = self.bot, 
                 min_audio_len= int(self.bot.custom.config['com_min_audio_len']),
                 end_speaking_delay= int(self.bot.custom.config['com_end_speaking_delay']),
-                interrupt_time= int(self.bot.custom.config['com_interrupt_time']))
+                interrupt_time= int(self.bot.custom.config['com_interrupt_time']),
+                max_audio_len= int(self.bot.custom.config.get('com_max_audio_len', 30000)),
+                stt_streaming= bool(int(self.bot.custom.config.get('STT_streaming', 0))),
+                stt_resample= bool(int(self.bot.custom.config.get('STT_resample', 1))),
+                opus_decoders= int(self.bot.custom.config.get('com_opus_decoders', 0)),
+                opus_playback= int(self.bot.custom.config.get('TTS_opus_encoders', 0)) > 0,
+                segment_len= int(self.bot.custom.config.get('com_segment_len', 10000)),
+                segment_pause= int(self.bot.custom.config.get('com_segment_pause', 100)),
+                vad= bool(int(self.bot.custom.config.get('com_vad', 1))),
+                vad_threshold= float(self.bot.custom.config.get('com_vad_threshold', -45)))
         
         logger.info(f"Connected to {self.voice_channel_title}")
         self.bot.dispatch('voice_client_connected', 
@@ -332,10 +654,11 @@ class Audio_Cog(commands.Cog):
 
         self.voice_client.listen(self.stt_sink)
             
-    #@commands.Cog.listener('on_TTS_play')
-    #async def on_TTS_play(self, audio:io.BytesIO, **kwargs):
-    #    logger.debug('on TTS play received')
-    #    self.play_queue.append(audio)
+    @commands.Cog.listener('on_TTS_play')
+    async def on_TTS_play(self, **kwargs):
+        # audio was added to queues.audio_out
+        if self.stt_sink:
+            self.stt_sink.start_playback()
 
     @AudioSink.listener()
     def on_voice_member_disconnect(self, member: discord.Member, ssrc: Optional[int]) -> None:
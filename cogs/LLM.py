@@ -34,6 +34,23 @@ Configuration - expected in the .env config
     LLM_api_key - openai goodness
     LLM_server_type - ollama, openai, text-get-webui
     LLM_SFW - 1 for yes - not currently implimented
+    LLM_connections, LLM_http2, LLM_timeout - the shared http client, see 
+        scripts/LLM_interface.py. It is closed in cleanup.
+    LLM_token_cache(default ./token_counts.json, empty for memory only) - token 
+        counts of messages and prompts (scripts/token_counter.py). token_monitor
+        counts the queued messages in batches while the bot is not generating.
+    LLM_prompt_layout(append/relative, default append) - append writes the message 
+        history with absolute times (to the minute) and only adds to its end, the 
+        server reuses its prompt cache for everything but the new messages. When the
+        history outgrows its tokens the oldest half is dropped at once. relative is the
+        old "2 minutes" layout, every turn is evaluated in full. Set OLLAMA_NUM_PARALLEL
+        to 2 or more so the CTR and CHAT prompts keep a cache each.
+    LLM_prefill(0/1, default 1) - with the append layout, between turns botman_monitor
+        sends the next prompt up to its new messages (1 token answer) so the server
+        has evaluated the history and the last response before the next user is done
+        talking. Only the new message is left when the transcript arrives. The
+        count requests use the same slot, the queued messages are counted before the
+        prefill and no more until the next turn, a count after it would evict it.
     LLM_speaker_pause_time - time to pause between speakers in ms.
     LLM_message_history_privacy - as the messages are processed in batches, there has 
         to be a way to limit the message history. Might need to impliment a responded to for the
@@ -47,8 +64,10 @@ Configuration - expected in the .env config
 
 Event listeners -
 
-    on_speaker_interrupt - stop llm generation. expected data is the memeber_id speaking
-        and append the data to the current_speaking list
+    on_speaker_interrupt - stop llm generation. expected data is a Speaking_Interrupt with
+        the bot message that was cut off and exactly how much of it was played. The stop
+        is latched until the stream has ended, an interrupt of the message still being
+        streamed is applied to its text after it has ended (cleanup_interrupt)
 
     on_message_history - message hisory from DB for a user logging in
         in the form of a dict with the key of a mssage id and value of
@@ -61,6 +80,8 @@ import logging, asyncio
 from datetime import datetime
 from time import perf_counter
 
+import httpx
+
 from discord import TextChannel
 from discord.ext import commands, tasks
 
@@ -98,16 +119,13 @@ class Bot_Manager(commands.Cog, Bot_LLM):
         self.choosing_to_respond_in_progress: bool = False
         self.wmh_in_progress: bool = False
 
+        self.prefill: bool = bool(int(self.bot.custom.config.get('LLM_prefill', 1)))
+        self.prefill_task: asyncio.Task = None
+        self.prefilled_key: tuple = None
+        self.counting_tokens: bool = False
 
     @tasks.loop(seconds=0.1)
     async def botman_monitor(self):
-        if self.user_speaking:
-            self.stop_generation = True
-            self.llm.stop_generation = True
-        else:
-            self.stop_generation = False
-            self.llm.stop_generation = False
-
         # close the aiohttp session if inactive
         #if (perf_counter() - self.llm.session_last) < 2:
         #    if not self.llm.session.closed:
@@ -127,6 +145,22 @@ class Bot_Manager(commands.Cog, Bot_LLM):
                 process_list.append(item)
             await self.process_user_messages(process_list)
 
+        # between turns, while the room is quiet or someone is still talking
+        elif self.prefill:
+            self.start_prefill()
+
+    def start_prefill(self):
+        '''the next prompt's prefix goes to the server's cache once per change'''
+        if (self.prefill_task is not None) and (not self.prefill_task.done()):
+            return
+        if self.counting_tokens or self.get_token_queue:
+            # token_monitor first, the counts also decide what the prompt holds
+            return
+        key = self.prefill_key()
+        if key == self.prefilled_key:
+            return
+        self.prefilled_key = key
+        self.prefill_task = asyncio.get_running_loop().create_task(self.prefill_next_prompt())
                 
     async def choose_to_respond(self):
         if self.choosing_to_respond_in_progress:
@@ -172,6 +206,7 @@ class Bot_Manager(commands.Cog, Bot_LLM):
                     'alt_host' : None,
                     'alt_port' : None,
                     'disc_message' : response_message,
+                    'sentence_index' : len(response_message.sentences) - 1,
                     }))
         response_message = self.cleanup_interrupt(response_message)
         self.queues.db_message.append(response_message)
@@ -181,47 +216,57 @@ class Bot_Manager(commands.Cog, Bot_LLM):
         self.wmh_in_progress = False
 
     def cleanup_interrupt(self, disc_message: Discord_Message) -> Discord_Message:
-        if disc_message.text_user_interrupt is None:
-            return disc_message
-        interrupt_list = []
-        sentence_list = []
-        int_start = False
-        for sentence in disc_message.sentences:
-            if sentence.startswith('~(') and sentence.endswith(')'):
-                if not int_start:
-                    int_start = True
-                else:
-                    interrupt_list.append(sentence)
-            elif sentence == '~~':
-                pass
-            else:
-                interrupt_list.append(sentence)
-                sentence_list.append(sentence)
-        disc_message.text_user_interrupt = ' '.join(sentence_list)
-        disc_message.text = ' '.join(interrupt_list)
-        return disc_message
+        # an interrupt of the message while it was streaming is applied now that it has ended
+        return self.apply_pending_interrupt(disc_message)
 
     async def get_prompt_tokens(self):
-        await asyncio.sleep(3)
-        text = self.prompts.gen_prompt_chat(self.prompts.bot_info, {'Alice', 'Bob'})
-        num_tokens = await self.llm.get_num_tokens(prompt=text)
-        self.prompts.bot_info.set_tokens(prompt_name="CHAT",tokens=num_tokens)
-        print(num_tokens)
-        
-        text = self.prompts.gen_prompt_ctr(bot_info=self.prompts.bot_info, listeners={'Alice', 'Bob'}, history= '')
-        num_tokens = await self.llm.get_num_tokens(prompt=text)
-        self.prompts.bot_info.set_tokens(prompt_name="CTR",tokens = num_tokens)
-        print(num_tokens)
-
-        self.llm.assistant_tokens = await self.llm.get_num_tokens(self.llm.prompt_assistant)
-        print(self.llm.assistant_tokens)
-
-    @commands.Cog.listener('on_speaking_interrupt')
-    async def on_speaking_interrupt(self, speaking_interrupt: Speaking_Interrupt):
+        # counted once per model and prompt text, token_counter keeps them across restarts
+        texts = [self.prompts.gen_prompt_chat(self.prompts.bot_info, {'Alice', 'Bob'}),
+                self.prompts.gen_prompt_ctr(bot_info=self.prompts.bot_info, listeners={'Alice', 'Bob'}, history= ''),
+                self.llm.prompt_assistant]
+        if any(self.token_counter.get(text) is None for text in texts):
+            # delay with library load
+            await asyncio.sleep(3)
+        try:
+            chat_tokens, ctr_tokens, self.llm.assistant_tokens = await self.token_counter.count_many(texts)
+        except (httpx.HTTPError, ValueError) as e:
+            # estimates, counted again at the next connect
+            logger.info(f'Prompt tokens could not be counted, estimated: {e}')
+            chat_tokens, ctr_tokens, self.llm.assistant_tokens = (len(text) // 4 for text in texts)
+        self.prompts.bot_info.set_tokens(prompt_name="CHAT",tokens=chat_tokens)
+        self.prompts.bot_info.set_tokens(prompt_name="CTR",tokens = ctr_tokens)
+        await asyncio.to_thread(self.token_counter.save)
+        logger.info(f'Prompt tokens CHAT {chat_tokens} CTR {ctr_tokens} assistant {self.llm.assistant_tokens}')
+
+    def prefill_holds_cache(self) -> bool:
+        '''a prefill is running or went out since the last turn'''
+        if self.prefill_task is None:
+            return False
+        if not self.prefill_task.done():
+            return True
+        if self.prefill_task.cancelled() or self.prefill_task.exception():
+            return False
+        return (self.prefilled_key == self.prefill_key()) and (self.prefill_task.result() is not None)
+
+    @tasks.loop(seconds=1)
+    async def token_monitor(self):
+        # message token counts for the prompt budget, in batches while the bot is idle.
+        # A count request would push the prefilled prompt out of a one slot server's cache
+        if self.wmh_in_progress or self.choosing_to_respond_in_progress or self.prefill_holds_cache():
+            return
+        self.counting_tokens = True
+        try:
+            await self.count_queued_tokens()
+        finally:
+            self.counting_tokens = False
+
+    @commands.Cog.listener('on_speaker_interrupt')
+    async def on_speaker_interrupt(self, message: Speaking_Interrupt):
         if self.track_message_interrupt:
-            message = self.interupt_sentences(interrupt = speaking_interrupt)
-            self.queues.text_message.append(message)
-        self.stop_generation = True
+            interrupted = self.interupt_sentences(interrupt = message)
+            if interrupted:
+                self.queues.text_message.append(interrupted)
+        self.interrupt_generation()
 
     @commands.Cog.listener('on_message_history')
     async def on_message_history(self, user_id: int, message_history: dict[datetime, Discord_Message]):
@@ -236,6 +281,7 @@ class Bot_Manager(commands.Cog, Bot_LLM):
         self.bot_id = self.bot.user.id
         self.bot_name = self.bot.user.name
         self.botman_monitor.start()
+        self.token_monitor.start()
         # delay with library load
         self.prompts.bot_info.name = self.bot_name
         await self.get_prompt_tokens()
@@ -244,7 +290,13 @@ class Bot_Manager(commands.Cog, Bot_LLM):
     async def cleanup(self):
         if self.botman_monitor:
             self.botman_monitor.stop()
-        pass
+        if self.token_monitor.is_running():
+            self.token_monitor.stop()
+        if self.prefill_task is not None:
+            self.prefill_task.cancel()
+        logger.info(f'LLM prefill - {self.prefill_count} prompts, {self.prefill_tokens} tokens evaluated ahead of time')
+        await asyncio.to_thread(self.token_counter.save)
+        await self.llm.close()
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Bot_Manager(bot))
\ No newline at end of file
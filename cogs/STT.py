@@ -5,17 +5,55 @@ Yes, the wyomining protocol is not well documented but it works.
 Audio in is process through the deque audio_in containing Audio_Message(audio data and Discord_Message)
 The text is added to the Discord_Message and sent to the deque LLM for further processing.
     if the last message in the LLM queue has the same member_id as the current message, it will be merged with that message.
+
+With STT_streaming enabled the Audio cog has already sent the audio to the server, so the 
+Audio_Message carries an STT_Stream and only the transcript is awaited here. If the stream
+failed, the buffered audio is sent the old way.
+
+STT_resample (default 1) - the 48khz stereo Discord audio is downmixed and resampled to 
+16khz mono in a worker thread before it is sent, Whisper would do the same on the server.
+
+STT_connections (default 2) - buffered audio is sent on connections borrowed from a 
+Wyoming_Pool: one is kept connected and health checked ahead of time, at most this many 
+requests run at once per server.
+
+STT_trim (0/1, default 1) - leading and trailing silence is cut before the audio is sent
+and utterances with less than STT_min_speech_ratio (default 0.2) speech frames are dropped,
+near silent audio is what makes Whisper hallucinate. Streamed audio is already on the 
+server, the gate still drops its transcript.
+
+STT_chunk_ms (default 100) - audio per AudioChunk event when buffered audio is sent
+
+STT_timeout (seconds, default 15) - longest wait for a transcript. A server that does not
+answer in time is treated like one that failed: a streamed utterance is resent, buffered 
+audio goes to another server once, then it is dropped. Transcripts are delivered in order,
+without it one hung server would hold back every later one.
+
+STT_servers (optional, 'host:port,host:port') - more STT servers, STT_host:STT_port is 
+used when not set. Each gets its own pool.
+
+Every Audio_Message is transcribed as soon as it arrives (speaker_event, STT_monitor picks
+up anything left), several at once. A request goes to the server with the fewest requests
+outstanding and is retried once on another one if it fails. Finished transcripts wait for
+the earlier utterances, so they reach queues.llm in the order the users spoke.
+
+Long turns arrive in segments (com_segment_len in cogs/Audio.py) that share one 
+Discord_Message. They are transcribed while the user is still talking, the text of each
+segment is held until the final one is in and the message is passed on once, whole.
 '''
-import logging
+import logging, asyncio
 from datetime import datetime
 
 from discord.ext import commands, tasks
 from discord.opus import Decoder as DiscOpus
 from typing import Union 
 
-from scripts.STT_wfw import transcribe
+from scripts.STT_wfw import transcribe, stt_rate, stt_channels, stt_width
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.audio_trim import Silence_Trimmer
+from scripts.wyoming_pool import Wyoming_Pool
 from scripts.discord_ext import Commands_Bot
-from scripts.datatypes import Discord_Message, Halluicanation_Sentences
+from scripts.datatypes import Discord_Message, Audio_Message, Halluicanation_Sentences
 from scripts.utils import time_diff
 
 logger = logging.getLogger(__name__)
@@ -28,6 +66,40 @@ class STT(commands.Cog):
         self.time_between_messages: float = float(self.bot.custom.config['behavior_time_between_messages'])
         self.host = self.bot.custom.config['STT_host']
         self.port = self.bot.custom.config['STT_port']
+        self.resampler: Polyphase_Resampler = None
+        if bool(int(self.bot.custom.config.get('STT_resample', 1))):
+            self.resampler = Polyphase_Resampler(
+                    input_rate=DiscOpus.SAMPLING_RATE,
+                    output_rate=stt_rate,
+                    input_channels=DiscOpus.CHANNELS)
+        self.trimmer: Silence_Trimmer = None
+        if bool(int(self.bot.custom.config.get('STT_trim', 1))):
+            self.trimmer = Silence_Trimmer(
+                    rate=DiscOpus.SAMPLING_RATE,
+                    channels=DiscOpus.CHANNELS,
+                    width=DiscOpus.SAMPLE_SIZE // DiscOpus.CHANNELS,
+                    threshold_db=float(self.bot.custom.config.get('com_vad_threshold', -45)),
+                    min_speech_ratio=float(self.bot.custom.config.get('STT_min_speech_ratio', 0.2)))
+
+        servers = self.bot.custom.config.get('STT_servers') or f'{self.host}:{self.port}'
+        self.pools: list[Wyoming_Pool] = []
+        for server in servers.split(','):
+            host, port = server.strip().rsplit(':', 1)
+            self.pools.append(Wyoming_Pool(
+                    host=host,
+                    port=int(port),
+                    max_connections=int(self.bot.custom.config.get('STT_connections', 2))))
+        self.chunk_ms: int = int(self.bot.custom.config.get('STT_chunk_ms', 100))
+        self.timeout: float = float(self.bot.custom.config.get('STT_timeout', 15))
+        self.outstanding: dict[Wyoming_Pool, int] = {pool: 0 for pool in self.pools}
+
+        # utterances are numbered when they are picked up, results are handed on in that order
+        self.tasks: set[asyncio.Task] = set()
+        self.next_sequence: int = 0
+        self.deliver_sequence: int = 0
+        self.results: dict[int, tuple[Audio_Message, Union[str, None]]] = {}
+        # (segment, text) of the segments delivered so far, by turn_id
+        self.segment_text: dict[int, list[tuple[int, str]]] = {}
 
         self.STT_monitor.start()
 
@@ -56,43 +128,144 @@ class STT(commands.Cog):
 
     @tasks.loop(seconds=0.1)
     async def STT_monitor(self):
-        # process audio by looping through the first item in the queue and put results in the llm_queue
-        if self.queues.audio_in:
+        # anything that was queued without a speaker_event
+        self.dispatch_audio()
+
+    @commands.Cog.listener('on_speaker_event')
+    async def on_speaker_event(self, **kwargs):
+        self.dispatch_audio()
+
+    def dispatch_audio(self) -> None:
+        '''starts a transcription for every Audio_Message in queues.audio_in'''
+        while self.queues.audio_in:
             incoming_audio = self.queues.audio_in.popleft()
+            task = asyncio.get_running_loop().create_task(
+                    self.transcribe_message(self.next_sequence, incoming_audio))
+            self.next_sequence += 1
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def pick_pool(self, exclude: Wyoming_Pool = None) -> Wyoming_Pool:
+        '''least outstanding requests'''
+        candidates = [pool for pool in self.pools if pool is not exclude] or self.pools
+        return min(candidates, key=lambda pool: self.outstanding[pool])
+
+    async def transcribe_message(self, sequence: int, incoming_audio: Audio_Message) -> None:
+        response = None
+        try:
+            response = await self.get_text(incoming_audio)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.info(f'STT failed, utterance from {incoming_audio.message.user_name} dropped: {e}')
+        finally:
+            self.results[sequence] = (incoming_audio, response)
+            self.deliver_results()
+
+    async def get_text(self, incoming_audio: Audio_Message) -> Union[str, None]:
+        audio_data = incoming_audio.audio_data
+        if (not len(audio_data)) and (incoming_audio.stt_stream is None):
+            # end of a segmented turn without audio left
+            return None
+        if self.trimmer:
+            trim = await asyncio.to_thread(self.trimmer.trim, audio_data, incoming_audio.noise_floor_db)
+            if trim['speech_ratio'] < self.trimmer.min_speech_ratio:
+                logger.info(f'STT - utterance from {incoming_audio.message.user_name} dropped, '
+                        f'{trim["speech_ratio"]:.0%} speech')
+                return None
+            audio_data = audio_data[trim['start']:trim['end']]
+
+        if incoming_audio.stt_stream:
+            # audio was streamed while the user was talking, only the transcript is left
+            try:
+                response = await asyncio.wait_for(incoming_audio.stt_stream.transcript(), timeout=self.timeout)
+                if response is not None:
+                    return response
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.info(f'STT stream failed, resending the buffered audio: {e}')
+
+        if self.resampler:
+            audio_data = memoryview(await asyncio.to_thread(
+                    self.resampler.resample, audio_data))
+            rate, channels, width = stt_rate, stt_channels, stt_width
+        else:
+            # SAMPLE_SIZE is the size of a sample frame, wyoming wants bytes per sample
+            rate, channels = DiscOpus.SAMPLING_RATE, DiscOpus.CHANNELS
+            width = DiscOpus.SAMPLE_SIZE // DiscOpus.CHANNELS
+
+        pool = self.pick_pool()
+        for attempt in range(min(2, len(self.pools))):
+            if attempt:
+                pool = self.pick_pool(exclude=pool)
+            self.outstanding[pool] += 1
+            try:
+                return await asyncio.wait_for(transcribe(
+                        audio_data=audio_data,
+                        host=pool.host,
+                        port=pool.port,
+                        input_channels=channels,
+                        input_rate=rate,
+                        input_width=width,
+                        pool=pool,
+                        chunk_ms=self.chunk_ms), timeout=self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt or (len(self.pools) == 1):
+                    raise
+                logger.info(f'STT {pool.host}:{pool.port} failed, trying another server: {e}')
+            finally:
+                self.outstanding[pool] -= 1
+
+    def deliver_results(self) -> None:
+        '''hands the finished transcripts on, stops at the first one still running'''
+        while self.deliver_sequence in self.results:
+            incoming_audio, response = self.results.pop(self.deliver_sequence)
+            self.deliver_sequence += 1
             message = incoming_audio.message
-            response = await transcribe(
-                    audio_data=incoming_audio.audio_data,
-                    host=self.host,
-                    port=self.port,
-                    input_channels=DiscOpus.CHANNELS,
-                    input_rate=DiscOpus.SAMPLING_RATE,
-                    input_width=DiscOpus.SAMPLE_SIZE)
-            message.text = self.halluicanation_check(response)
-            if not message.text:
-                # hallucination detected, discard the message and return
-                return
-            message.timestamp_STT = datetime.now()
+            # segments are checked one by one, whisper hallucinates per request
+            text = self.halluicanation_check(response) if response is not None else None
+            if not incoming_audio.final:
+                if text:
+                    self.segment_text.setdefault(incoming_audio.turn_id, []).append(
+                            (incoming_audio.segment, text))
+                continue
+            parts = self.segment_text.pop(incoming_audio.turn_id, [])
+            if text:
+                parts.append((incoming_audio.segment, text))
+            if parts:
+                self.add_message(message, ' '.join(part for _, part in sorted(parts)))
+
+    def add_message(self, message: Discord_Message, text: str) -> None:
+        message.text = text
+        message.timestamp_STT = datetime.now()
 
         #check to see if the last message in the LLM queue is by the same member and update the data
-            if self.queues.llm:
-                if (self.queues.llm[-1].user_id == message.user_id) and ((self.queues.llm[-1].timestamp_Audio_End - message.timestamp_Audio_End).total_seconds() < self.time_between_messages):
-                    current_message = self.queues.llm[-1]
-                    current_message.text += ' ' + message.text
-                    current_message.timestamp_Audio_End = message.timestamp_Audio_End
-                    current_message.timestamp_STT = message.timestamp_STT
-                    current_message.listener_names.union(message.listener_names)
-                    current_message.listener_ids.union(message.listener_ids)
-                    logger.info(f'STT - Update LLM message {time_diff(current_message.timestamp_STT, current_message.timestamp_Audio_End)} {current_message.user_name} {current_message.text}')
-            else:
-                # new messages are added to the DB and LLM queues. 
-                self.queues.llm.append(message)
-                self.queues.db_message.append(message)
-                self.queues.text_message.append(message)
-                logger.info(f'STT - New LLM message {(time_diff(message.timestamp_Audio_End, message.timestamp_STT))}')
-                
+        if self.queues.llm and (self.queues.llm[-1].user_id == message.user_id) and \
+                ((message.timestamp_Audio_End - self.queues.llm[-1].timestamp_Audio_End).total_seconds() < self.time_between_messages):
+            current_message = self.queues.llm[-1]
+            current_message.text += ' ' + message.text
+            current_message.timestamp_Audio_End = message.timestamp_Audio_End
+            current_message.timestamp_STT = message.timestamp_STT
+            current_message.listener_names.update(message.listener_names)
+            current_message.listener_ids.update(message.listener_ids)
+            logger.info(f'STT - Update LLM message {time_diff(current_message.timestamp_STT, current_message.timestamp_Audio_End)} {current_message.user_name} {current_message.text}')
+        else:
+            # new messages are added to the DB and LLM queues. 
+            self.queues.llm.append(message)
+            self.queues.db_message.append(message)
+            self.queues.text_message.append(message)
+            logger.info(f'STT - New LLM message {(time_diff(message.timestamp_Audio_End, message.timestamp_STT))}')
+
+    @commands.Cog.listener('on_connect')
+    async def on_connect(self, *args, **kwargs):
+        # first connection is ready before the first utterance
+        for pool in self.pools:
+            pool.warm()
+
     async def cleanup(self):
         if self.STT_monitor.is_running():
             self.STT_monitor.stop()
+        for task in tuple(self.tasks):
+            task.cancel()
+        for pool in self.pools:
+            await pool.close()
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(STT(bot))
\ No newline at end of file
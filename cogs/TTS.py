@@ -2,27 +2,70 @@
 TTS cog 
 
 Designed around Piper, but just set None to the field fothat uses piper with the wyoming protocol (Home Assistant / Rasspy)
-'''
 
-import logging, array, io, asyncio#, time#, wave
-from datetime import datetime
+Configuation expected in the .env config file
+    TTS_host, TTS_port - the wyoming piper server
+
+    TTS_servers(optional, 'host:port,host:port') - several piper servers, sentences
+        are routed between them by scripts/tts_router.py: each voice stays on one
+        server, servers that are down or slow are avoided and a failed request is
+        retried on another. Defaults to TTS_host:TTS_port. TTS_Message alt_host /
+        alt_port still pin a sentence to a server.
+    TTS_slow_ms(int, default 2000) - a server whose time to first audio averages
+        more than this gets no new requests while others are faster, tts_probe 
+        times a short sentence on it every 10 seconds until it is back under
+
+    TTS_opus_encoders(int, default 0) - above 0 every sentence is encoded to Opus on
+        that many threads right after synthesis and played as is (see cogs/Audio.py),
+        0 queues 48khz stereo pcm that discord.py encodes while playing
+
+    TTS_connections(int, default 2) - sentences synthesized at once per server. Each 
+        server has a Wyoming_Pool of open connections, the next sentences are 
+        requested while the first one is still being synthesized. Finished sentences 
+        wait for the earlier ones, so queues.audio_out stays in order.
+
+    Piper's audio is converted to 48khz stereo with a Polyphase_Resampler in a worker
+    thread, in the format piper announces in audio-start (voice models differ).
 
-import numpy as np
+    TTS_streaming(0/1, default 1) - piper's audio chunks are resampled as they arrive
+        and the sentence at the head of the queue is played while it is still being
+        synthesized. Not with TTS_opus_encoders, those encode whole sentences.
 
-import librosa
+    TTS_cache_mb(int, default 32, 0 disables) - short phrases are cached as final audio
+        (scripts/tts_cache.py), a repeated "Yeah." plays without asking piper again
+    TTS_cache_dir(optional) - keeps the cached phrases on disk across restarts
+    TTS_cache_disk_mb(int, default 256) - size of the disk cache
+'''
+
+import logging, array, io, asyncio, copy#, time#, wave
+from datetime import datetime
+from typing import Union, TypedDict
 
 from discord.opus import Decoder as DiscOpus
 from discord.ext import commands, tasks
 
 import wyoming.tts as wyTTS
 
-from scripts.datatypes import TTS_Message, TTS_Audio
+from scripts.datatypes import TTS_Message, TTS_Audio, Audio_Out, Speaking_Interrupt, Discord_Message
 from scripts.discord_ext import Commands_Bot
 
-from scripts.TTS_Piper import request_TTS
+from scripts.TTS_Piper import collect_TTS
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.tts_cache import TTS_Cache
+from scripts.audio_opus import Opus_Encoder_Pool
+from scripts.tts_router import TTS_Router
 
 logger = logging.getLogger(__name__)
 
+class TTS_Job(TypedDict):
+    '''one sentence from queues.tts on its way to queues.audio_out'''
+    tts_message: TTS_Message
+    pieces: list # audio not queued yet, pcm bytes or lists of opus packets
+    head: Audio_Out # first part queued for playback, the rest continues it
+    finished: bool
+    open: bool # a piece was queued before the sentence finished, playback waits for its end
+    task: asyncio.Task
+
 class TTS(commands.Cog):
     def __init__(self, bot: Commands_Bot) -> None:
         self.bot: Commands_Bot = bot
@@ -33,74 +76,239 @@ class TTS(commands.Cog):
         self.show_timings = self.bot.custom.show_timings
         self.tts_host = self.bot.custom.config['TTS_host']
         self.tts_port = int(self.bot.custom.config['TTS_port'])
+        self.opus_pool: Opus_Encoder_Pool = None
+        opus_encoders = int(self.bot.custom.config.get('TTS_opus_encoders', 0))
+        if opus_encoders > 0:
+            self.opus_pool = Opus_Encoder_Pool(workers=opus_encoders)
+        self.connections: int = int(self.bot.custom.config.get('TTS_connections', 2))
+        # opus packets need whole sentences, streamed audio is played as pcm
+        self.streaming: bool = bool(int(self.bot.custom.config.get('TTS_streaming', 1))) \
+                and (self.opus_pool is None)
+        self.output_format: str = 'opus' if self.opus_pool else f'pcm{self.output_rate}x{self.output_channels}'
+        self.cache: TTS_Cache = None
+        cache_mb = int(self.bot.custom.config.get('TTS_cache_mb', 32))
+        if cache_mb > 0:
+            self.cache = TTS_Cache(
+                    memory_bytes=cache_mb << 20,
+                    cache_dir=self.bot.custom.config.get('TTS_cache_dir') or None,
+                    disk_bytes=int(self.bot.custom.config.get('TTS_cache_disk_mb', 256)) << 20)
+        # by (rate, channels) of the piper voice, see get_resampler
+        self.resamplers: dict[tuple[int, int], Polyphase_Resampler] = {}
+        servers = [(self.tts_host, self.tts_port)]
+        if self.bot.custom.config.get('TTS_servers'):
+            servers = []
+            for server in self.bot.custom.config['TTS_servers'].split(','):
+                host, port = server.strip().rsplit(':', 1)
+                servers.append((host, int(port)))
+        self.router: TTS_Router = TTS_Router(servers=servers,
+                max_connections=self.connections,
+                slow_ms=int(self.bot.custom.config.get('TTS_slow_ms', 2000)))
+
+        # sentences are numbered when they are picked up and queued for playback in that order
+        self.tasks: set[asyncio.Task] = set()
+        self.next_sequence: int = 0
+        self.deliver_sequence: int = 0
+        self.jobs: dict[int, TTS_Job] = {}
+        self.interrupted: Discord_Message = None
         self.tts_monitor.start()
+        self.tts_probe.start()
 
-    async def resample_audio(self, tts_audio: TTS_Audio):
+    def get_resampler(self, tts_audio: TTS_Audio) -> Union[Polyphase_Resampler, None]:
         '''
-        quick and dirty resampling and converting to stereo. Yes,
-        its not the best resample, but it works for this purpose.
-
-        Caveats:
-            - only converts mono to stereo
-            - does not change sample width (i.e. 16bit expected)
+        a resampler with its own stream state for the format piper announced, None
+        if it is already 48khz stereo. The filter is designed once per format.
         '''
-        audio_data_np = np.array(tts_audio['audio'], dtype=np.int16)
-
-        # resample first
-        if tts_audio['rate'] != self.output_rate:
-            audio_data_np_float = np.divide(audio_data_np, 32768)
-            resampled_audio_np_float = librosa.core.resample(
-                    audio_data_np_float, 
-                    orig_sr=tts_audio['rate'], 
-                    target_sr=self.output_rate,
-                    res_type='linear')
-            # just to make this as non-blocking as possible
-            await asyncio.sleep(0.0001)
-            audio_data_np = np.array(np.multiply(resampled_audio_np_float, 32786), dtype=np.int16)
-
-        # convert to stereo if needed
-        if (tts_audio['channels'] != self.output_channels) and (tts_audio['channels'] == 1):
-                audio_data_np = np.repeat(audio_data_np, self.output_channels)
-
-        return audio_data_np.tobytes()        
+        if tts_audio['width'] != 2:
+            raise ValueError(f'TTS audio is {tts_audio["width"] * 8} bit, only 16 bit is supported')
+        if (tts_audio['rate'] == self.output_rate) and (tts_audio['channels'] == self.output_channels):
+            return None
+        key = (tts_audio['rate'], tts_audio['channels'])
+        if key not in self.resamplers:
+            self.resamplers[key] = Polyphase_Resampler(
+                    input_rate=tts_audio['rate'],
+                    output_rate=self.output_rate,
+                    input_channels=tts_audio['channels'],
+                    output_channels=self.output_channels)
+        resampler = copy.copy(self.resamplers[key])
+        resampler.reset()
+        return resampler
 
     @tasks.loop(seconds=0.1)
     async def tts_monitor(self):
+        # every queued sentence is requested right away, the pools limit how many run at once
         while self.queues.tts:
-
             tts_message = self.queues.tts.popleft()
+            job = TTS_Job(tts_message=tts_message, pieces=[], head=None, finished=False, open=False, task=None)
+            self.jobs[self.next_sequence] = job
+            job['task'] = asyncio.get_running_loop().create_task(self.synthesize(job))
+            self.next_sequence += 1
+            self.tasks.add(job['task'])
+            job['task'].add_done_callback(self.tasks.discard)
+
+    @tasks.loop(seconds=10)
+    async def tts_probe(self):
+        # servers marked down get requests again once they answer
+        await self.router.probe()
 
-            if tts_message['alt_host'] or tts_message['alt_port']:
-                output = await request_TTS(text = tts_message['text'], 
-                    voice= tts_message['wyTTSSynth'], 
-                    alt_host=tts_message['alt_host'],
-                    alt_port=tts_message['alt_port'])
+    async def synthesize(self, job: TTS_Job) -> None:
+        tts_message = job['tts_message']
+        audio = None
+        key = None
+        if self.cache:
+            key = self.cache.key(tts_message['text'], tts_message['wyTTSSynth'], self.output_format)
+        try:
+            if key:
+                cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    job['pieces'].append(cached)
+                    key = None
+                    return
+            if self.streaming:
+                audio = await self.stream_audio(job, keep=key is not None)
             else:
-                output = await request_TTS(text = tts_message['text'], 
-                    voice= tts_message['wyTTSSynth'], 
-                    host=self.tts_host,
-                    port=self.tts_port)
+                audio = await self.get_audio(tts_message)
+                job['pieces'].append(audio)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            logger.info(f'TTS failed, sentence skipped: {e}')
+        finally:
+            job['finished'] = True
+            self.deliver_results()
+        if key and (audio is not None):
+            await asyncio.to_thread(self.cache.put, key, audio)
+            if self.cache.requests % 100 == 0:
+                logger.info(f'{self.cache}')
+
+    def request(self, tts_message: TTS_Message):
+        '''the audio chunks of a sentence from the server the router picks'''
+        host, port = None, None
+        if tts_message['alt_host'] or tts_message['alt_port']:
+            host = tts_message['alt_host'] or self.tts_host
+            port = tts_message['alt_port'] or self.tts_port
+        return self.router.stream(text=tts_message['text'],
+                voice=tts_message['wyTTSSynth'], host=host, port=port)
+
+    async def get_audio(self, tts_message: TTS_Message) -> Union[bytes, list[bytes]]:
+        '''the whole sentence, 48khz stereo pcm or opus packets'''
+        output = await collect_TTS(self.request(tts_message))
+
+        resampler = self.get_resampler(output)
+        if resampler:
+            output_audio = await asyncio.to_thread(resampler.resample, output['audio'])
+        else:
+            output_audio = output['audio'].tobytes()
+
+        if self.opus_pool:
+            return await self.opus_pool.encode(output_audio)
+        return output_audio
 
-            if (output['rate'] != self.output_rate) or (output['channels'] != self.output_channels):
-                output_audio = await self.resample_audio(output)
+    async def stream_audio(self, job: TTS_Job, keep: bool = False) -> Union[bytes, None]:
+        '''
+        resamples the chunks as piper sends them, the sentence at the head of the
+        queue goes to playback chunk by chunk. keep returns the whole sentence (cache)
+        '''
+        parts = []
+        resampler = False
+        async for chunk in self.request(job['tts_message']):
+            if resampler is False:
+                resampler = self.get_resampler(chunk)
+            if resampler:
+                audio = await asyncio.to_thread(resampler.process, chunk['audio'])
             else:
-                output_audio = output['audio']
+                audio = chunk['audio']
+            job['pieces'].append(audio)
+            if keep:
+                parts.append(audio)
+            self.deliver_results()
+        return b''.join(parts) if keep else None
 
-            self.queues.audio_out.append(io.BytesIO(output_audio))
-            disc_message = tts_message['disc_message']
+    def queue_pieces(self, job: TTS_Job) -> bool:
+        '''moves the audio a sentence has so far to queues.audio_out, True if any'''
+        if not job['pieces']:
+            if not (job['finished'] and job['open']):
+                return False
+            # nothing new since the last piece, playback still has to learn the sentence ended
+            job['pieces'].append([] if self.opus_pool else b'')
+        disc_message = job['tts_message']['disc_message']
+        if disc_message is self.interrupted:
+            job['pieces'].clear()
+            return False
+        if self.opus_pool:
+            audio_out = Audio_Out(audio=None, opus=[packet for piece in job['pieces'] for packet in piece])
+        else:
+            audio_out = Audio_Out(audio=io.BytesIO(b''.join(job['pieces'])))
+        job['pieces'].clear()
+        audio_out.update(
+                text=job['tts_message']['text'],
+                sentence_index=job['tts_message'].get('sentence_index'),
+                disc_message=disc_message,
+                complete=job['finished'])
+        job['open'] = not job['finished']
+        if job['head'] is None:
+            job['head'] = audio_out
             if not disc_message.timestamp_TTS_start:
                 disc_message.timestamp_TTS_start = datetime.now()
             else:
                 disc_message.timestamp_TTS_end = datetime.now()
+        else:
+            audio_out['continues'] = job['head']
+        self.queues.audio_out.append(audio_out)
+        return True
+
+    def deliver_results(self) -> None:
+        '''
+        queues the synthesized sentences for playback in order. The first unfinished
+        one passes on what it has (streaming), the ones after it wait.
+        '''
+        played = False
+        while self.deliver_sequence in self.jobs:
+            job = self.jobs[self.deliver_sequence]
+            played = self.queue_pieces(job) or played
+            if not job['finished']:
+                break
+            del self.jobs[self.deliver_sequence]
+            self.deliver_sequence += 1
+        if played:
+            self.bot.dispatch('TTS_play')
     
+    @commands.Cog.listener('on_speaker_interrupt')
+    async def on_speaker_interrupt(self, message: Speaking_Interrupt):
+        # the rest of the interrupted response will not be played, skip synthesizing it
+        if message.get('disc_message') is None:
+            return
+        # sentences already being synthesized are stopped, their audio dropped. A task
+        # cancelled before it started never runs synthesize's finally, the job is
+        # finished here so the sentences after it are still delivered
+        self.interrupted = message['disc_message']
+        for job in self.jobs.values():
+            if (job['tts_message']['disc_message'] is self.interrupted) and not job['finished']:
+                job['task'].cancel()
+                job['finished'] = True
+                job['pieces'].clear()
+        self.deliver_results()
+        for tts_message in tuple(self.queues.tts):
+            if tts_message['disc_message'] is message['disc_message']:
+                self.queues.tts.remove(tts_message)
+
     @commands.Cog.listener('on_connect')
     async def on_connect(self, *args, **kwargs):
-        #initial library loading        
-        await request_TTS(text='testing',
-                voice=None, port=self.tts_port, host=self.tts_host)
+        #initial library loading, also opens the first connections of every server
+        await asyncio.gather(*(collect_TTS(self.router.stream(text='testing', voice=self.router.last_voice.get(pool),
+                host=pool.host, port=pool.port)) for pool in self.router.pools.values()), return_exceptions=True)
 
     async def cleanup(self):
-        pass
+        self.jobs.clear()
+        if self.cache:
+            logger.info(f'{self.cache}')
+        if self.tts_monitor.is_running():
+            self.tts_monitor.stop()
+        if self.tts_probe.is_running():
+            self.tts_probe.stop()
+        for task in tuple(self.tasks):
+            task.cancel()
+        logger.info(f'{self.router}')
+        await self.router.close()
+        if self.opus_pool:
+            self.opus_pool.close()
         
 async def setup(bot: commands.Bot):
     await bot.add_cog(TTS(bot=bot))
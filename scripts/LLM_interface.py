@@ -7,13 +7,25 @@ choice_bin - a method that returns a True or False value based on the prompt
     context of the conversation. The current setup uses a prompt to choose if 
     to respond in a conversation.
 
-aiohttp session closure is responsibilty of the cog to watch the session_last
-and close it 30 seconds after last use.
+All requests go through one httpx.AsyncClient per LLM_Interface (keep-alive,
+so a response does not wait on a new connection). The owner calls close() on
+cleanup, the client is made again if it is used after that.
+    LLM_connections(int, default 4) - connections kept open to the server
+    LLM_http2(0/1, default 0) - HTTP/2, needs the h2 package (pip install httpx[http2]),
+        one connection multiplexes the requests. Ollama only speaks HTTP/1.1,
+        this is for servers behind a proxy that does.
+    LLM_timeout(seconds, default 120) - longest wait for the next bit of a response
+
+Streamed responses are NDJSON, one object per line, but a network read can hold
+part of a line or several lines. NDJSON_Decoder buffers the bytes and only
+parses whole lines (with orjson when it is installed). stream yields LLM_Token
+events and, when the response is complete, one LLM_Stats event (also kept in
+last_stats).
 '''
-import json, logging, asyncio
+import json, logging, asyncio, importlib.util
 from time import perf_counter
 
-from typing import Type, Any
+from typing import Type, Any, AsyncIterator, Union
 
 #import aiohttp
 #from langchain_openai import OpenAI
@@ -21,10 +33,35 @@ from typing import Type, Any
 #from openai import AsyncOpenAI
 import httpx
 
-from scripts.datatypes import Prompt_SUA
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+from scripts.datatypes import Prompt_SUA, LLM_Token, LLM_Stats
 
 logger = logging.getLogger(__name__)
 
+class NDJSON_Decoder():
+    '''incremental newline delimited json, feed it bytes as they arrive'''
+    def __init__(self):
+        self.buffer: bytes = b''
+
+    def feed(self, data: bytes) -> list[dict]:
+        if b'\n' not in data:
+            self.buffer += data
+            return []
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return [json_loads(line) for line in lines if line.strip()]
+
+    def flush(self) -> list[dict]:
+        '''a last line without the newline'''
+        line, self.buffer = self.buffer, b''
+        return [json_loads(line)] if line.strip() else []
+
 # servers that use the openai api
 servers_openai_api = ['openai', 'text-gen-webui'] 
 
@@ -46,11 +83,36 @@ class LLM_Interface():
         self.prompt_assistant: str = self.prompts['assistant']
         self.assistant_tokens: int = 0
 
-        self.llm: httpx.AsyncClient = httpx.AsyncClient(base_url=self.llm_uri)
+        self.connections: int = int(config.get('LLM_connections', 4))
+        self.http2: bool = bool(int(config.get('LLM_http2', 0)))
+        if self.http2 and (importlib.util.find_spec('h2') is None):
+            logger.info('LLM_http2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1')
+            self.http2 = False
+        self.timeout: float = float(config.get('LLM_timeout', 120))
+        self.client: httpx.AsyncClient = None
         #self.session: aiohttp.ClientSession = aiohttp.ClientSession()
         #self.session_last = 0.0
 
         self.stop_generation: float = False
+        self.last_stats: LLM_Stats = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        '''the shared client, made on first use (it has to be closed on the loop that used it)'''
+        if (self.client is None) or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                    base_url=self.llm_uri,
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=self.connections,
+                        max_keepalive_connections=self.connections,
+                        keepalive_expiry=300),
+                    timeout=httpx.Timeout(self.timeout, connect=5.0))
+        return self.client
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
 
     def spit_prompts(self):
         _ =self.prompts['system'].split('{system_prompt}')
@@ -122,6 +184,12 @@ class LLM_Interface():
         '''
         Get the number of tokens in a string. Set to 1 
         token prediction to avoid wasting resources.
+
+        prompt_eval_count leaves out the part of the prompt the server had cached
+        (and is not sent at all when nothing was evaluated), the count is taken from
+        context instead, the server's tokens of the whole prompt and the answer. The
+        template only passes the prompt through, context is not sent for raw requests.
+        Raises ValueError if the response has no context.
         '''
         request_data = self.get_request_data(
                     system_str='', 
@@ -129,15 +197,16 @@ class LLM_Interface():
                     stream=False, 
                     raw=False,
                     num_predict=1)
-        response = None
-        async with httpx.AsyncClient() as client:
-            r = await client.post(
-                    url=f'{self.llm_uri}/api/generate', 
-                    data=json.dumps(request_data))
-            response = json.loads(r.content)
-            await client.aclose()
-            await asyncio.sleep(0)
-        return response['prompt_eval_count']
+        request_data['raw'] = False
+        request_data['template'] = '{{ .Prompt }}'
+        r = await self.get_client().post(
+                url='/api/generate', 
+                content=json.dumps(request_data))
+        r.raise_for_status()
+        response = json_loads(r.content)
+        if not response.get('context'):
+            raise ValueError(f'no token count in the response: {r.content[:200]}')
+        return max(0, len(response['context']) - response.get('eval_count', 0))
         '''
         self.session_last = perf_counter()
 
@@ -165,6 +234,23 @@ class LLM_Interface():
             print(e, output_dict)
         return int(output_dict['prompt_eval_count'])
         '''
+    async def prefill(self, prompts: Prompt_SUA) -> int:
+        '''
+        evaluates the prompt and drops the 1 token answer. The server keeps it cached,
+        a later prompt that starts the same only evaluates the rest. Returns
+        prompt_eval_count.
+        '''
+        request_data = self.get_request_data(
+                system_str=prompts['system'], 
+                user_str=prompts['user'], 
+                stream=False,
+                num_predict=1)
+        r = await self.get_client().post(
+                url='/api/generate', 
+                content=json.dumps(request_data))
+        r.raise_for_status()
+        return json_loads(r.content).get('prompt_eval_count', 0)
+
     async def generate_factory(self, prompts: Prompt_SUA, output_class: Type[Any], 
                 raw: bool = True, temp: float = 0.7, format_json: bool = True) -> any:
         '''
@@ -177,29 +263,46 @@ class LLM_Interface():
                 raw=raw,
                 stream=False,
                 output_json = format_json)
-        output = ''
-        async with httpx.AsyncClient() as client:
-            r = await client.post(
-                    url=f'{self.llm_uri}/api/generate', 
-                    data = json.dumps(request_data))
-            output = r.content.decode('utf-8')
-            await client.aclose()
-            await asyncio.sleep(0)
+        r = await self.get_client().post(
+                url='/api/generate', 
+                content=json.dumps(request_data))
+        output = r.content.decode('utf-8')
         return output_class(output)
 
-    async def stream(self, prompts: Prompt_SUA, raw: bool = True):
+    async def stream(self, prompts: Prompt_SUA, raw: bool = True) -> AsyncIterator[Union[LLM_Token, LLM_Stats]]:
         '''
         Simple streaming client for the LLM API. It uses raw mode to override whatever the
         llm server is doing to the prompts
         '''
         request_data = self.get_request_data(system_str=prompts['system'], user_str=prompts['user'], raw=raw, stream=True)
-        async with httpx.AsyncClient() as client:
-            async with client.stream('POST', f"{self.llm_uri}/api/generate", json=request_data) as response:
-                async for chunk in response.aiter_bytes():
-                    obj = json.loads(chunk)
-                    yield obj['response']
-            await client.aclose()
-            await asyncio.sleep(0)
+        decoder = NDJSON_Decoder()
+        async with self.get_client().stream('POST', '/api/generate', json=request_data) as response:
+            async for chunk in response.aiter_bytes():
+                for obj in decoder.feed(chunk):
+                    event = self.stream_event(obj)
+                    if event is None:
+                        return
+                    yield event
+            for obj in decoder.flush():
+                event = self.stream_event(obj)
+                if event is not None:
+                    yield event
+
+    def stream_event(self, obj: dict) -> Union[LLM_Token, LLM_Stats, None]:
+        '''None on an error from the server'''
+        if 'error' in obj:
+            logger.info(f'LLM server error: {obj["error"]}')
+            return None
+        if not obj.get('done'):
+            return LLM_Token(type='token', text=obj.get('response', ''))
+        self.last_stats = LLM_Stats(type='stats',
+                prompt_eval_count=obj.get('prompt_eval_count', 0),
+                prompt_eval_duration=obj.get('prompt_eval_duration', 0),
+                eval_count=obj.get('eval_count', 0),
+                eval_duration=obj.get('eval_duration', 0),
+                load_duration=obj.get('load_duration', 0),
+                total_duration=obj.get('total_duration', 0))
+        return self.last_stats
     #async with self.llm.agenerate()
         
         '''aiohttp
@@ -59,11 +59,15 @@ Configuration - expected in the .env config
 '''
 import logging, asyncio
 from datetime import datetime
+from time import perf_counter
 from typing import DefaultDict, Union
 from collections import deque
 
+import httpx
+
 from scripts.datatypes import Discord_Message, Speaking_Interrupt, Binary_Reasoning, Prompt_SUA
 from scripts.LLM_interface import LLM_Interface
+from scripts.token_counter import Token_Counter
 from scripts.LLM_prompts import LLM_Prompts, Bot_User_Info
 from scripts.utils import strip_non_alphanum
 
@@ -95,7 +99,17 @@ class Bot_LLM():
         self.bot_id: int = bot_id
         self.bot_name: str = bot_name
 
-        self.message_history_privacy: int = config['LLM_message_history_privacy']
+        self.message_history_privacy: int = int(config['LLM_message_history_privacy'])
+
+        # 'append' keeps the prompt prefix byte identical between turns so the server
+        # reuses its cache of it, 'relative' is the old "2 minutes" layout
+        self.prompt_layout: str = config.get('LLM_prompt_layout', 'append')
+        # append layout, by prompt type the oldest message id still in the history
+        self.history_start: dict[str, int] = {}
+        # user_ids, listener_ids, listener_names, bot_info, streaming_type of the last wmh prompt
+        self.prefill_context: tuple = None
+        self.prefill_count: int = 0
+        self.prefill_tokens: int = 0
 
         self.voice_model: str = 'en_GB-vctk-medium'
         self.voice_number: int = 8
@@ -105,9 +119,49 @@ class Bot_LLM():
         self.tokens_thoughts = self.tokens_chat // 3
         self.tokens_thoughts_response = self.tokens_chat_response // 2
 
-        self.stop_generation: bool = False
+        # latched by interrupt_generation, cleared by wmh_stream_sentences once it has stopped
+        self.stop_generation: asyncio.Event = asyncio.Event()
+        # bot message being streamed, its sentences are still growing
+        self.response_in_progress: Discord_Message = None
+        # interrupt of response_in_progress, applied once streaming has ended
+        self.pending_interrupt: Speaking_Interrupt = None
 
         self.get_token_queue = deque()
+        self.token_counter = Token_Counter(llm=self.llm,
+                cache_file=config.get('LLM_token_cache', './token_counts.json') or None)
+
+    def message_line(self, message: Discord_Message, cur_time: datetime = None) -> str:
+        '''a message as it is in the prompts'''
+        if self.prompt_layout == 'append':
+            return self.prompts.gen_message_output(message, absolute=True)
+        return self.prompts.gen_message_output(message, cur_time)
+
+    def message_tokens_text(self, message: Discord_Message) -> str:
+        '''the message as it is counted, relative time from the message itself so the text does not change'''
+        if (self.prompt_layout == 'append') or (message.timestamp is None):
+            return self.prompts.gen_message_output(message, absolute=True)
+        return self.prompts.gen_message_output(message, message.timestamp)
+
+    def message_tokens(self, message: Discord_Message) -> int:
+        '''
+        message.tokens, the cached count or an estimate until the token counter
+        got to the message (queued for it)
+        '''
+        if message.tokens is None:
+            text = self.message_tokens_text(message)
+            message.tokens = self.token_counter.get(text)
+            if message.tokens is None:
+                if message not in self.get_token_queue:
+                    self.get_token_queue.append(message)
+                return len(text) // 4
+        return message.tokens
+
+    async def count_queued_tokens(self) -> int:
+        '''counts a batch from get_token_queue, the new counts are saved to disk'''
+        counted = await self.token_counter.drain(self.get_token_queue, self.message_tokens_text)
+        if counted:
+            await asyncio.to_thread(self.token_counter.save)
+        return counted
 
     def get_ctr_prompts(self, 
                     disc_messages: list[Discord_Message],
@@ -128,19 +182,16 @@ class Bot_LLM():
                 listener_ids.add(id)
             for name in message.listener_names:
                 listener_names.add(name)
-            new_messages += self.prompts.gen_message_output(message, cur_time)
-            if message.tokens:
-                available_tokens -= message.tokens
-            else:
-                available_tokens -= len(new_messages[-1]) // 4
-                self.get_token_queue.append(message)
+            new_messages += self.message_line(message, cur_time) + '\n'
+            available_tokens -= self.message_tokens(message)
 
         history = self.get_message_history(
                 user_ids=user_ids,
                 listener_ids=listener_ids,
                 max_tokens=available_tokens,
                 cur_time=cur_time,
-                prompted=False)
+                prompted=False,
+                window='CTR')
 
         ctr_str = self.prompts.gen_prompt_ctr(
                     bot_info=self.prompts.bot_info,
@@ -181,8 +232,7 @@ class Bot_LLM():
 
         for message in messages:
             if message.tokens is None:
-                if not message in self.get_token_queue:
-                    self.get_token_queue.append(message)
+                self.message_tokens(message)
             if not message.user_id in self.message_listened_to.keys():
                 self.message_listened_to[message.user_id] = set()
             if prepend:
@@ -200,30 +250,66 @@ class Bot_LLM():
         self.message_id_high = max_key
         self.message_id_low = min_key
 
-    def interupt_sentences(self, interrupt: Speaking_Interrupt) -> Discord_Message:
+    def interrupt_generation(self) -> bool:
         '''
-        insert '(member_name)~~' into the sentences list before the first sentence 
-        that was interrupted and append '~~' to the end of the list. Join the sentences
-        and replace the message.text with the joined sentences and dispatch an
-        interrupted message event.
+        stops the response being generated, the stop stays set until 
+        wmh_stream_sentences has stopped. Returns False if nothing is generating.
         '''
-        message = self.message_store[self.last_bot_message]
+        if self.response_in_progress is None:
+            return False
+        self.stop_generation.set()
+        return True
 
-        if interrupt.num_sentences == None:
-            logger.info('ValueError: num_sentences cannot be less than 1')
+    def interupt_sentences(self, interrupt: Speaking_Interrupt) -> Discord_Message:
+        '''
+        insert '(member_name)~~' into the sentences list where the users cut the
+        bot off and append '~~' to the end of the list. The audio playback reports
+        how many sentences were played in full and how much of the next one, that
+        sentence is split after the last word heard (by its share of the audio).
+        Join the sentences and replace the message.text with the joined sentences.
+
+        A message that is still streaming is left alone (the queued TTS sentences
+        index into its sentences), the interrupt is kept in pending_interrupt for
+        apply_pending_interrupt. Returns None then.
+        '''
+        message = interrupt.get('disc_message') or self.message_store.get(self.last_bot_message)
+        if message is None:
+            logger.info('ValueError: no message to interrupt')
+            return
+        if message is self.response_in_progress:
+            self.pending_interrupt = interrupt
             return
-        elif interrupt.num_sentences > len(message.sentences):
-            logger.info('ValuteError: num_sentences is greater than the number of sentences in the last message')
+        sentences_heard = interrupt.get('sentences_heard')
+        if sentences_heard == None:
+            # older event without playback position, only the unplayed count is known
+            sentences_heard = len(message.sentences) - interrupt['num_sentences']
+        if not (0 <= sentences_heard <= len(message.sentences)):
+            logger.info('ValueError: sentences_heard is outside of the sentences in the message')
             return
 
-        message.sentences.insert(len(message.sentences) - (interrupt.num_sentences), 
-                ('(' + ', '.join(member_name.capitalize() for member_name in interrupt.member_names) + ')~~'))
-        message.sentences.append('~~')
+        heard = message.sentences[:sentences_heard]
+        not_heard = message.sentences[sentences_heard:]
+        if not_heard and interrupt.get('partial_fraction'):
+            words = not_heard[0].split()
+            num_words = int(len(words) * interrupt['partial_fraction'])
+            if num_words:
+                heard.append(' '.join(words[:num_words]))
+                not_heard[0] = ' '.join(words[num_words:])
 
         message.text_user_interrupt = message.text
-
+        message.sentences = heard + ['(' + interrupt['user_name'].capitalize() + ')~~'] + not_heard + ['~~']
         message.text = ' '.join(message.sentences)
-        return self.message_store[self.last_bot_message]
+        message.tokens = None # counted again with the interrupt
+        return message
+
+    def apply_pending_interrupt(self, message: Discord_Message) -> Discord_Message:
+        '''interrupt that came in while message was streaming, call once it has ended'''
+        interrupt = self.pending_interrupt
+        self.pending_interrupt = None
+        if interrupt is None:
+            return message
+        interrupt['disc_message'] = message
+        return self.interupt_sentences(interrupt) or message
 
     def _get_message_history_keys(self, 
                     user_ids: set[int], 
@@ -243,16 +329,18 @@ class Bot_LLM():
         if self.message_history_privacy == 0:
             keyset.update(self.message_store.keys())
         elif self.message_history_privacy == 1:
-            keyset |= {element for id in listener_ids for element in self.message_listened_to[id]}
+            keyset |= {element for id in listener_ids for element in self.message_listened_to.get(id, ())}
         elif self.message_history_privacy == 2:
-            keyset &= {element for id in listener_ids for element in self.message_listened_to[id]}
+            if listener_ids:
+                keyset |= set.intersection(*(self.message_listened_to.get(id, set()) for id in listener_ids))
         elif self.message_history_privacy == 3:
             keyset |= {element for id in user_ids for element in self.message_listened_to[id]}
         elif self.message_history_privacy == 4:
-            keyset &= {element for id in user_ids for element in self.message_listened_to[id]}
+            if user_ids:
+                keyset |= set.intersection(*(self.message_listened_to[id] for id in user_ids))
 
         if ignore_keys != None:
-            keyset - ignore_keys
+            keyset -= ignore_keys
         
         # remove bot keys as they are listeners to everything and break privacy
         #keyset.remove(self.bot_id)
@@ -268,10 +356,15 @@ class Bot_LLM():
                 max_tokens: int, 
                 cur_time: datetime = None, 
                 prompted:bool = False,
-                ignore_messages: set[int] = None) -> str:
-
+                ignore_messages: set[int] = None,
+                window: str = 'CHAT') -> str:
+        '''
+        window - the prompt the history is for, the append layout keeps a history per prompt
+        '''
         keylist = self._get_message_history_keys(user_ids, 
                     listener_ids, ignore_messages)
+        if self.prompt_layout == 'append':
+            return self.get_append_history(keylist, max_tokens, window)
         
         member_history = []
         tokens = 0
@@ -281,12 +374,8 @@ class Bot_LLM():
 
         for message_id in keylist:
             message = self.message_store[message_id]
-            output_str = self.prompts.gen_user_prompt(message, cur_time, prompted=prompted)
-            if message.tokens == None:
-                self.get_token_queue(Discord_Message)
-                tokens += (message.prompt_end + message.prompt_end) // 4
-            else:
-                tokens += message.tokens
+            output_str = self.message_line(message, cur_time)
+            tokens += self.message_tokens(message)
             if tokens > max_tokens:
                 break
             member_history.append(output_str)
@@ -295,6 +384,26 @@ class Bot_LLM():
         output_str = '\n'.join(member_history) + '\n'
         
         return output_str
+
+    def get_append_history(self, keylist: list[int], max_tokens: int, window: str) -> str:
+        '''
+        history that only grows at the end, the server's prompt cache covers
+        everything up to the new messages. When it no longer fits, the oldest
+        messages are dropped down to half of max_tokens at once, so the prefix
+        changes once every few turns instead of every turn.
+        '''
+        start = self.history_start.get(window)
+        keylist = sorted(key for key in keylist if (start is None) or (key >= start))
+        tokens = [self.message_tokens(self.message_store[key]) for key in keylist]
+        total = sum(tokens)
+        if total > max_tokens:
+            drop = 0
+            while (drop < len(keylist)) and (total > max_tokens // 2):
+                total -= tokens[drop]
+                drop += 1
+            keylist = keylist[drop:]
+            self.history_start[window] = keylist[0] if keylist else self.message_id_high + 1
+        return ''.join(self.message_line(self.message_store[key]) + '\n' for key in keylist)
         
     def process_sentences(self, sentence: str, previous_sentences: list[str]) -> str:
         '''
@@ -363,8 +472,6 @@ class Bot_LLM():
                 raise TypeError("Messages must be a list of Discord_Message objects or a single Discord_Message object")
 
         cur_time = datetime.now()
-        avaible_tokens = self.tokens_chat - self.tokens_chat_response
-        avaible_tokens -= bot_info.get_tokens(streaming_type) - self.llm.assistant_tokens
         new_messages = ""
         user_ids = set()
 
@@ -373,15 +480,22 @@ class Bot_LLM():
                 response.listener_ids.update(message.listener_ids)
                 response.listener_names.update(message.listener_names)
                 #self.store_message(message)
-                new_messages += self.prompts.gen_message_output(message, cur_time) + '\n'
-
-        system_prompt = self.prompts.gen_prompt_chat(bot_info=bot_info, listeners=response.listener_names)
-
-        user_prompt = (self.get_message_history(
-                listener_ids = response.listener_ids,
-                user_ids=user_ids,
-                max_tokens=avaible_tokens, 
-                cur_time=cur_time, prompted=False)) + '\n' + new_messages
+                new_messages += self.message_line(message, cur_time) + '\n'
+
+        # the next turn is likely in the same company, see prefill_next_prompt
+        self.prefill_context = (user_ids, set(response.listener_ids), set(response.listener_names),
+                bot_info, streaming_type)
+        system_prompt, user_prompt = self.get_wmh_prefix(user_ids=user_ids,
+                listener_ids=response.listener_ids,
+                listener_names=response.listener_names,
+                bot_info=bot_info,
+                streaming_type=streaming_type,
+                cur_time=cur_time)
+        if self.prompt_layout == 'append':
+            # the new messages are the next turn's history, no separator that would not be there
+            user_prompt += new_messages
+        else:
+            user_prompt += '\n' + new_messages
         
         prompts = Prompt_SUA({
                 'system': system_prompt,
@@ -394,6 +508,55 @@ class Bot_LLM():
 
         return prompts
     
+    def get_wmh_prefix(self,
+                user_ids: set[int],
+                listener_ids: set[int],
+                listener_names: set[str],
+                bot_info: Bot_User_Info,
+                streaming_type: str = 'CHAT',
+                cur_time: datetime = None) -> tuple[str, str]:
+        '''the system prompt and the message history of a wmh prompt'''
+        avaible_tokens = self.tokens_chat - self.tokens_chat_response
+        avaible_tokens -= bot_info.get_tokens(streaming_type) - self.llm.assistant_tokens
+
+        system_prompt = self.prompts.gen_prompt_chat(bot_info=bot_info, listeners=listener_names)
+
+        history = self.get_message_history(
+                listener_ids = listener_ids,
+                user_ids=user_ids,
+                max_tokens=avaible_tokens, 
+                cur_time=cur_time, prompted=False, window=streaming_type)
+        return system_prompt, history
+
+    def prefill_key(self) -> tuple:
+        '''changes when the next prompt's prefix may have changed'''
+        return (self.message_id_high, self.message_id_low, id(self.prefill_context))
+
+    async def prefill_next_prompt(self) -> Union[int, None]:
+        '''
+        sends the next wmh prompt up to where its new messages will go (append layout)
+        so the server has it cached, the answer is 1 token and thrown away. Uses the
+        company of the last turn. Returns the tokens evaluated, None if nothing was sent.
+        '''
+        if (self.prompt_layout != 'append') or (self.prefill_context is None):
+            return None
+        user_ids, listener_ids, listener_names, bot_info, streaming_type = self.prefill_context
+        system_prompt, history = self.get_wmh_prefix(user_ids=user_ids,
+                listener_ids=listener_ids,
+                listener_names=listener_names,
+                bot_info=bot_info,
+                streaming_type=streaming_type)
+        start = perf_counter()
+        try:
+            tokens = await self.llm.prefill(Prompt_SUA({'system': system_prompt, 'user': history}))
+        except (httpx.HTTPError, ValueError) as e:
+            logger.info(f'LLM prefill failed: {e}')
+            return None
+        self.prefill_count += 1
+        self.prefill_tokens += tokens
+        logger.debug(f'LLM prefill {tokens} tokens in {(perf_counter() - start) * 1000:.0f}ms')
+        return tokens
+
     async def wmh_stream_sentences(self, 
                 messages: list[Discord_Message],
                 bot_response_mesg: Discord_Message, 
@@ -401,6 +564,7 @@ class Bot_LLM():
                 display_history: bool = False,
                 streaming_type:str = 'CHAT'):
 
+        self.response_in_progress = bot_response_mesg
         prompts = self.get_wmh_prompts(messages = messages, 
                         response=bot_response_mesg,
                         bot_info=bot_info,
@@ -408,20 +572,26 @@ class Bot_LLM():
                         streaming_type=streaming_type)
 
         await asyncio.sleep(0)
-        if self.llm.stop_generation:
-            self.llm.stop_generation = False
+        if self.stop_generation.is_set():
+            self.stop_generation.clear()
+            self.response_in_progress = None
             return
 
+        # closed in finally, a break would leave the response holding a connection
+        chunks = self.llm.stream(prompts=prompts)
         try:
             sentence_seperators = ['.', '?', '\n', '!']        
             sentence:str = ''
-            async for chunk_undecoded in self.llm.stream(prompts=prompts):
+            async for event in chunks:
                 #chunk = self.process_chunk(chunk)
-                if self.llm.stop_generation == True:
-                    await asyncio.sleep(0)
-                    self.llm.stop_generation = False
+                if self.stop_generation.is_set():
                     break
-                chunk = chunk_undecoded#= self.decode_chunk(chunk_undecoded)
+                if event['type'] == 'stats':
+                    logger.debug(f'LLM prompt {event["prompt_eval_count"]} tokens in '
+                            f'{event["prompt_eval_duration"] / 1e6:.0f}ms, response {event["eval_count"]} tokens in '
+                            f'{event["eval_duration"] / 1e6:.0f}ms, total {event["total_duration"] / 1e6:.0f}ms')
+                    continue
+                chunk = event['text']
                 if chunk not in sentence_seperators:
                     sentence += chunk
                 else:
@@ -437,6 +607,9 @@ class Bot_LLM():
                                 yield sentence
                     sentence = ''
         finally:
+            await chunks.aclose()
+            self.stop_generation.clear()
+            self.response_in_progress = None
             #update time
             cur_time = datetime.now()
             bot_response_mesg.text = ' '.join(bot_response_mesg.sentences)
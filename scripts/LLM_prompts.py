@@ -23,6 +23,9 @@ class LLM_Prompts():
 
         self.bot_info = Bot_User_Info(name=bot_name, personality=self.personality)
 
+        # absolute time of a message, to the minute so the line never changes (see Bot_LLM.prompt_layout)
+        self.timestamp_format: str = '%Y-%m-%d %H:%M'
+
     def gen_prompt_chat(self, bot_info: Bot_User_Info, listeners: set[str]):
         """Generate the prompt for chat mode. Stores it so it doesn't have to be generated every time."""
         if 'CHAT' not in bot_info.prompts:
@@ -33,7 +36,7 @@ class LLM_Prompts():
             bot_info.prompts['CHAT'] = {}
             bot_info.prompts['CHAT']['begin'] = _[0]
             bot_info.prompts['CHAT']['end'] = _[1]
-        output =  f"{bot_info.prompts['CHAT']['begin']} {len(listeners)} members, {', '.join(listeners)} "
+        output =  f"{bot_info.prompts['CHAT']['begin']} {len(listeners)} members, {', '.join(sorted(listeners))} "
         output = f"{output}{bot_info.prompts['CHAT']['end']}"
         return output
 
@@ -50,14 +53,19 @@ class LLM_Prompts():
             bot_info.prompts['CTR']['middle'] = _[0]
             bot_info.prompts['CTR']['end'] = _[1]
 
-        output = f"{bot_info.prompts['CTR']['begin']} {len(listeners)} members, {', '.join(listeners)} "
+        output = f"{bot_info.prompts['CTR']['begin']} {len(listeners)} members, {', '.join(sorted(listeners))} "
         output += f"{bot_info.prompts['CTR']['middle']}{history}{bot_info.prompts['CTR']['end']}"
         return output
 
-    def gen_message_output(self, message: Discord_Message, cur_time = None) -> str:
+    def gen_message_output(self, message: Discord_Message, cur_time = None, absolute: bool = False) -> str:
         """
-        Generates the message output to use in its response.
+        Generates the message output to use in its response. The time is how long ago
+        the message was, or with absolute when it was.
         """
+        if absolute:
+            if message.timestamp is None:
+                return f'{message.user_name} : {message.text}'
+            return f'{message.user_name} : {message.timestamp.strftime(self.timestamp_format)} : {message.text}'
         time_str = self.return_time_since_last_message(cur_time=cur_time, message_time=message.timestamp)
         return f'{message.user_name} : {time_str} : {message.text}'
 
@@ -1,56 +1,251 @@
 '''
 Handles STT via wyoming faster whisper (part of the home assistant / rhasspy project).
 Yes, the wyomining protocol is not well documented but it works.
+
+transcribe - sends a finished utterance and waits for the text, on a connection
+    borrowed from a Wyoming_Pool (STT cog) so no turn waits for a connect. The audio 
+    is framed by audio_chunks (memoryview slices, STT_chunk_ms each) and written
+    through a Batched_Writer, so the socket is not drained after every chunk
+STT_Stream - opens the session on the first packet and streams audio while 
+    the user is still talking (STT_streaming=1), on a connection borrowed from
+    the same pools for as long as the user talks
+
+Whisper works on 16khz mono, with STT_resample=1 the Discord audio is converted
+before it is sent (1/6 of the bytes on the socket).
 '''
-import array, logging
+import logging, asyncio
 
-from typing import Union 
+from typing import Union, Iterator, Iterable
+from concurrent.futures import Future as CFuture
 
 import wyoming.mic as wyMic
 import wyoming.asr as wyAsr
 import wyoming.audio as wyAudio
 import wyoming.client as wyClient
+from wyoming.event import async_write_event
+
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.wyoming_pool import Wyoming_Pool
 
 logger = logging.getLogger(__name__)
 
-async def transcribe(
-        audio_data: array.array, 
-        host: str, 
-        port: int, input_rate: int, 
-        input_channels: int, 
-        input_width: int) -> Union[str, None]:
-    timestamp: int = 0
-    my_audio_chunks:list[wyAudio.AudioChunk] = []
-    start = 0
-
-    # wyoming protocol data list (home assistant voice)
-    while len(audio_data) > start:
-        payload_size = 1000
-        end = start +  payload_size
-        audio_segment = audio_data[start:end]
-        my_audio_chunks.append(wyAudio.AudioChunk(
+# whisper's native format
+stt_rate = 16000
+stt_channels = 1
+stt_width = 2
+
+def audio_chunks(
+        audio_data: memoryview,
+        input_rate: int,
+        input_channels: int,
+        input_width: int,
+        chunk_ms: int = 100) -> Iterator[wyAudio.AudioChunk]:
+    '''
+    frames the utterance for wyoming, chunk_ms of audio per AudioChunk. The chunks
+    are memoryview slices of audio_data (no copies) and are made as they are sent.
+    '''
+    audio_data = memoryview(audio_data).cast('B')
+    frame_bytes = input_channels * input_width
+    chunk_bytes = max(1, input_rate * chunk_ms // 1000) * frame_bytes
+    for start in range(0, len(audio_data), chunk_bytes):
+        yield wyAudio.AudioChunk(
             rate = input_rate,
             width = input_width,
             channels= input_channels,
-            audio=audio_segment.tobytes(),
-            timestamp=timestamp            
-            ))
-        timestamp += my_audio_chunks[-1].timestamp + int(
-            len(my_audio_chunks[-1].audio) / (input_channels * input_width * input_rate)  * 1000)
-        start = end
+            audio=audio_data[start:start + chunk_bytes],
+            timestamp=(start // frame_bytes) * 1000 // input_rate)
 
-    #wyoming tranmission start
-    my_client = wyClient.AsyncTcpClient(host=host, 
-                                        port=port)
-    await my_client.connect()
-    await my_client.write_event(wyAsr.Transcribe().event())
-    await my_client.write_event(wyAudio.AudioStart(
+class Batched_Writer():
+    '''
+    StreamWriter stand-in for wyoming's async_write_event, which drains after every
+    event. Writes go to the socket buffer as they come, drain only waits once 
+    flush_bytes are pending, flush waits for the rest.
+    '''
+    def __init__(self, writer: asyncio.StreamWriter, flush_bytes: int = 1 << 16):
+        self.writer = writer
+        self.flush_bytes = flush_bytes
+        self.pending: int = 0
+
+    def write(self, data: bytes | memoryview) -> None:
+        self.pending += len(data)
+        self.writer.write(data)
+
+    def writelines(self, data: Iterable[bytes]) -> None:
+        for item in data:
+            self.write(item)
+
+    async def drain(self) -> None:
+        if self.pending >= self.flush_bytes:
+            await self.flush()
+
+    async def flush(self) -> None:
+        self.pending = 0
+        await self.writer.drain()
+
+async def _send_utterance(my_client: wyClient.AsyncTcpClient,
+        audio_data: memoryview,
+        input_rate: int,
+        input_channels: int,
+        input_width: int,
+        chunk_ms: int) -> str:
+    writer = Batched_Writer(my_client._writer)
+    await async_write_event(wyAsr.Transcribe().event(), writer)
+    await async_write_event(wyAudio.AudioStart(
         rate=input_rate, 
         width=input_width, 
-        channels=input_channels).event())        
-    for item in my_audio_chunks:
-        await my_client.write_event(item.event())
-    await my_client.write_event(wyAudio.AudioStop().event())        
-    response = await my_client.read_event()
-    
-    return response.data['text']
+        channels=input_channels).event(), writer)
+    for item in audio_chunks(audio_data, input_rate, input_channels, input_width, chunk_ms):
+        await async_write_event(item.event(), writer)
+    await async_write_event(wyAudio.AudioStop().event(), writer)
+    await writer.flush()
+    event = await my_client.read_event()
+    while (event is not None) and (not wyAsr.Transcript.is_type(event.type)):
+        event = await my_client.read_event()
+    if event is None:
+        raise ConnectionResetError('STT server closed the connection before the transcript')
+    return event.data['text']
+
+async def transcribe(
+        audio_data: memoryview, 
+        host: str, 
+        port: int, input_rate: int, 
+        input_channels: int, 
+        input_width: int,
+        pool: Wyoming_Pool = None,
+        chunk_ms: int = 100) -> Union[str, None]:
+    '''
+    with a pool the request runs on one of its open connections, retried once 
+    on a new one if the server had closed it. Without, a connection is opened
+    and closed for this utterance.
+    chunk_ms - audio per AudioChunk event
+    '''
+    #wyoming tranmission start
+    if pool is None:
+        my_client = wyClient.AsyncTcpClient(host=host, port=port)
+        await my_client.connect()
+        try:
+            return await _send_utterance(my_client, audio_data, input_rate, input_channels, input_width, chunk_ms)
+        finally:
+            await my_client.disconnect()
+
+    try:
+        async with pool.connection() as my_client:
+            return await _send_utterance(my_client, audio_data, input_rate, input_channels, input_width, chunk_ms)
+    except OSError as e:
+        logger.info(f'STT request failed on a pooled connection, retrying: {e}')
+    async with pool.connection() as my_client:
+        return await _send_utterance(my_client, audio_data, input_rate, input_channels, input_width, chunk_ms)
+
+class STT_Stream():
+    '''
+    Streaming transcription session. The connection is opened as soon as the
+    speaker starts talking and audio is forwarded while they are still speaking, 
+    so only AudioStop is left to send at end of speech and the wait for the 
+    transcript no longer grows with the length of the utterance.
+
+    feed, finish and cancel are safe to call from the voice_recv thread, the
+    session itself runs on the bot loop. Chunks that queue up while a write
+    is in flight are joined and sent as a single AudioChunk.
+
+    If a resampler is passed (one per stream, it keeps state between chunks), 
+    the chunks are converted to 16khz mono in a worker thread before sending.
+
+    With a pool the session runs on one of its warm connections and counts
+    against its max_connections, without one a connection to host:port is 
+    opened for the stream.
+    '''
+    def __init__(self,
+            host: str,
+            port: int,
+            input_rate: int,
+            input_channels: int,
+            input_width: int,
+            loop: asyncio.AbstractEventLoop,
+            resampler: Polyphase_Resampler = None,
+            pool: Wyoming_Pool = None):
+        self.pool = pool
+        self.host = pool.host if pool else host
+        self.port = pool.port if pool else int(port)
+        self.resampler = resampler
+        if resampler:
+            self.input_rate, self.input_channels, self.input_width = stt_rate, stt_channels, stt_width
+        else:
+            self.input_rate = input_rate
+            self.input_channels = input_channels
+            self.input_width = input_width
+        self.loop = loop
+
+        self._queue: asyncio.Queue[Union[bytes, None]] = asyncio.Queue()
+        self._cancelled: bool = False
+        self._future: CFuture[Union[str, None]] = asyncio.run_coroutine_threadsafe(self._run(), loop)
+
+    def feed(self, audio: bytes) -> None:
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, audio)
+
+    def finish(self) -> None:
+        '''end of speech, sends AudioStop once the queued audio is written'''
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    def cancel(self) -> None:
+        '''utterance discarded, close the connection without transcribing'''
+        self._cancelled = True
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def transcript(self) -> Union[str, None]:
+        return await asyncio.wrap_future(self._future)
+
+    async def _run(self) -> Union[str, None]:
+        if self.pool is None:
+            my_client = wyClient.AsyncTcpClient(host=self.host, port=self.port)
+            await my_client.connect()
+            try:
+                return await self._stream(my_client)
+            finally:
+                await my_client.disconnect()
+
+        async with self.pool.connection() as my_client:
+            return await self._stream(my_client)
+
+    async def _stream(self, my_client: wyClient.AsyncTcpClient) -> Union[str, None]:
+        timestamp: int = 0
+        bytes_per_ms = self.input_rate * self.input_channels * self.input_width / 1000
+
+        await my_client.write_event(wyAsr.Transcribe().event())
+        await my_client.write_event(wyAudio.AudioStart(
+            rate=self.input_rate, 
+            width=self.input_width, 
+            channels=self.input_channels).event())
+
+        while True:
+            chunks = [await self._queue.get()]
+            while not self._queue.empty() and chunks[-1] is not None:
+                chunks.append(self._queue.get_nowait())
+            done = chunks[-1] is None
+            if done:
+                chunks.pop()
+            if self._cancelled:
+                # the session is half way, the connection can not go back to the pool
+                await my_client.disconnect()
+                return None
+            if chunks:
+                audio = b''.join(chunks)
+                if self.resampler:
+                    audio = await asyncio.to_thread(self.resampler.process, audio)
+                await my_client.write_event(wyAudio.AudioChunk(
+                    rate=self.input_rate,
+                    width=self.input_width,
+                    channels=self.input_channels,
+                    audio=audio,
+                    timestamp=timestamp).event())
+                timestamp += int(len(audio) / bytes_per_ms)
+            if done:
+                break
+
+        await my_client.write_event(wyAudio.AudioStop().event())
+        event = await my_client.read_event()
+        while (event is not None) and (not wyAsr.Transcript.is_type(event.type)):
+            event = await my_client.read_event()
+        if event is None:
+            logger.info(f'STT stream closed by {self.host}:{self.port} before the transcript')
+            return None
+        return event.data['text']
@@ -2,14 +2,24 @@
 TTS Script that fetches audio from piper using the wyoming protocol
 
 The TTS_Audio dict contains the audio data and the audio details. 
+
+request_TTS takes a Wyoming_Pool so every sentence does not pay for a new
+connection, wyoming-piper keeps the connection open after each sentence.
+
+stream_TTS yields the audio chunks as they arrive, so playback can start on
+Piper's first chunk instead of waiting for the whole sentence.
 '''
 
 import logging, array
 
+from typing import AsyncIterator
+
 import wyoming.client as wyClient
 import wyoming.tts as wyTTS
+import wyoming.audio as wyAudio
 
 from scripts.datatypes import TTS_Audio
+from scripts.wyoming_pool import Wyoming_Pool
 
 logger = logging.getLogger(__name__)
 '''
@@ -19,29 +29,74 @@ class Piper():
         self.piper_port:int = None
         self.audio_data = array.array('h')
 '''
+async def _read_chunks(client: wyClient.AsyncTcpClient) -> AsyncIterator[TTS_Audio]:
+    # the format comes with audio-start, it depends on the voice model
+    audio_format = TTS_Audio(audio=b'', rate=22050, width=2, channels=1)
+    event = await client.read_event()
+    while (event is not None) and (event.type != 'audio-stop'):
+        if wyAudio.AudioStart.is_type(event.type):
+            start = wyAudio.AudioStart.from_event(event)
+            audio_format.update(rate=start.rate, width=start.width, channels=start.channels)
+        elif event.type == 'audio-chunk':
+            yield TTS_Audio(audio_format, audio=event.payload)
+        event = await client.read_event()
+    if event is None:
+        raise ConnectionResetError('TTS server closed the connection during synthesis')
+
+async def stream_TTS(text: str, 
+            voice: wyTTS.SynthesizeVoice,
+            host: str = None,
+            port: int = None,
+            pool: Wyoming_Pool = None,
+            ) -> AsyncIterator[TTS_Audio]:
+    '''
+    yields the audio of a sentence chunk by chunk as piper sends it, each with
+    the format from audio-start. With a pool
+    the request runs on one of its open connections (piper keeps them open), a 
+    request that fails on a reused connection before any audio came back is 
+    retried once on a new one
+    '''
+    synthesize = wyTTS.Synthesize(text=text, voice=voice).event()
+    if pool is None:
+        my_client = wyClient.AsyncTcpClient(host=host, port=port)
+        await my_client.connect()
+        try:
+            await my_client.write_event(synthesize)
+            async for chunk in _read_chunks(my_client):
+                yield chunk
+        finally:
+            await my_client.disconnect()
+        return
+
+    received = False
+    for attempt in range(2):
+        try:
+            async with pool.connection() as my_client:
+                await my_client.write_event(synthesize)
+                async for chunk in _read_chunks(my_client):
+                    received = True
+                    yield chunk
+            return
+        except OSError as e:
+            if received or attempt:
+                raise
+            logger.info(f'TTS request failed on a pooled connection, retrying: {e}')
+
 async def request_TTS(text: str, 
             voice: wyTTS.SynthesizeVoice,
             host: str = None,
             port: int = None,
+            pool: Wyoming_Pool = None,
             ) -> TTS_Audio:
+    '''the whole sentence at once, see stream_TTS'''
+    return await collect_TTS(stream_TTS(text=text, voice=voice, host=host, port=port, pool=pool))
 
+async def collect_TTS(chunks: AsyncIterator[TTS_Audio]) -> TTS_Audio:
+    '''joins streamed chunks into one TTS_Audio'''
     audio_data = array.array('h')
-
-    my_client = wyClient.AsyncTcpClient(host=host, port=port)
-    await my_client.connect()
-    await my_client.write_event(wyTTS.Synthesize(text=text, voice=voice).event())
-
-    event = await my_client.read_event()
-    while event.type != 'audio-stop':
-        if event.type == 'audio-chunk':
-            audio_data.frombytes(event.payload)
-        event = await my_client.read_event()
-    
-    ouput = TTS_Audio({
-        'audio': audio_data,
-        'rate': 22050,
-        'channels': 1,
-        'width': 2,
-        })
+    ouput = TTS_Audio(audio=audio_data, rate=22050, width=2, channels=1)
+    async for chunk in chunks:
+        audio_data.frombytes(chunk['audio'])
+        ouput.update(rate=chunk['rate'], width=chunk['width'], channels=chunk['channels'])
     
     return ouput
\ No newline at end of file
@@ -0,0 +1,143 @@
+'''
+Fixed capacity PCM buffers for the voice receive sink.
+
+Each speaker gets one PCM_Ring_Buffer that is allocated once when the speaker
+is first heard. Utterances are written one after another into the buffer, so
+no audio is copied or reallocated while someone is talking.
+
+The buffer is twice the size of the longest allowed utterance. When an
+utterance would run off the end of the buffer, it is moved to the front
+(at most once per wrap). finish copies the utterance once when it is handed
+to STT: the queued audio may wait behind other speakers while this speaker's
+next utterances wrap over the same part of the buffer.
+
+Frame_Queue hands the frames from the voice_recv thread to the event loop.
+'''
+import logging
+from collections import deque
+from typing import Any, Iterator
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class PCM_Ring_Buffer():
+    def __init__(self, max_utterance_bytes: int, frame_bytes: int = 4):
+        '''
+        max_utterance_bytes - longest utterance kept, anything past that is dropped
+        frame_bytes - bytes per sample frame (all channels), writes are kept aligned to it
+        '''
+        self.frame_bytes: int = frame_bytes
+        self.max_utterance_bytes: int = max_utterance_bytes - (max_utterance_bytes % frame_bytes)
+        self.capacity: int = 2 * self.max_utterance_bytes
+
+        self._buffer: np.ndarray = np.zeros(self.capacity, dtype=np.uint8)
+        self._view: memoryview = memoryview(self._buffer)
+        self._start: int = 0
+        self._end: int = 0
+        self.dropped_bytes: int = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def start_utterance(self) -> None:
+        '''begins a new utterance right after the previous one'''
+        self._start = self._end
+        self.dropped_bytes = 0
+
+    def _reserve(self, size: int) -> int:
+        '''
+        returns the number of bytes that can be written contiguously at self._end,
+        moving the current utterance to the front of the buffer if needed
+        '''
+        available = self.max_utterance_bytes - len(self)
+        if size > available:
+            self.dropped_bytes += size - available
+            size = available - (available % self.frame_bytes)
+        if size <= 0:
+            return 0
+        if self._end + size > self.capacity:
+            length = len(self)
+            # start > capacity / 2 >= length here, so the regions never overlap
+            self._buffer[:length] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, length
+        return size
+
+    def write(self, pcm: bytes) -> int:
+        '''copies pcm into the buffer, returns the number of bytes stored'''
+        size = self._reserve(len(pcm))
+        if size:
+            self._buffer[self._end:self._end + size] = np.frombuffer(pcm, dtype=np.uint8, count=size)
+            self._end += size
+        return size
+
+    def fill_silence(self, size: int) -> int:
+        '''zero fills size bytes in place (missing packets), returns the number of bytes stored'''
+        size = self._reserve(size)
+        if size:
+            self._buffer[self._end:self._end + size] = 0
+            self._end += size
+        return size
+
+    def utterance(self) -> memoryview:
+        '''zero copy view of the current utterance'''
+        return self._view[self._start:self._end]
+
+    def finish(self, length: int = None) -> memoryview:
+        '''
+        returns a copy of the current utterance that the buffer does not reuse
+        and starts the next one. length keeps only the start of the utterance 
+        (i.e. trailing silence)
+        '''
+        view = self.utterance()
+        if length is not None:
+            view = view[:length]
+        audio = memoryview(bytes(view))
+        if self.dropped_bytes:
+            logger.info(f'utterance truncated, {self.dropped_bytes} bytes dropped')
+        self.start_utterance()
+        return audio
+
+    def clear(self) -> None:
+        self._start = self._end = 0
+        self.dropped_bytes = 0
+
+class Frame_Queue():
+    '''
+    Bounded single producer / single consumer queue between the voice_recv
+    reader thread and the event loop. deque append and popleft are atomic, so
+    no lock is needed. With an Opus_Decoder_Pool each decoder thread is a
+    producer, every speaker stays on one thread so their frames stay in order.
+
+    put returns True when the consumer has to be woken up. The flag is set by
+    the producer after appending and cleared by the consumer before draining,
+    so a frame can never be left behind without a wakeup on the way. When full,
+    the oldest frame is dropped and counted.
+    '''
+    def __init__(self, maxlen: int = 500):
+        self._items: deque = deque(maxlen=maxlen)
+        self._wakeup_pending: bool = False
+        self.dropped: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> bool:
+        if len(self._items) == self._items.maxlen:
+            self.dropped += 1
+        self._items.append(item)
+        if self._wakeup_pending:
+            return False
+        self._wakeup_pending = True
+        return True
+
+    def drain(self) -> Iterator[Any]:
+        self._wakeup_pending = False
+        while True:
+            try:
+                yield self._items.popleft()
+            except IndexError:
+                return
+
+    def clear(self) -> None:
+        self._items.clear()
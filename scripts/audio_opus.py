@@ -0,0 +1,106 @@
+'''
+Opus decoding off the voice_recv thread, and encoding of the TTS audio.
+
+By default discord-ext-voice-recv decodes every speaker's Opus stream on its
+packet thread, which is the CPU ceiling in busy channels. In passthrough mode
+(com_opus_decoders > 0) the sink asks for raw Opus and hands the packets to
+Opus_Decoder_Pool.
+
+Each worker thread owns the decoder states of the SSRCs assigned to it
+(ssrc % workers), so a stream is always decoded in order by the same thread
+and a decoder is never shared. discord.py calls libopus through ctypes,
+which releases the GIL while decoding, so threads scale without the pickling
+cost of a process pool.
+
+Empty packets (FakePacket, lost in transit) are decoded as packet loss
+concealment to keep the decoder state in step.
+
+Opus_Encoder_Pool encodes a synthesized sentence to 20ms packets right after
+TTS (TTS_opus_encoders > 0), so queued sentences take ~1/10 of the memory and
+the player thread only sends packets. Each worker thread keeps one encoder
+with the settings discord.py uses for its own encoding.
+'''
+import logging, threading, queue, asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any
+
+from discord.opus import Decoder, Encoder
+
+logger = logging.getLogger(__name__)
+
+class Opus_Decoder_Pool():
+    def __init__(self, workers: int, on_decoded: Callable[[dict[str, Any]], None]):
+        '''
+        workers - number of decoder threads
+        on_decoded - called on the worker thread with the frame, frame['pcm'] filled in
+        '''
+        self.on_decoded = on_decoded
+        self._queues: list[queue.SimpleQueue] = [queue.SimpleQueue() for _ in range(max(1, workers))]
+        self._threads: list[threading.Thread] = []
+        for index, jobs in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(jobs,),
+                    name=f'opus-decoder-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, frame: dict[str, Any]) -> None:
+        '''frame needs 'ssrc' and 'opus', safe to call from any thread'''
+        self._queues[frame['ssrc'] % len(self._queues)].put(frame)
+
+    def drop(self, ssrc: int) -> None:
+        '''forget the decoder state of a stream (speaker left)'''
+        self._queues[ssrc % len(self._queues)].put(ssrc)
+
+    def close(self) -> None:
+        for jobs in self._queues:
+            jobs.put(None)
+
+    def _worker(self, jobs: queue.SimpleQueue) -> None:
+        decoders: dict[int, Decoder] = {}
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if isinstance(job, int):
+                decoders.pop(job, None)
+                continue
+            decoder = decoders.get(job['ssrc'])
+            if decoder is None:
+                decoder = decoders[job['ssrc']] = Decoder()
+            try:
+                job['pcm'] = decoder.decode(job['opus'] or None, fec=False)
+            except Exception as e:
+                logger.info(f'opus decode failed for ssrc {job["ssrc"]}: {e}')
+                continue
+            self.on_decoded(job)
+
+class Opus_Encoder_Pool():
+    def __init__(self, workers: int):
+        '''workers - number of encoder threads'''
+        self.frame_size: int = Encoder.FRAME_SIZE
+        self.samples_per_frame: int = Encoder.SAMPLES_PER_FRAME
+        self._local: threading.local = threading.local()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+                max_workers=max(1, workers), thread_name_prefix='opus-encoder')
+
+    def _encode(self, pcm: bytes | memoryview) -> list[bytes]:
+        encoder = getattr(self._local, 'encoder', None)
+        if encoder is None:
+            encoder = self._local.encoder = Encoder()
+        pcm = memoryview(pcm)
+        packets = []
+        for start in range(0, len(pcm), self.frame_size):
+            # the encoder takes a pointer to bytes
+            frame = bytes(pcm[start:start + self.frame_size])
+            if len(frame) < self.frame_size:
+                frame += bytes(self.frame_size - len(frame))
+            packets.append(encoder.encode(frame, self.samples_per_frame))
+        return packets
+
+    async def encode(self, pcm: bytes | memoryview) -> list[bytes]:
+        '''48khz 16bit stereo pcm to 20ms opus packets, the last frame is padded with silence'''
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, pcm)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,241 @@
+'''
+Playback source for the bot voice.
+
+The old path wrapped every TTS sentence in its own discord.PCMAudio and
+started the next one from the after callback, every sentence paid for a new
+player thread and left a gap while it started. PCM_Stream_Source is played
+once per voice connection and never ends, TTS audio is appended to one
+continuous buffer and the sentences run back to back.
+
+read() is called by the discord.py player thread every 20ms and returns one
+frame (Encoder.FRAME_SIZE bytes of 48khz 16bit stereo). The last partial frame
+of a finished sentence is padded with silence. When nothing is buffered it
+returns silence frames, after idle_frames of those on_idle is called so the
+owner can pause the player (stops the speaking indicator and the silence
+packets) until more audio arrives.
+
+Every append is one sentence and can carry a tag (the sink passes the
+Audio_Out it came from). The source keeps the start and end of each sentence
+in bytes played since it was created, clear() returns a Playback_Position:
+the sentence that was playing, exactly how much of it went out and the
+sentences that never started. A frame is handed to the player right before
+it is sent, so the position is off by at most one 20ms frame.
+
+Streamed sentences (TTS_streaming) arrive in pieces while Piper is still
+synthesizing, append(extend=True) adds a piece to the sentence with the same
+tag instead of starting a new one. Pieces are not cut at frame boundaries,
+while the sentence is still coming (complete=False) a partial frame at the end
+of the buffer is held back until the next piece or the end of the sentence
+arrives, padding it would put a click in the middle of the sentence whenever
+Piper is slower than real time.
+
+With TTS_opus_encoders the sentences are encoded to Opus packets in the TTS
+cog (Opus_Encoder_Pool) and played through Opus_Stream_Source, discord.py
+sends the packets as they are instead of encoding every frame on the player
+thread. Positions are still counted in 48khz stereo pcm bytes (one packet is
+one 20ms frame), so both sources report the same Playback_Position.
+
+append and clear are called from the event loop, read from the player thread,
+the buffer is guarded by a lock held only for the copy.
+'''
+import logging, threading
+
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Optional, TypedDict, Any
+
+import discord
+from discord.opus import Encoder, OPUS_SILENCE
+
+logger = logging.getLogger(__name__)
+
+class Playback_Position(TypedDict):
+    tag: Any # sentence playing, or the last one played if the buffer ran dry
+    played_bytes: int # of that sentence
+    total_bytes: int
+    pending: list[Any] # tags of the sentences that did not start
+
+class Stream_Source(discord.AudioSource, ABC):
+    '''
+    sentence bookkeeping and the dry spell handling shared by the pcm and the
+    opus source, the subclasses only store the audio
+    '''
+    def __init__(self, idle_frames: int = 25, on_idle: Optional[Callable[[], None]] = None):
+        '''
+        idle_frames - silence frames (20ms each) sent after the buffer runs dry before on_idle
+        on_idle - called on the player thread, once per dry spell
+        '''
+        self.frame_size: int = Encoder.FRAME_SIZE
+        self.silence: bytes = bytes(self.frame_size)
+        self.idle_frames: int = idle_frames
+        self.on_idle: Optional[Callable[[], None]] = on_idle
+
+        # [start, end, tag] of every sentence not fully played, in bytes since the 
+        # source was made
+        self._segments: deque[list] = deque()
+        self._last_segment: list = None
+        self._appended_bytes: int = 0
+        self._played_bytes: int = 0
+        # the last sentence appended has more pieces coming
+        self._streaming: bool = False
+        self._starved_frames: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def buffered(self) -> int:
+        '''bytes (48khz stereo pcm) queued and not played yet'''
+        return self._appended_bytes - self._played_bytes
+
+    @property
+    def pending_segments(self) -> int:
+        '''appended sentences that have not started playing yet'''
+        with self._lock:
+            return sum(1 for segment in self._segments if segment[0] >= self._played_bytes)
+
+    @abstractmethod
+    def _store(self, audio: Any) -> int:
+        '''keeps the audio of one sentence, returns its length in pcm bytes'''
+
+    @abstractmethod
+    def _next_frame(self) -> tuple[Optional[bytes], int]:
+        '''the next frame to send and its length in pcm bytes, None if nothing is stored'''
+
+    @abstractmethod
+    def _discard(self) -> None:
+        '''drops everything stored'''
+
+    def append(self, audio: Any, tag: Any = None, extend: bool = False, complete: bool = True) -> None:
+        '''
+        queues one sentence after everything already buffered. extend adds to the
+        last sentence if it has the same tag (the next piece of a streamed sentence),
+        complete is False while more pieces of it will follow
+        '''
+        with self._lock:
+            self._streaming = not complete
+            size = self._store(audio)
+            if not size:
+                # only marks the end of a streamed sentence
+                return
+            segment = self._segments[-1] if self._segments else self._last_segment
+            if extend and (segment is not None) and (segment[2] is tag) \
+                    and (segment[1] == self._appended_bytes):
+                segment[1] += size
+                if not self._segments:
+                    # it had played out while waiting for this piece
+                    self._segments.append(segment)
+            else:
+                self._segments.append([self._appended_bytes, self._appended_bytes + size, tag])
+            self._appended_bytes += size
+
+    def _position(self) -> Optional[Playback_Position]:
+        # under the lock
+        current = self._last_segment
+        pending = list(self._segments)
+        if pending and (pending[0][0] < self._played_bytes):
+            current = pending.pop(0)
+        if current is None:
+            return None
+        return Playback_Position(
+                tag=current[2],
+                played_bytes=min(self._played_bytes, current[1]) - current[0],
+                total_bytes=current[1] - current[0],
+                pending=[segment[2] for segment in pending])
+
+    def position(self) -> Optional[Playback_Position]:
+        '''where playback is, None if nothing was appended yet'''
+        with self._lock:
+            return self._position()
+
+    def clear(self) -> Optional[Playback_Position]:
+        '''
+        drops everything not played yet, the next read is silence. Returns the 
+        position playback was stopped at
+        '''
+        with self._lock:
+            position = self._position()
+            self._discard()
+            self._segments.clear()
+            self._last_segment = None
+            self._streaming = False
+            self._played_bytes = self._appended_bytes
+        return position
+
+    def read(self) -> bytes:
+        with self._lock:
+            frame, size = self._next_frame()
+            if frame is None:
+                self._starved_frames += 1
+            else:
+                self._starved_frames = 0
+                self._played_bytes += size
+                while self._segments and (self._segments[0][1] <= self._played_bytes):
+                    self._last_segment = self._segments.popleft()
+            starved = self._starved_frames
+
+        if frame is None:
+            if (starved == self.idle_frames) and self.on_idle:
+                self.on_idle()
+            return self.silence
+        return frame
+
+    def cleanup(self) -> None:
+        self.clear()
+
+class PCM_Stream_Source(Stream_Source):
+    '''48khz 16bit stereo pcm, encoded to Opus by discord.py on the player thread'''
+    # played audio is only removed from the front of the buffer once this much
+    # has built up, so reads do not shift the buffer every frame
+    compact_bytes: int = 1 << 20
+
+    def __init__(self, idle_frames: int = 25, on_idle: Optional[Callable[[], None]] = None):
+        super().__init__(idle_frames=idle_frames, on_idle=on_idle)
+        self._buffer: bytearray = bytearray()
+        self._read_pos: int = 0
+
+    def _store(self, pcm: bytes | memoryview) -> int:
+        self._buffer += pcm
+        return len(pcm)
+
+    def _next_frame(self) -> tuple[Optional[bytes], int]:
+        start = self._read_pos
+        end = min(start + self.frame_size, len(self._buffer))
+        if (start == end) or ((end - start < self.frame_size) and self._streaming):
+            # the rest of a partial frame is still being synthesized
+            return None, 0
+        frame = bytes(self._buffer[start:end])
+        self._read_pos = end
+        if self._read_pos >= self.compact_bytes:
+            del self._buffer[:self._read_pos]
+            self._read_pos = 0
+        if len(frame) < self.frame_size:
+            frame += self.silence[:self.frame_size - len(frame)]
+        return frame, end - start
+
+    def _discard(self) -> None:
+        self._buffer.clear()
+        self._read_pos = 0
+
+    def is_opus(self) -> bool:
+        return False
+
+class Opus_Stream_Source(Stream_Source):
+    '''pre-encoded 20ms Opus packets, sent by discord.py as they are'''
+    def __init__(self, idle_frames: int = 25, on_idle: Optional[Callable[[], None]] = None):
+        super().__init__(idle_frames=idle_frames, on_idle=on_idle)
+        self.silence = OPUS_SILENCE
+        self._packets: deque[bytes] = deque()
+
+    def _store(self, packets: list[bytes]) -> int:
+        self._packets.extend(packets)
+        return len(packets) * self.frame_size
+
+    def _next_frame(self) -> tuple[Optional[bytes], int]:
+        if not self._packets:
+            return None, 0
+        return self._packets.popleft(), self.frame_size
+
+    def _discard(self) -> None:
+        self._packets.clear()
+
+    def is_opus(self) -> bool:
+        return True
@@ -0,0 +1,134 @@
+'''
+Polyphase resampling with numpy.
+
+Discord works in 48khz 16bit stereo, Whisper wants 16khz mono. Sending the
+Discord audio as is ships 6x the bytes over the Wyoming socket and the
+server resamples it anyway, so the STT path downmixes and resamples first.
+
+The TTS path goes the other way, Piper's 22050hz mono to Discord's 48khz
+stereo (147:320).
+
+The filter is a Kaiser windowed sinc, designed once per rate pair and split
+into L phases of K taps (L/M is the reduced up/down ratio). The phase pattern
+repeats every L outputs, which consume M inputs, so the taps are laid out
+once as a (M+K-1, L) block matrix: every block of L output samples is one
+row of M+K-1 input samples times that matrix. A whole chunk is a single
+matrix product, the rounding, clipping and the copy to every output channel
+(interleaved) happen in the one write to the int16 output.
+
+process keeps the last M+K-1 input samples and the output position between
+calls, so a stream can be converted chunk by chunk. resample converts a
+complete utterance with a fresh state, it is safe to call from several
+worker threads at once. copy.copy shares the filter, reset() then gives the
+copy its own stream state.
+'''
+import logging
+from math import gcd
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger(__name__)
+
+class Polyphase_Resampler():
+    def __init__(self,
+            input_rate: int,
+            output_rate: int,
+            input_channels: int = 1,
+            output_channels: int = 1,
+            zero_crossings: int = 8,
+            rolloff: float = 0.9,
+            kaiser_beta: float = 8.6):
+        '''
+        input_rate, output_rate - in hz
+        input_channels - interleaved channels are averaged to mono
+        output_channels - the mono result is written to this many interleaved channels
+        zero_crossings - filter half width, more is sharper and slower
+        rolloff - cutoff as a fraction of the lower nyquist frequency
+        '''
+        self.input_rate: int = input_rate
+        self.output_rate: int = output_rate
+        self.input_channels: int = input_channels
+        self.output_channels: int = output_channels
+
+        g = gcd(input_rate, output_rate)
+        self.up: int = output_rate // g
+        self.down: int = input_rate // g
+
+        # prototype lowpass at the upsampled rate
+        cutoff = rolloff / max(self.up, self.down)
+        half_width = zero_crossings * max(self.up, self.down)
+        n = np.arange(-half_width, half_width + 1, dtype=np.float64)
+        taps = cutoff * np.sinc(cutoff * n) * np.kaiser(len(n), kaiser_beta) * self.up
+
+        # split into phases: bank[p, k] = taps[p + k * up], reversed so it lines
+        # up with an ascending window of input samples
+        self.taps_per_phase: int = -(-len(taps) // self.up)
+        padded = np.zeros(self.taps_per_phase * self.up)
+        padded[:len(taps)] = taps
+        self.bank: np.ndarray = padded.reshape(self.taps_per_phase, self.up).T[:, ::-1].astype(np.float32)
+
+        # output j of a block uses phase (j * down) % up, its newest input is 
+        # (j * down) // up samples into the block
+        K = self.taps_per_phase
+        self.span: int = self.down + K - 1
+        self.block: np.ndarray = np.zeros((self.span, self.up), dtype=np.float32)
+        for j in range(self.up):
+            newest = (j * self.down) // self.up
+            self.block[newest:newest + K, j] = self.bank[(j * self.down) % self.up]
+
+        self.reset()
+
+    def reset(self) -> None:
+        self._history: np.ndarray = self._empty_history()
+        self._input_count: int = 0
+        self._output_count: int = 0
+
+    def _empty_history(self) -> np.ndarray:
+        return np.zeros(self.span, dtype=np.float32)
+
+    def _to_mono(self, pcm: bytes | memoryview | np.ndarray) -> np.ndarray:
+        samples = pcm if isinstance(pcm, np.ndarray) else np.frombuffer(pcm, dtype=np.int16)
+        if self.input_channels > 1:
+            samples = samples[:len(samples) - (len(samples) % self.input_channels)]
+            return samples.reshape(-1, self.input_channels).mean(axis=1, dtype=np.float32)
+        return samples.astype(np.float32)
+
+    def _convert(self, x: np.ndarray, history: np.ndarray, input_count: int,
+                output_count: int) -> tuple[np.ndarray, np.ndarray, int, int]:
+        '''returns output samples (float) and the new history, input_count, output_count'''
+        K, H = self.taps_per_phase, len(history)
+        input_end = input_count + len(x)
+        # every output whose newest input sample is in this chunk
+        output_end = (input_end * self.up + self.down - 1) // self.down
+        samples = np.concatenate((history, x))
+        if output_end <= output_count:
+            return np.zeros(0, dtype=np.float32), samples[len(samples) - H:], input_end, output_end
+
+        # whole blocks around the new outputs, the last one is zero padded
+        first_block = output_count // self.up
+        blocks = -(-output_end // self.up) - first_block
+        buffer = np.concatenate((samples, np.zeros(self.span, dtype=np.float32)))
+        # input i is at buffer[i - input_count + H], block b starts K-1 before input b * down
+        start = first_block * self.down - (K - 1) - input_count + H
+        rows = sliding_window_view(buffer, self.span)[start:start + blocks * self.down:self.down]
+        y = (rows @ self.block).reshape(-1)
+        offset = first_block * self.up
+        return y[output_count - offset:output_end - offset], samples[len(samples) - H:], input_end, output_end
+
+    def _to_int16(self, y: np.ndarray) -> np.ndarray:
+        np.clip(np.rint(y, out=y), -32768, 32767, out=y)
+        output = np.empty((len(y), self.output_channels), dtype=np.int16)
+        output[:] = y[:, None]
+        return output
+
+    def process(self, pcm: bytes | memoryview | np.ndarray) -> bytes:
+        '''stateful, converts the next chunk of a stream'''
+        y, self._history, self._input_count, self._output_count = self._convert(
+                self._to_mono(pcm), self._history, self._input_count, self._output_count)
+        return self._to_int16(y).tobytes()
+
+    def resample(self, pcm: bytes | memoryview | np.ndarray) -> bytes:
+        '''converts a complete utterance, does not touch the stream state'''
+        y, _, _, _ = self._convert(self._to_mono(pcm), self._empty_history(), 0, 0)
+        return self._to_int16(y).tobytes()
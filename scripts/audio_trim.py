@@ -0,0 +1,79 @@
+'''
+Silence trimming and energy gating before STT.
+
+Whisper makes things up when it is fed near silent audio ("thanks for
+watching", see Halluicanation_Sentences). The sink pads lost packets with
+zeros and the utterance still starts and ends with whatever the mic picked up
+around the speech, so before an utterance is sent:
+
+    - every 20ms frame is classified in one vectorized pass (frame_stats and
+      Energy_VAD.is_speech). The noise floor is estimated from the quietest
+      frames of the utterance, capped by the speaker's floor from the sink's
+      Energy_VAD (or max_noise_floor_db): an utterance of continuous speech has
+      no quiet frames and its quietest speech is not noise
+    - leading and trailing non speech is cut, pad_ms is kept on both sides
+    - utterances with less than min_speech_ratio speech frames are dropped
+      and never reach the STT server
+
+trim returns offsets into the utterance, the caller slices its memoryview.
+'''
+import logging
+
+from typing import TypedDict
+
+import numpy as np
+
+from scripts.audio_vad import frame_stats, Energy_VAD
+
+logger = logging.getLogger(__name__)
+
+class Trim_Result(TypedDict):
+    start: int # in bytes
+    end: int
+    speech_ratio: float # speech frames / all frames
+
+class Silence_Trimmer():
+    def __init__(self,
+            rate: int = 48000,
+            channels: int = 2,
+            width: int = 2,
+            frame_ms: int = 20,
+            threshold_db: float = -45.0,
+            pad_ms: int = 150,
+            min_speech_ratio: float = 0.2,
+            noise_percentile: float = 5.0,
+            max_noise_floor_db: float = -50.0):
+        '''
+        width - bytes per sample (one channel)
+        threshold_db - minimum frame energy for speech, same as com_vad_threshold
+        pad_ms - audio kept before the first and after the last speech frame
+        min_speech_ratio - utterances with less speech than this are dropped
+        noise_percentile - the noise floor is this percentile of the frame energies
+        max_noise_floor_db - cap of the noise floor when the speaker's is not known
+        '''
+        self.channels: int = channels
+        self.threshold_db: float = threshold_db
+        self.min_speech_ratio: float = min_speech_ratio
+        self.noise_percentile: float = noise_percentile
+        self.max_noise_floor_db: float = max_noise_floor_db
+        self.frame_bytes: int = rate * frame_ms // 1000 * channels * width
+        self.pad_frames: int = pad_ms // frame_ms
+
+    def trim(self, pcm: bytes | memoryview, noise_floor_db: float = None) -> Trim_Result:
+        '''noise_floor_db - the speaker's background level, Energy_VAD.noise_floor_db of the sink'''
+        num_frames = len(pcm) // self.frame_bytes
+        if num_frames == 0:
+            return Trim_Result(start=0, end=0, speech_ratio=0.0)
+        frames = np.frombuffer(pcm, dtype=np.int16, count=num_frames * self.frame_bytes // 2)
+        energy_db, zcr = frame_stats(frames.reshape(num_frames, -1), self.channels)
+
+        vad = Energy_VAD(threshold_db=self.threshold_db, channels=self.channels)
+        cap = self.max_noise_floor_db if noise_floor_db is None else noise_floor_db
+        vad.noise_floor_db = min(float(np.percentile(energy_db, self.noise_percentile)), cap)
+        speech = np.flatnonzero(vad.is_speech(energy_db, zcr))
+        if len(speech) == 0:
+            return Trim_Result(start=0, end=0, speech_ratio=0.0)
+
+        start = max(0, int(speech[0]) - self.pad_frames) * self.frame_bytes
+        end = min(len(pcm), (int(speech[-1]) + 1 + self.pad_frames) * self.frame_bytes)
+        return Trim_Result(start=start, end=end, speech_ratio=len(speech) / num_frames)
@@ -0,0 +1,89 @@
+'''
+Frame level voice activity detection for the voice receive sink.
+
+Discord keeps sending low level noise packets after someone stops talking, so
+"no packet for x ms" is a poor end of speech signal. Energy_VAD classifies every
+20ms frame as speech or silence from its energy (dBFS) and zero crossing rate,
+and runs a small per speaker state machine:
+
+    SILENCE -> SPEECH on the first speech frame
+    SPEECH -> END after hangover_ms of non speech frames (end of turn)
+    END -> SPEECH if speech resumes before the utterance was handed off
+
+The noise floor adapts on silence frames, so a noisy mic needs to be louder than
+its own background (noise_margin_db) to count as speech.
+
+frame_stats works on a 2d array of frames so whole utterances can be classified
+in a single vectorized pass.
+'''
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SILENCE = 0
+SPEECH = 1
+END = 2
+
+def frame_stats(frames: np.ndarray, channels: int = 2) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    frames - int16 array shaped (num_frames, samples_per_frame * channels)
+    returns (energy in dBFS, zero crossing rate per sample) for each frame
+    '''
+    samples = frames.astype(np.float32)
+    energy = np.mean(np.square(samples), axis=1) / (32768.0 ** 2)
+    energy_db = 10 * np.log10(energy + 1e-12)
+    # first channel is plenty for the zero crossing rate
+    mono = np.signbit(frames[:, ::channels])
+    zcr = np.count_nonzero(mono[:, 1:] != mono[:, :-1], axis=1) / max(mono.shape[1] - 1, 1)
+    return energy_db, zcr
+
+class Energy_VAD():
+    def __init__(self,
+            threshold_db: float = -45.0,
+            hangover_ms: int = 200,
+            frame_ms: int = 20,
+            channels: int = 2,
+            noise_margin_db: float = 10.0,
+            zcr_max: float = 0.25):
+        '''
+        threshold_db - minimum frame energy to be considered speech
+        hangover_ms - silence after speech before the turn is over
+        zcr_max - frames above this zero crossing rate are treated as hiss, unless they are loud
+        '''
+        self.threshold_db: float = threshold_db
+        self.noise_margin_db: float = noise_margin_db
+        self.zcr_max: float = zcr_max
+        self.channels: int = channels
+        self.hangover_frames: int = max(1, hangover_ms // frame_ms)
+
+        self.noise_floor_db: float = -90.0
+        self.state: int = SILENCE
+        self.silent_frames: int = 0
+
+    @property
+    def end_of_turn(self) -> bool:
+        return self.state == END
+
+    def is_speech(self, energy_db: np.ndarray, zcr: np.ndarray) -> np.ndarray:
+        threshold = max(self.threshold_db, self.noise_floor_db + self.noise_margin_db)
+        loud = energy_db > threshold
+        return loud & ((zcr < self.zcr_max) | (energy_db > threshold + 15))
+
+    def process(self, pcm: bytes) -> bool:
+        '''classifies a single frame of pcm and advances the state machine, returns True for speech'''
+        frame = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+        energy_db, zcr = frame_stats(frame, self.channels)
+        speech = bool(self.is_speech(energy_db, zcr)[0])
+
+        if speech:
+            self.state = SPEECH
+            self.silent_frames = 0
+        else:
+            self.noise_floor_db = 0.95 * self.noise_floor_db + 0.05 * float(energy_db[0])
+            if self.state == SPEECH:
+                self.silent_frames += 1
+                if self.silent_frames >= self.hangover_frames:
+                    self.state = END
+        return speech
@@ -19,7 +19,7 @@ class Prompt_Output(TypedDict):
 
     
 class TTS_Audio(TypedDict):
-    audio: array.array
+    audio: array.array | bytes # bytes for a single streamed chunk
     rate: int
     width: int
     channels: int
@@ -81,9 +81,20 @@ class TTS_Message(TypedDict):
     text: str
     timestamp_request_start: float 
     wyTTSSynth: wyTTS.SynthesizeVoice
-    alt_host: str # future plans: multiple servers to avoid loading lag for voice models
+    alt_host: str # pins the sentence to this server, see scripts/tts_router.py
     alt_port: int
     disc_message: Discord_Message
+    sentence_index: NotRequired[int] # position in disc_message.sentences
+
+class Audio_Out(TypedDict):
+    '''one synthesized sentence in queues.audio_out'''
+    audio: io.BytesIO # 48khz 16bit stereo pcm, None when encoded to opus
+    opus: NotRequired[list[bytes]] # 20ms opus packets (TTS_opus_encoders)
+    text: str
+    sentence_index: int
+    disc_message: Discord_Message
+    continues: NotRequired['Audio_Out'] # streamed sentence, more audio for that Audio_Out
+    complete: NotRequired[bool] # False while more pieces of a streamed sentence follow
 
 class Binary_Reasoning():
     '''
@@ -168,14 +179,27 @@ class info_table(TypedDict):
     corrected_text: dict[int, corrected_text]
 
 class Speaking_Interrupt(TypedDict):
-        num_sentences: int
+        num_sentences: int # queued sentences that did not start playing
         user_id: int
         user_name: str
+        disc_message: NotRequired[Discord_Message] # the bot message that was cut off
+        sentences_heard: NotRequired[int] # disc_message.sentences played in full
+        partial_fraction: NotRequired[float] # share of the next sentence that was played
 
 class Audio_Message():
-    def __init__(self, audio_data: io.BytesIO, message: Discord_Message):
-        self.audio_data: io.BytesIO = audio_data
+    def __init__(self, audio_data: memoryview, message: Discord_Message, stt_stream: Any = None, final: bool = True,
+                noise_floor_db: float = None, turn_id: int = None, segment: int = 0):
+        self.audio_data: memoryview = audio_data
         self.message: Discord_Message = message
+        # STT_Stream when the audio was already streamed to the STT server
+        self.stt_stream: Any = stt_stream
+        # False for the segments of a long turn before the last, they share the message
+        self.final: bool = final
+        # background level of the speaker's mic from the sink's vad, None without it
+        self.noise_floor_db: float = noise_floor_db
+        # the segments of a turn share turn_id (numbered by the sink) and are numbered from 0
+        self.turn_id: int = turn_id
+        self.segment: int = segment
 
 class Prompt_SUA(TypedDict):
     system: str
@@ -192,6 +216,21 @@ class Prompt_Split(TypedDict):
     end: NotRequired[str]
     tokens: NotRequired[int]
 
+class LLM_Token(TypedDict):
+    '''streamed response text, see LLM_Interface.stream'''
+    type: str # 'token'
+    text: str
+
+class LLM_Stats(TypedDict):
+    '''last event of a streamed response, durations in nanoseconds (ollama)'''
+    type: str # 'stats'
+    prompt_eval_count: int # 0 if the whole prompt was cached
+    prompt_eval_duration: int
+    eval_count: int
+    eval_duration: int
+    load_duration: int
+    total_duration: int
+
 class db_in_out(TypedDict):
     user_id: NotRequired[int]
     bot_id: NotRequired[str]
@@ -232,6 +271,25 @@ class db_client():
             self.prompts[prompt_name]['tokens'] = tokens
         else:
             raise ValueError(f"Prompt name '{prompt_name}' not found.")
+
+@dataclass
+class Bot_User_Info():
+    '''the bot's personality and its prompts (LLM_Prompts.bot_info), tokens as in db_client'''
+    name: str
+    personality: str = None
+    prompts: dict[str, Prompt_Split] = field(default_factory=dict)
+
+    def get_tokens(self, prompt_name: str):
+        if prompt_name in self.prompts:
+            return self.prompts[prompt_name]['tokens']
+        else:
+            raise ValueError(f"Prompt name '{prompt_name}' not found.")
+
+    def set_tokens(self, prompt_name: str, tokens: int):
+        if prompt_name in self.prompts:
+            self.prompts[prompt_name]['tokens'] = tokens
+        else:
+            raise ValueError(f"Prompt name '{prompt_name}' not found.")
     
 Halluicanation_Sentences = (
     'thank you', 
@@ -6,7 +6,7 @@ from collections import deque
 from discord import TextChannel, VoiceChannel
 from discord.ext import commands
 
-from scripts.datatypes import Discord_Message, Audio_Message, TTS_Message, Halluicanation_Sentences, bot_user_info, db_client_user, db_client_in_out
+from scripts.datatypes import Discord_Message, Audio_Message, Audio_Out, TTS_Message, Halluicanation_Sentences, Bot_User_Info, db_client, db_in_out
 
 class Commands_Bot(commands.Bot):
     def __init__(self, *args, **kwargs):
@@ -33,8 +33,8 @@ class Discord_Container():
         self.message_store: dict = {}
         self.current_listeners: dict = {}
         self.last_user_audio: dict[int, float] = {}
-        self.user_info: dict[int, db_client_user] = {}
-        self.bot_info: dict[str, bot_user_info] = {} 
+        self.user_info: dict[int, db_client] = {}
+        self.bot_info: dict[str, Bot_User_Info] = {} 
 
 
         self.text_channel: TextChannel  = None
@@ -90,10 +90,10 @@ class Queue_Container():
         self.audio_in: deque[Audio_Message] = deque()
         self.llm: deque[Discord_Message] = deque()
         self.tts: deque[TTS_Message] = deque()
-        self.audio_out: deque[io.BytesIO] = deque()
+        self.audio_out: deque[Audio_Out] = deque()
         self.db_message: deque[Discord_Message] = deque()
         self.text_message: deque[Discord_Message] = deque()
-        self.db_loginout: deque[db_client_in_out] = deque()
+        self.db_loginout: deque[db_in_out] = deque()
 
     """ should be defined in the llm_main
     def get_message_store_key(self, get_current: bool = False, set: int = None) -> int:
@@ -0,0 +1,169 @@
+'''
+Token counts for the prompt budget.
+
+The LLM server has no tokenizer endpoint, a count is a generation with
+num_predict 1 (LLM_Interface.get_num_tokens, the length of the context it
+returns, prompt caching does not change it). Token_Counter keeps the counts
+so a text is sent once per model:
+
+    - keyed by model and a hash of the text, in memory (oldest dropped past
+      max_entries) and in a json file that survives restarts (the CHAT / CTR
+      prompts are counted once, not at every start)
+    - drain counts queued messages in batches, the requests of a batch run at
+      once on the shared client (LLM_connections), and fills Discord_Message.tokens
+    - a message that could not be counted max_attempts drains in a row keeps
+      the estimate (len(text) // 4) and is not queued again, it is not saved
+    - save writes the file when there are new counts, call it from a worker thread
+'''
+import logging, os, json, hashlib, asyncio
+
+from collections import deque
+from typing import Callable, Union
+
+import httpx
+
+from scripts.datatypes import Discord_Message
+from scripts.LLM_interface import LLM_Interface
+
+logger = logging.getLogger(__name__)
+
+class Token_Counter():
+    def __init__(self,
+            llm: LLM_Interface,
+            cache_file: str = None,
+            batch_size: int = 16,
+            max_entries: int = 100000,
+            max_attempts: int = 3):
+        '''
+        cache_file - json file of the counts, None keeps them in memory only
+        batch_size - messages counted per drain
+        max_attempts - failed drains before a message keeps its estimate
+        '''
+        self.llm: LLM_Interface = llm
+        self.cache_file: str = cache_file
+        self.batch_size: int = batch_size
+        self.max_entries: int = max_entries
+        self.max_attempts: int = max_attempts
+
+        self.counts: dict[str, int] = {}
+        self.dirty: bool = False
+        self.failures: dict[str, int] = {} # key: failed drains in a row
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        if self.cache_file:
+            self.load()
+
+    def __repr__(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return f'Token_Counter(hit rate {hit_rate:.0%} of {requests}, {len(self.counts)} counts)'
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f'{self.llm.llm_model}\n{text}'.encode()).hexdigest()
+
+    def get(self, text: str) -> Union[int, None]:
+        '''the cached count, None if the text was not counted yet'''
+        tokens = self.counts.get(self.key(text))
+        if tokens is not None:
+            self.hits += 1
+        return tokens
+
+    def remember(self, text: str, tokens: int) -> None:
+        self.counts[self.key(text)] = tokens
+        self.dirty = True
+        while len(self.counts) > self.max_entries:
+            del self.counts[next(iter(self.counts))]
+
+    async def count(self, text: str) -> int:
+        tokens = self.get(text)
+        if tokens is None:
+            self.misses += 1
+            tokens = await self.llm.get_num_tokens(prompt=text)
+            self.remember(text, tokens)
+        return tokens
+
+    async def count_many(self, texts: list[str]) -> list[int]:
+        '''
+        the uncounted texts are sent at once, each distinct text once. Raises the
+        first error after all came back, the counts that did are kept
+        '''
+        missing = list({text for text in texts if self.get(text) is None})
+        if missing:
+            self.misses += len(missing)
+            results = await asyncio.gather(*(self.llm.get_num_tokens(prompt=text) for text in missing),
+                    return_exceptions=True)
+            for text, tokens in zip(missing, results):
+                if not isinstance(tokens, BaseException):
+                    self.remember(text, tokens)
+            for error in results:
+                if isinstance(error, BaseException):
+                    raise error
+        return [self.counts[self.key(text)] for text in texts]
+
+    async def drain(self,
+            queue: deque[Discord_Message],
+            message_text: Callable[[Discord_Message], str]) -> int:
+        '''
+        counts up to batch_size queued messages as message_text formats them
+        and sets their tokens, returns the number of messages counted
+        '''
+        messages = []
+        seen = set()
+        while queue and (len(messages) < self.batch_size):
+            message = queue.popleft()
+            if (message.tokens is None) and (id(message) not in seen):
+                seen.add(id(message))
+                messages.append(message)
+        if not messages:
+            return 0
+        texts = [message_text(message) for message in messages]
+        try:
+            results = await self.count_many(texts)
+        except (httpx.HTTPError, ValueError) as e:
+            # server busy or down, try again on the next drain
+            keys = [self.key(text) for text in texts]
+            for key in set(keys):
+                self.failures[key] = self.failures.get(key, 0) + 1
+            retry = []
+            for message, text, key in zip(messages, texts, keys):
+                if self.failures[key] < self.max_attempts:
+                    retry.append(message)
+                else:
+                    message.tokens = len(text) // 4
+            for key in set(keys):
+                if self.failures[key] >= self.max_attempts:
+                    del self.failures[key]
+            logger.info(f'Token count failed, {len(retry)} messages queued again, '
+                        f'{len(messages) - len(retry)} keep the estimate: {e}')
+            queue.extendleft(reversed(retry))
+            return 0
+        for message, text, tokens in zip(messages, texts, results):
+            self.failures.pop(self.key(text), None)
+            message.tokens = tokens
+        return len(messages)
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file, 'r') as file:
+                counts = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.info(f'Token counts in {self.cache_file} unreadable, starting empty: {e}')
+            return
+        self.counts.update(counts)
+        logger.info(f'Token counts - {len(self.counts)} loaded from {self.cache_file}')
+
+    def save(self) -> None:
+        if (not self.cache_file) or (not self.dirty):
+            return
+        self.dirty = False
+        counts = dict(self.counts) # the loop keeps adding
+        try:
+            with open(self.cache_file + '.tmp', 'w') as file:
+                json.dump(counts, file)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as e:
+            logger.info(f'Token counts - could not write {self.cache_file}: {e}')
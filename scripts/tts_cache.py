@@ -0,0 +1,208 @@
+'''
+Cache of synthesized TTS phrases.
+
+The bot says the same short sentences over and over ("Yeah.", "What?",
+greetings), each one used to cost a Piper round trip and a resample. TTS_Cache
+keeps the final audio (48khz stereo pcm, or the Opus packets with
+TTS_opus_encoders) keyed by the normalized text, the voice and the output
+format:
+
+    - memory tier, an LRU with a byte budget
+    - disk tier (optional), one file per phrase in cache_dir, read through mmap
+      and promoted to memory on a hit. It survives restarts, the oldest files
+      (by last use) are removed when it grows past its budget
+
+Only phrases up to max_text_length characters are kept, long sentences rarely
+repeat word for word.
+
+get and put do the disk io, call them from a worker thread.
+'''
+import logging, os, mmap, hashlib, threading
+
+from collections import OrderedDict
+from typing import Union
+
+import wyoming.tts as wyTTS
+
+logger = logging.getLogger(__name__)
+
+Cached_Audio = Union[bytes, list[bytes]] # pcm or opus packets
+
+class TTS_Cache():
+    def __init__(self,
+            memory_bytes: int = 32 << 20,
+            cache_dir: str = None,
+            disk_bytes: int = 256 << 20,
+            max_text_length: int = 80):
+        '''
+        memory_bytes - budget of the in memory LRU
+        cache_dir - directory of the disk tier, None keeps the cache in memory only
+        disk_bytes - budget of the disk tier
+        max_text_length - longer sentences are not cached
+        '''
+        self.memory_bytes: int = memory_bytes
+        self.disk_bytes: int = disk_bytes
+        self.max_text_length: int = max_text_length
+        self.cache_dir: str = cache_dir
+
+        self._memory: OrderedDict[str, Cached_Audio] = OrderedDict()
+        self._memory_used: int = 0
+        # file name -> size, oldest use first
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_used: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_index()
+
+    @property
+    def requests(self) -> int:
+        return self.memory_hits + self.disk_hits + self.misses
+
+    def __repr__(self) -> str:
+        requests = self.requests
+        hit_rate = (self.memory_hits + self.disk_hits) / requests if requests else 0.0
+        return (f'TTS_Cache(hit rate {hit_rate:.0%} of {requests}, memory {self.memory_hits} disk {self.disk_hits} '
+                f'miss {self.misses}, {len(self._memory)} phrases {self._memory_used >> 10}KB in memory, '
+                f'{len(self._disk)} phrases {self._disk_used >> 10}KB on disk)')
+
+    def key(self, text: str, voice: wyTTS.SynthesizeVoice, output_format: str) -> Union[str, None]:
+        '''
+        output_format - what is stored, i.e. 'pcm48000x2' or 'opus'
+        None if the phrase is not cached (too long)
+        '''
+        text = ' '.join(text.split()).casefold()
+        if (not text) or (len(text) > self.max_text_length):
+            return None
+        if voice is None:
+            voice_key = 'default'
+        else:
+            voice_key = f'{voice.name}|{voice.language}|{voice.speaker}'
+        return hashlib.sha1(f'{output_format}\n{voice_key}\n{text}'.encode()).hexdigest()
+
+    def get(self, key: str) -> Union[Cached_Audio, None]:
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+        audio = self._read(key)
+        if audio is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, audio)
+        return audio
+
+    def put(self, key: str, audio: Cached_Audio) -> None:
+        self._remember(key, audio)
+        if self.cache_dir and (os.path.basename(self._path(key, isinstance(audio, list))) not in self._disk):
+            self._write(key, audio)
+
+    @staticmethod
+    def _size(audio: Cached_Audio) -> int:
+        if isinstance(audio, list):
+            return sum(len(packet) for packet in audio)
+        return len(audio)
+
+    def _remember(self, key: str, audio: Cached_Audio) -> None:
+        size = self._size(audio)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._size(self._memory.pop(key))
+            self._memory[key] = audio
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= self._size(evicted)
+
+    def _path(self, key: str, opus: bool) -> str:
+        return os.path.join(self.cache_dir, key + ('.opus' if opus else '.pcm'))
+
+    def _load_index(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(('.pcm', '.opus')):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_used += size
+        logger.info(f'TTS cache - {len(self._disk)} phrases on disk in {self.cache_dir}')
+
+    def _read(self, key: str) -> Union[Cached_Audio, None]:
+        if not self.cache_dir:
+            return None
+        for opus in (False, True):
+            name = os.path.basename(self._path(key, opus))
+            if name in self._disk:
+                break
+        else:
+            return None
+        path = self._path(key, opus)
+        try:
+            with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if opus:
+                    # 2 byte length before every packet
+                    audio, position = [], 0
+                    while position < len(data):
+                        length = int.from_bytes(data[position:position + 2], 'little')
+                        audio.append(data[position + 2:position + 2 + length])
+                        position += 2 + length
+                else:
+                    audio = data[:]
+            os.utime(path)
+        except (OSError, ValueError) as e:
+            logger.info(f'TTS cache - {path} unreadable, removed: {e}')
+            self._remove(name)
+            return None
+        with self._lock:
+            self._disk.move_to_end(name)
+        return audio
+
+    def _write(self, key: str, audio: Cached_Audio) -> None:
+        opus = isinstance(audio, list)
+        path = self._path(key, opus)
+        if opus:
+            data = b''.join(len(packet).to_bytes(2, 'little') + packet for packet in audio)
+        else:
+            data = bytes(audio)
+        try:
+            # complete files only, a crash mid write leaves the .tmp behind
+            with open(path + '.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.info(f'TTS cache - could not write {path}: {e}')
+            return
+        with self._lock:
+            self._disk[os.path.basename(path)] = len(data)
+            self._disk_used += len(data)
+            evict = []
+            while (self._disk_used > self.disk_bytes) and (len(self._disk) > 1):
+                name, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                evict.append(name)
+        for name in evict:
+            self._unlink(name)
+
+    def _remove(self, name: str) -> None:
+        with self._lock:
+            size = self._disk.pop(name, None)
+            if size is not None:
+                self._disk_used -= size
+        self._unlink(name)
+
+    def _unlink(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
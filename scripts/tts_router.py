@@ -0,0 +1,198 @@
+'''
+Routing of TTS requests over several piper servers.
+
+Loading a voice model takes piper a while, so every voice is kept on one
+server (affinity) once it has been used. The first request for a voice goes to
+the least loaded healthy server, preferring the one with the fewest voices
+already assigned. Requests without a voice (the server's default) can go
+anywhere and always take the least loaded server.
+
+A request leaves its voice's server when that server is
+    - unhealthy, its last health check or request failed (probe() checks every
+      server again, the TTS cog runs it every few seconds)
+    - slow, the time to the first audio chunk (queueing included) averages
+      more than slow_ms. A slow server gets no routed requests to update its
+      average, probe() times a short sentence on it instead and the server is
+      used again once that comes back under slow_ms. The probe (and the TTS
+      cog's warm up) uses the voice the server synthesized last, a server that
+      holds one model at a time would reload otherwise
+A request that fails before any audio came back is retried once on another
+server. When the home server failed the voice moves, when it is only slow the
+voice stays so it comes back once the server catches up. timeout applies to
+every chunk, a server that stalls in the middle of a sentence fails the request.
+
+TTS_Message.alt_host / alt_port pin a sentence to that server. Servers that
+are not in the list get a pool of their own that only the sentences naming
+them use, they are never routed to.
+'''
+import logging, time, asyncio
+
+from typing import AsyncIterator
+
+import wyoming.tts as wyTTS
+
+from scripts.datatypes import TTS_Audio
+from scripts.wyoming_pool import Wyoming_Pool
+from scripts.TTS_Piper import stream_TTS
+
+logger = logging.getLogger(__name__)
+
+class TTS_Router():
+    # timed by probe() on slow servers
+    probe_text: str = 'Testing.'
+
+    def __init__(self,
+            servers: list[tuple[str, int]],
+            max_connections: int = 2,
+            slow_ms: int = 2000,
+            timeout: float = 15.0):
+        '''
+        servers - (host, port) of every piper server
+        max_connections - requests at once per server
+        slow_ms - average time to the first audio chunk above which a server is avoided
+        timeout - in seconds, no audio chunk for this long is a failed request
+        '''
+        self.max_connections: int = max_connections
+        self.slow: float = slow_ms / 1000
+        self.timeout: float = timeout
+
+        self.pools: dict[tuple[str, int], Wyoming_Pool] = {}
+        self.pinned: dict[tuple[str, int], Wyoming_Pool] = {} # alt_host / alt_port, not routed
+        self.outstanding: dict[Wyoming_Pool, int] = {}
+        self.first_audio: dict[Wyoming_Pool, float] = {} # moving average, seconds
+        self.affinity: dict[str, Wyoming_Pool] = {}
+        self.last_voice: dict[Wyoming_Pool, wyTTS.SynthesizeVoice] = {} # the model the server has loaded
+        for host, port in servers:
+            self.add_pool(self.pools, host, port)
+
+        self.requests: int = 0
+        self.fallbacks: int = 0
+        self.retries: int = 0
+
+    def __repr__(self) -> str:
+        servers = ', '.join(f'{pool.host}:{pool.port} {"up" if pool.healthy else "down"} '
+                f'{self.first_audio[pool] * 1000:.0f}ms' for pool in self.pools.values())
+        return (f'TTS_Router({servers}; requests {self.requests} fallbacks {self.fallbacks} '
+                f'retries {self.retries}, voices {({voice: pool.port for voice, pool in self.affinity.items()})})')
+
+    def add_pool(self, pools: dict[tuple[str, int], Wyoming_Pool], host: str, port: int) -> Wyoming_Pool:
+        key = (host, int(port))
+        if key not in pools:
+            pool = Wyoming_Pool(host=host, port=int(port), max_connections=self.max_connections)
+            pools[key] = pool
+            self.outstanding[pool] = 0
+            self.first_audio[pool] = 0.0
+        return pools[key]
+
+    def get_pool(self, host: str, port: int) -> Wyoming_Pool:
+        '''the pool of a server a request is pinned to, one of the routed ones if it is listed'''
+        return self.pools.get((host, int(port))) or self.add_pool(self.pinned, host, port)
+
+    @staticmethod
+    def voice_key(voice: wyTTS.SynthesizeVoice) -> str:
+        '''the voice model, speakers of one model share it'''
+        if voice is None:
+            return None
+        return voice.name or voice.language
+
+    def usable(self, pool: Wyoming_Pool) -> bool:
+        return pool.healthy and (self.first_audio[pool] <= self.slow)
+
+    def load(self, pool: Wyoming_Pool) -> tuple:
+        return (self.outstanding[pool] / pool.max_connections, self.first_audio[pool])
+
+    def pick(self, voice: wyTTS.SynthesizeVoice, exclude: Wyoming_Pool = None) -> Wyoming_Pool:
+        candidates = [pool for pool in self.pools.values() if pool is not exclude] or list(self.pools.values())
+        usable = [pool for pool in candidates if self.usable(pool)] \
+                or [pool for pool in candidates if pool.healthy] or candidates
+
+        key = self.voice_key(voice)
+        if key is None:
+            return min(usable, key=self.load)
+        home = self.affinity.get(key)
+        if home in usable:
+            return home
+        if (home is None) or (not home.healthy):
+            # new voice or its server is down, spread the models over the servers
+            voices = {pool: 0 for pool in self.pools.values()}
+            for pool in self.affinity.values():
+                voices[pool] += 1
+            pool = min(usable, key=lambda pool: (voices[pool],) + self.load(pool))
+            if home is not None:
+                logger.info(f'TTS voice {key} moved from {home.host}:{home.port} to {pool.host}:{pool.port}')
+            self.affinity[key] = pool
+            return pool
+        # slow or excluded, this request only
+        self.fallbacks += 1
+        return min(usable, key=self.load)
+
+    async def stream(self,
+            text: str,
+            voice: wyTTS.SynthesizeVoice,
+            host: str = None,
+            port: int = None) -> AsyncIterator[TTS_Audio]:
+        '''
+        yields the audio chunks like stream_TTS. host / port pin the request to
+        that server, otherwise it is routed
+        '''
+        self.requests += 1
+        pool = self.get_pool(host, port) if host else self.pick(voice)
+        for attempt in range(2):
+            received = False
+            start = time.perf_counter()
+            current = pool
+            self.outstanding[current] += 1
+            self.last_voice[current] = voice
+            try:
+                chunks = stream_TTS(text=text, voice=voice, pool=pool)
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), timeout=self.timeout)
+                    received = True
+                    self.first_audio[pool] = 0.8 * self.first_audio[pool] + 0.2 * (time.perf_counter() - start)
+                    pool.healthy = True
+                    while True:
+                        yield chunk
+                        chunk = await asyncio.wait_for(anext(chunks), timeout=self.timeout)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    await chunks.aclose()
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                if received:
+                    raise
+                pool.healthy = False
+                if attempt or host or (len(self.pools) == 1):
+                    raise
+                self.retries += 1
+                logger.info(f'TTS {pool.host}:{pool.port} failed, trying another server: {e}')
+                pool = self.pick(voice, exclude=pool)
+            finally:
+                self.outstanding[current] -= 1
+
+    async def measure(self, pool: Wyoming_Pool) -> None:
+        '''times a short sentence, the result replaces the server's average'''
+        start = time.perf_counter()
+        self.outstanding[pool] += 1
+        chunks = stream_TTS(text=self.probe_text, voice=self.last_voice.get(pool), pool=pool)
+        try:
+            await asyncio.wait_for(anext(chunks), timeout=self.timeout)
+            self.first_audio[pool] = time.perf_counter() - start
+        except StopAsyncIteration:
+            pass
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.info(f'TTS {pool.host}:{pool.port} failed the probe: {e}')
+            pool.healthy = False
+        finally:
+            await chunks.aclose()
+            self.outstanding[pool] -= 1
+
+    async def probe(self) -> None:
+        '''health check of every server, the slow ones are timed again'''
+        await asyncio.gather(*(pool.check() for pool in self.pools.values()))
+        await asyncio.gather(*(self.measure(pool) for pool in self.pools.values()
+                if pool.healthy and (self.first_audio[pool] > self.slow)))
+
+    async def close(self) -> None:
+        for pool in (*self.pools.values(), *self.pinned.values()):
+            await pool.close()
@@ -0,0 +1,182 @@
+'''
+Pool of Wyoming connections to one server (STT now, TTS can share it).
+
+Every request used to open a new AsyncTcpClient, so each turn paid for a TCP
+connect (and the STT path never closed its socket). Wyoming_Pool keeps
+connections open and ready:
+
+    - warm_connections are connected ahead of time and health checked with a
+      Describe / Info round trip, so a request starts writing right away
+    - a connection is checked again when it is borrowed (closed by the server,
+      EOF pending) and replaced if it is dead
+    - at most max_connections are borrowed at once, further requests wait
+    - a connection goes back to the pool after a clean request if the server
+      kept it open. wyoming-faster-whisper closes it after every transcript,
+      those are dropped and the replacement is already warming up by then.
+      wyoming-piper keeps them, once a returned connection is still open when
+      it is borrowed again (keeps_open) borrowed connections count as warm and
+      no replacements are opened
+
+    async with pool.connection() as client:
+        await client.write_event(...)
+
+A request that fails on a borrowed connection raises like a fresh one would
+(OSError / ConnectionError), the caller decides whether to retry.
+
+check() is the health probe for routing between servers: a connect with the
+Describe / Info round trip, the connection is kept as a warm one. healthy
+follows the last probe or warm up.
+'''
+import logging, asyncio, contextlib
+
+from collections import deque
+from typing import AsyncIterator
+
+import wyoming.client as wyClient
+import wyoming.info as wyInfo
+
+logger = logging.getLogger(__name__)
+
+class Wyoming_Pool():
+    def __init__(self,
+            host: str,
+            port: int,
+            max_connections: int = 2,
+            warm_connections: int = 1,
+            connect_timeout: float = 2.0):
+        '''
+        max_connections - requests in flight at once on this server
+        warm_connections - idle connections kept open and checked ahead of time
+        connect_timeout - in seconds, for the connect and the health check
+        '''
+        self.host: str = host
+        self.port: int = int(port)
+        self.max_connections: int = max(1, max_connections)
+        self.warm_connections: int = min(warm_connections, self.max_connections)
+        self.connect_timeout: float = connect_timeout
+
+        self._idle: deque[wyClient.AsyncTcpClient] = deque()
+        self._warming: set[asyncio.Task] = set()
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(self.max_connections)
+        self.in_use: int = 0
+        self.closed: bool = False
+        self.keeps_open: bool = False # the server left a connection open after a request
+        self.healthy: bool = True # last health check passed
+        self._returned: set[wyClient.AsyncTcpClient] = set() # idle after serving a request
+
+        self.connects: int = 0
+        self.ready_hits: int = 0 # borrowed an open connection
+        self.cold_connects: int = 0 # had to connect while a request waited
+        self.dropped: int = 0 # found closed when borrowed
+
+    def __repr__(self) -> str:
+        return (f'Wyoming_Pool({self.host}:{self.port} idle {len(self._idle)} in use {self.in_use} '
+                f'connects {self.connects} ready {self.ready_hits} cold {self.cold_connects} dropped {self.dropped})')
+
+    async def _connect(self, check: bool = True) -> wyClient.AsyncTcpClient:
+        client = wyClient.AsyncTcpClient(host=self.host, port=self.port,
+                connect_timeout=self.connect_timeout)
+        await client.connect()
+        self.connects += 1
+        if not check:
+            return client
+        try:
+            # health check, the server has to answer a Describe
+            await client.write_event(wyInfo.Describe().event())
+            event = await asyncio.wait_for(client.read_event(), timeout=self.connect_timeout)
+            while (event is not None) and (not wyInfo.Info.is_type(event.type)):
+                event = await asyncio.wait_for(client.read_event(), timeout=self.connect_timeout)
+            if event is None:
+                raise ConnectionResetError(f'{self.host}:{self.port} closed during the health check')
+        except BaseException:
+            await self._disconnect(client)
+            raise
+        return client
+
+    @staticmethod
+    def _alive(client: wyClient.AsyncTcpClient) -> bool:
+        writer, reader = client._writer, client._reader
+        return (writer is not None) and (not writer.is_closing()) and (not reader.at_eof())
+
+    async def _disconnect(self, client: wyClient.AsyncTcpClient) -> None:
+        try:
+            await client.disconnect()
+        except OSError:
+            pass
+
+    def warm(self) -> None:
+        '''opens connections in the background until warm_connections are ready'''
+        ready = sum(1 for client in self._idle if self._alive(client))
+        if self.keeps_open:
+            # borrowed connections come back
+            ready += self.in_use
+        while (not self.closed) and (ready + len(self._warming) < self.warm_connections):
+            task = asyncio.get_running_loop().create_task(self._warm_one())
+            self._warming.add(task)
+            task.add_done_callback(self._warming.discard)
+
+    async def _warm_one(self) -> None:
+        await self.check()
+
+    async def check(self) -> bool:
+        '''health check on a new connection, it is kept if the pool has room'''
+        try:
+            client = await self._connect()
+        except (OSError, asyncio.TimeoutError) as e:
+            if self.healthy:
+                logger.info(f'Wyoming {self.host}:{self.port} not ready: {e}')
+            self.healthy = False
+            return False
+        self.healthy = True
+        if self.closed or (len(self._idle) >= self.max_connections):
+            await self._disconnect(client)
+        else:
+            self._idle.append(client)
+        return True
+
+    async def _borrow(self) -> wyClient.AsyncTcpClient:
+        while self._idle:
+            client = self._idle.popleft()
+            alive = self._alive(client)
+            if client in self._returned:
+                self._returned.discard(client)
+                self.keeps_open = alive
+            if alive:
+                self.ready_hits += 1
+                return client
+            self.dropped += 1
+            await self._disconnect(client)
+        # the request itself shows whether the server is up
+        self.cold_connects += 1
+        return await self._connect(check=False)
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[wyClient.AsyncTcpClient]:
+        if self.closed:
+            raise ConnectionError(f'Wyoming pool {self.host}:{self.port} is closed')
+        async with self._slots:
+            client = await self._borrow()
+            self.in_use += 1
+            clean = False
+            try:
+                # the replacement warms up while this request runs
+                self.warm()
+                yield client
+                clean = True
+            finally:
+                self.in_use -= 1
+                if clean and (not self.closed) and self._alive(client) \
+                        and (len(self._idle) < self.max_connections):
+                    self._idle.append(client)
+                    self._returned.add(client)
+                else:
+                    await self._disconnect(client)
+                self.warm()
+
+    async def close(self) -> None:
+        self.closed = True
+        for task in tuple(self._warming):
+            task.cancel()
+        self._returned.clear()
+        while self._idle:
+            await self._disconnect(self._idle.popleft())
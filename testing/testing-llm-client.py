@@ -0,0 +1,123 @@
+'''
+Benchmark for the shared LLM http client (LLM_connections): time to first token
+of a streamed response and the time of a token count request, with a new
+httpx.AsyncClient per request (old LLM_Interface) against the one kept open
+client of LLM_Interface.
+
+The stand-in server talks like ollama's /api/generate: HTTP/1.1 keep-alive,
+a streamed reply is chunked NDJSON, one line per token. accept_delay is the
+time a new connection takes before the server reads it (a remote host or a
+busy server), first_token the prompt eval.
+
+run from the repo root: python testing/testing-llm-client.py [accept delay ms]
+'''
+import asyncio, sys, time, json
+sys.path.append('.')
+
+import httpx
+
+from scripts.LLM_interface import LLM_Interface
+
+host = '127.0.0.1'
+port = 10398
+accept_delay = (float(sys.argv[1]) if len(sys.argv) > 1 else 5) / 1000
+first_token = 0.02
+token_time = 0.002
+turns = 30
+
+config = {
+    'LLM_host': host, 'LLM_port': port, 'LLM_server_type': 'ollama', 'LLM_model': 'stand-in',
+    'LLM_context_length': 8192, 'LLM_temperature': 0.7, 'LLM_api_key': '', 'LLM_token_response': 256,
+    'LLM_prompt_format': 'chatml',
+    'PROMPTS': {'PROMPTS': {'chatml': {
+        'system': '<|im_start|>system\n{system_prompt}<|im_end|>\n',
+        'user': '<|im_start|>user\n{user_prompt}<|im_end|>\n',
+        'assistant': '<|im_start|>assistant\n'}}},
+}
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    await asyncio.sleep(accept_delay)
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            request = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+            await asyncio.sleep(first_token)
+            if request.get('stream'):
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n')
+                for token in ['Sure', ',', ' I', ' can', ' help', '.']:
+                    line = json.dumps({'model': 'stand-in', 'response': token, 'done': False}).encode() + b'\n'
+                    writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                    await writer.drain()
+                    await asyncio.sleep(token_time)
+                line = json.dumps({'model': 'stand-in', 'response': '', 'done': True,
+                        'prompt_eval_count': 40, 'eval_count': 6}).encode() + b'\n'
+                writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n0\r\n\r\n')
+            else:
+                body = json.dumps({'model': 'stand-in', 'response': '{}', 'done': True,
+                        'prompt_eval_count': 40, 'context': list(range(41)), 'eval_count': 1}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+async def old_stream(llm: LLM_Interface, prompts: dict):
+    '''LLM_Interface.stream before the shared client'''
+    request_data = llm.get_request_data(system_str=prompts['system'], user_str=prompts['user'], stream=True)
+    async with httpx.AsyncClient() as client:
+        async with client.stream('POST', f'{llm.llm_uri}/api/generate', json=request_data) as response:
+            async for chunk in response.aiter_bytes():
+                yield json.loads(chunk)['response']
+
+async def old_num_tokens(llm: LLM_Interface, prompt: str) -> int:
+    request_data = llm.get_request_data(system_str='', user_str=prompt, raw=False, num_predict=1)
+    async with httpx.AsyncClient() as client:
+        r = await client.post(url=f'{llm.llm_uri}/api/generate', data=json.dumps(request_data))
+        return json.loads(r.content)['prompt_eval_count']
+
+async def run(stream, num_tokens) -> tuple[list[float], list[float]]:
+    ttft, counts = [], []
+    prompts = {'system': 'You are a bot in a voice chat.', 'user': 'Alice: can you help me?'}
+    for turn in range(turns):
+        start = time.perf_counter()
+        first = None
+        async for token in stream(prompts):
+            if first is None:
+                first = time.perf_counter() - start
+        ttft.append(first)
+        start = time.perf_counter()
+        await num_tokens(f'Alice: message {turn}')
+        counts.append(time.perf_counter() - start)
+    return ttft, counts
+
+def report(name: str, ttft: list[float], counts: list[float]) -> None:
+    # the first turn connects either way, steady state is what a conversation sees
+    average = lambda times: sum(times[1:]) / (len(times) - 1) * 1000
+    print(f'    {name:<22} first token avg {average(ttft):6.2f}ms (turn 1 {ttft[0] * 1000:6.2f}ms)  '
+          f'token count avg {average(counts):6.2f}ms')
+
+async def main():
+    server = await asyncio.start_server(stand_in_server, host, port)
+    print(f'{turns} turns, accept delay {accept_delay * 1000:.1f}ms, prompt eval {first_token * 1000:.0f}ms')
+
+    llm = LLM_Interface(config)
+    ttft, counts = await run(lambda prompts: old_stream(llm, prompts), lambda prompt: old_num_tokens(llm, prompt))
+    report('client per request', ttft, counts)
+
+    ttft, counts = await run(llm.stream, llm.get_num_tokens)
+    report('shared client', ttft, counts)
+    await llm.close()
+
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+'''
+Benchmark for the streamed LLM response decoding (NDJSON_Decoder in
+scripts/LLM_interface.py).
+
+    - a stand-in ollama server sends the NDJSON lines of a response cut at
+      random places and merged into random sized writes, like TCP reads under
+      load. json.loads per read (old LLM_Interface.stream) against
+      LLM_Interface.stream, counting the tokens that arrive intact and the
+      stats event
+    - decoding cost per token with json and orjson
+
+run from the repo root: python testing/testing-llm-ndjson.py
+'''
+import asyncio, sys, time, json, random
+sys.path.append('.')
+
+import httpx
+
+import scripts.LLM_interface as LLM_interface
+from scripts.LLM_interface import LLM_Interface, NDJSON_Decoder
+
+host = '127.0.0.1'
+port = 10399
+tokens = 400
+
+config = {
+    'LLM_host': host, 'LLM_port': port, 'LLM_server_type': 'ollama', 'LLM_model': 'stand-in',
+    'LLM_context_length': 8192, 'LLM_temperature': 0.7, 'LLM_api_key': '', 'LLM_token_response': 256,
+    'LLM_prompt_format': 'chatml',
+    'PROMPTS': {'PROMPTS': {'chatml': {
+        'system': '<|im_start|>system\n{system_prompt}<|im_end|>\n',
+        'user': '<|im_start|>user\n{user_prompt}<|im_end|>\n',
+        'assistant': '<|im_start|>assistant\n'}}},
+}
+
+def response_lines() -> bytes:
+    lines = [json.dumps({'model': 'stand-in', 'created_at': '2024-06-01T12:00:00.000000Z',
+                         'response': f' word{index}', 'done': False}) for index in range(tokens)]
+    lines.append(json.dumps({'model': 'stand-in', 'response': '', 'done': True, 'prompt_eval_count': 812,
+                             'prompt_eval_duration': 95000000, 'eval_count': tokens,
+                             'eval_duration': 4100000000, 'load_duration': 2000000,
+                             'total_duration': 4200000000}))
+    return ('\n'.join(lines) + '\n').encode()
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    rng = random.Random(1)
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            break
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        await reader.readexactly(int(headers.get('content-length', 0)))
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n')
+        body = response_lines()
+        position = 0
+        while position < len(body):
+            # anything from part of a line to a few lines per write
+            size = rng.randint(20, 400)
+            piece = body[position:position + size]
+            position += size
+            writer.write(f'{len(piece):x}\r\n'.encode() + piece + b'\r\n')
+            await writer.drain()
+            await asyncio.sleep(0.0005)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+    writer.close()
+
+async def old_stream(llm: LLM_Interface, prompts: dict) -> tuple[int, int]:
+    '''json.loads per read like LLM_Interface.stream did, returns (tokens, reads that failed)'''
+    request_data = llm.get_request_data(system_str=prompts['system'], user_str=prompts['user'], stream=True)
+    received, failed = 0, 0
+    async with httpx.AsyncClient() as client:
+        async with client.stream('POST', f'{llm.llm_uri}/api/generate', json=request_data) as response:
+            async for chunk in response.aiter_bytes():
+                try:
+                    json.loads(chunk)['response']
+                    received += 1
+                except (ValueError, KeyError):
+                    failed += 1
+    return received, failed
+
+async def new_stream(llm: LLM_Interface, prompts: dict) -> tuple[int, dict]:
+    received, stats = 0, None
+    async for event in llm.stream(prompts):
+        if event['type'] == 'token':
+            received += 1
+        else:
+            stats = event
+    return received, stats
+
+def decode_cost(loads) -> float:
+    '''microseconds per token to decode a response fed in 1400 byte reads'''
+    LLM_interface.json_loads = loads
+    body = response_lines()
+    reads = [body[start:start + 1400] for start in range(0, len(body), 1400)]
+    start = time.perf_counter()
+    for _ in range(50):
+        decoder = NDJSON_Decoder()
+        for data in reads:
+            decoder.feed(data)
+    return (time.perf_counter() - start) / 50 / (tokens + 1) * 1e6
+
+async def main():
+    server = await asyncio.start_server(stand_in_server, host, port)
+    llm = LLM_Interface(config)
+    prompts = {'system': 'You are a bot in a voice chat.', 'user': 'Alice: tell me a story.'}
+    print(f'{tokens} tokens per response, lines split and merged at random')
+
+    received, failed = await old_stream(llm, prompts)
+    print(f'    json.loads per read  tokens {received:4d} of {tokens}, {failed} reads did not parse, no stats')
+    received, stats = await new_stream(llm, prompts)
+    print(f'    NDJSON_Decoder       tokens {received:4d} of {tokens}, stats prompt_eval_count '
+          f'{stats["prompt_eval_count"]} eval_duration {stats["eval_duration"] / 1e6:.0f}ms '
+          f'total_duration {stats["total_duration"] / 1e6:.0f}ms')
+    await llm.close()
+    server.close()
+    await server.wait_closed()
+
+    print(f'    decode json          {decode_cost(json.loads):5.2f}us per token')
+    try:
+        import orjson
+        print(f'    decode orjson        {decode_cost(orjson.loads):5.2f}us per token')
+    except ImportError:
+        print('    orjson not installed')
+
+if __name__ == '__main__':
+    asyncio.run(main())
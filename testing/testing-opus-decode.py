@@ -0,0 +1,82 @@
+'''
+Benchmark for Opus passthrough: decoding every speaker on one thread (what
+voice_recv does on its packet thread) against Opus_Decoder_Pool.
+
+"recv thread" is the time the packet thread is busy, "total" is the time
+until every frame is decoded. Decoding in the pool only scales with real
+cores, on a single core box the win is the free packet thread.
+
+run from the repo root: python testing/testing-opus-decode.py [path/to/libopus.so]
+'''
+import os, sys, time, threading
+sys.path.append('.')
+
+import numpy as np
+import discord.opus
+
+from scripts.audio_opus import Opus_Decoder_Pool
+
+seconds = 5
+frames_per_speaker = seconds * 50
+
+def load_opus():
+    if len(sys.argv) > 1:
+        discord.opus.load_opus(sys.argv[1])
+    elif not discord.opus.is_loaded():
+        discord.opus._load_default()
+    if not discord.opus.is_loaded():
+        print('libopus not found, pass the path to libopus.so')
+        quit()
+
+def make_packets() -> list[bytes]:
+    encoder = discord.opus.Encoder()
+    t = np.arange(960 * frames_per_speaker) / 48000
+    mono = 8000 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2
+    mono += 300 * np.random.default_rng(0).standard_normal(len(t))
+    pcm = np.repeat(mono.astype(np.int16), 2).tobytes()
+    return [encoder.encode(pcm[i:i + 3840], 960) for i in range(0, len(pcm), 3840)]
+
+def in_thread(packets: list[bytes], speakers: int) -> float:
+    decoders = [discord.opus.Decoder() for _ in range(speakers)]
+    start = time.perf_counter()
+    for packet in packets:
+        for decoder in decoders:
+            decoder.decode(packet, fec=False)
+    return time.perf_counter() - start
+
+def pooled(packets: list[bytes], speakers: int, workers: int) -> tuple[float, float]:
+    total = len(packets) * speakers
+    done = threading.Event()
+    count = [0]
+    lock = threading.Lock()
+
+    def on_decoded(frame):
+        with lock:
+            count[0] += 1
+            if count[0] == total:
+                done.set()
+
+    pool = Opus_Decoder_Pool(workers=workers, on_decoded=on_decoded)
+    start = time.perf_counter()
+    for sequence, packet in enumerate(packets):
+        for ssrc in range(speakers):
+            pool.submit({'ssrc': ssrc, 'opus': packet, 'sequence': sequence})
+    recv_time = time.perf_counter() - start
+    done.wait()
+    total_time = time.perf_counter() - start
+    pool.close()
+    return recv_time, total_time
+
+if __name__ == '__main__':
+    load_opus()
+    packets = make_packets()
+    worker_counts = sorted({1, 2, os.cpu_count() or 1})
+    print(f'{seconds}s of audio per speaker, {os.cpu_count()} cpus')
+    for speakers in (5, 10, 20):
+        elapsed = in_thread(packets, speakers)
+        print(f'{speakers:>2} speakers - in thread      recv thread {elapsed * 1000:8.1f}ms  '
+              f'({elapsed / seconds * 100:.1f}% of real time)')
+        for workers in worker_counts:
+            recv_time, total_time = pooled(packets, speakers, workers)
+            print(f'             pool {workers:>2} workers recv thread {recv_time * 1000:8.1f}ms  '
+                  f'total {total_time * 1000:8.1f}ms')
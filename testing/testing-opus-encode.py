@@ -0,0 +1,76 @@
+'''
+Benchmark for TTS_opus_encoders: memory of a queued sentence as pcm and as
+Opus packets, and the time the player thread spends per 20ms frame on
+PCM_Stream_Source (discord.py encodes every frame) against
+Opus_Stream_Source (packets are sent as they are).
+
+run from the repo root: python testing/testing-opus-encode.py [path/to/libopus.so]
+'''
+import asyncio, sys, time
+sys.path.append('.')
+
+import numpy as np
+import discord.opus
+
+from scripts.audio_opus import Opus_Encoder_Pool
+from scripts.audio_playback import PCM_Stream_Source, Opus_Stream_Source
+
+seconds = 5
+sentences = 8
+
+def load_opus():
+    if len(sys.argv) > 1:
+        discord.opus.load_opus(sys.argv[1])
+    elif not discord.opus.is_loaded():
+        discord.opus._load_default()
+    if not discord.opus.is_loaded():
+        print('libopus not found, pass the path to libopus.so')
+        quit()
+
+def make_sentence(seed: int) -> bytes:
+    t = np.arange(48000 * seconds) / 48000
+    mono = 6000 * np.sin(2 * np.pi * (180 + seed * 20) * t) * (1 + np.sin(2 * np.pi * 4 * t)) / 2
+    mono += 200 * np.random.default_rng(seed).standard_normal(len(t))
+    return np.repeat(mono.astype(np.int16), 2).tobytes()
+
+def player_thread_time(source, frames: int) -> float:
+    '''what discord.py does per frame: read, and encode if the source is pcm'''
+    encoder = discord.opus.Encoder()
+    start = time.perf_counter()
+    for _ in range(frames):
+        data = source.read()
+        if not source.is_opus():
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+    return time.perf_counter() - start
+
+async def main():
+    load_opus()
+    pcm = [make_sentence(seed) for seed in range(sentences)]
+    pool = Opus_Encoder_Pool(workers=2)
+
+    start = time.perf_counter()
+    packets = await asyncio.gather(*(pool.encode(sentence) for sentence in pcm))
+    encode_time = time.perf_counter() - start
+    pool.close()
+
+    pcm_bytes = sum(len(sentence) for sentence in pcm)
+    opus_bytes = sum(sum(len(packet) + sys.getsizeof(b'') for packet in sentence) for sentence in packets)
+    print(f'{sentences} sentences of {seconds}s')
+    print(f'    queued as pcm   {pcm_bytes / 1e6:8.2f}MB')
+    print(f'    queued as opus  {opus_bytes / 1e6:8.2f}MB (with object overhead), '
+          f'{pcm_bytes / opus_bytes:.1f}x smaller')
+    print(f'    pool encode     {encode_time * 1000:8.1f}ms for {sentences * seconds}s of audio')
+
+    frames = sum(len(sentence) for sentence in packets)
+    pcm_source, opus_source = PCM_Stream_Source(), Opus_Stream_Source()
+    for sentence in pcm:
+        pcm_source.append(sentence)
+    for sentence in packets:
+        opus_source.append(sentence)
+    for name, source in (('pcm source', pcm_source), ('opus source', opus_source)):
+        elapsed = player_thread_time(source, frames)
+        print(f'    player thread, {name:<11} {elapsed / frames * 1e6:7.1f}us per 20ms frame '
+              f'({elapsed / frames / 0.02 * 100:.2f}% of real time)')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+'''
+Benchmark for the idle time prefill (LLM_prefill): time to the first sentence
+of a response with and without the next prompt sent ahead between turns.
+
+The stand-in ollama server is the one of testing-prompt-cache.py with one slot
+(OLLAMA_NUM_PARALLEL 1): it reuses the cache of the longest common prefix and
+evaluates the rest at prompt_eval ms per token. Its responses are three
+sentences, about as long as the bot's replies.
+
+Every turn a user message goes through Bot_LLM.wmh_stream_sentences (append
+layout). Between turns, while the next user is talking, the prefill case
+calls prefill_next_prompt like botman_monitor does.
+
+run from the repo root: python testing/testing-prefill.py [turns] [prompt_eval ms per token]
+'''
+import asyncio, sys, time, json, random, os
+sys.path.append('.')
+
+from datetime import datetime, timedelta
+
+import scripts.LLM_main as LLM_main
+from scripts.LLM_main import Bot_LLM
+from scripts.datatypes import Discord_Message
+
+host = '127.0.0.1'
+port = 10402
+turns = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+prompt_eval = (float(sys.argv[2]) if len(sys.argv) > 2 else 1) / 1000
+talking = 0.05 # seconds between turns in real time
+
+with open('data/prompts.json', 'r') as file:
+    prompts = json.load(file)
+
+config = {
+    'LLM_host': host, 'LLM_port': port, 'LLM_server_type': 'ollama', 'LLM_model': 'stand-in',
+    'LLM_context_length': '4096', 'LLM_temperature': '0.7', 'LLM_api_key': '', 'LLM_token_response': '256',
+    'LLM_prompt_format': 'chatml', 'LLM_SFW': '1', 'LLM_message_history_privacy': '1',
+    'LLM_token_cache': '', 'LLM_prompt_layout': 'append', 'PROMPTS': prompts,
+}
+
+response_tokens = ('Oh', ' that', ' sounds', ' like', ' a', ' long', ' day', ',', ' honestly', '.',
+                   ' I', ' would', ' have', ' gone', ' straight', ' to', ' the', ' pub', ' after', ' that', '.',
+                   ' What', ' did', ' the', ' others', ' say', ' about', ' it', '?')
+cached = ''
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    global cached
+    try:
+        while True:
+            if not await reader.readline():
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            request = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+            prompt = request['prompt']
+            common = len(os.path.commonprefix([cached, prompt]))
+            cached = prompt
+            eval_count = (len(prompt) - common + 3) // 4
+            await asyncio.sleep(eval_count * prompt_eval)
+            if not request.get('stream'):
+                # context is the whole prompt, cached or not
+                body = json.dumps({'response': 'O', 'done': True, 'prompt_eval_count': eval_count,
+                        'context': list(range((len(prompt) + 3) // 4 + 1)), 'eval_count': 1}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+                await writer.drain()
+                continue
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n')
+            for token in response_tokens:
+                line = json.dumps({'response': token, 'done': False}).encode() + b'\n'
+                writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                await writer.drain()
+            line = json.dumps({'response': '', 'done': True, 'prompt_eval_count': eval_count,
+                    'eval_count': len(response_tokens)}).encode() + b'\n'
+            writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n0\r\n\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+class Clock(datetime):
+    '''simulated time for the prompts'''
+    current: datetime = datetime(2024, 6, 1, 20, 0, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+async def conversation(prefill: bool) -> tuple[list[int], list[float], int]:
+    '''prompt_eval_count and seconds to the first sentence per turn, tokens prefilled'''
+    global cached
+    cached = ''
+    Clock.current = datetime(2024, 6, 1, 20, 0, 0)
+    bot = Bot_LLM(config=config, message_store={}, message_listened_to={}, bot_name='StellaMae', bot_id=1234)
+    bot_info = bot.prompts.bot_info
+    users = {1001: 'Alice', 2002: 'Bob'}
+    bot_info.set_tokens('CHAT', len(bot.prompts.gen_prompt_chat(bot_info, set(users.values()))) // 4)
+    bot.llm.assistant_tokens = 5
+
+    rng = random.Random(1)
+    evaluated, first_sentence = [], []
+    for turn in range(turns):
+        # the next user talks, the monitor prefills meanwhile
+        if prefill:
+            await bot.prefill_next_prompt()
+        await asyncio.sleep(talking)
+        Clock.current += timedelta(seconds=rng.randint(20, 90))
+        user_id = rng.choice(list(users))
+        message = Discord_Message(user_name=users[user_id], user_id=user_id, bot_id=None, bot_name=None,
+                text=f'This is message {turn}, I am telling the others about my day and asking what they think.',
+                listener_ids={1001, 2002, 1234}, listener_names={'Alice', 'Bob', 'StellaMae'},
+                timestamp=Clock.current)
+        response = Discord_Message(user_name='StellaMae', user_id=1234, bot_id=None, bot_name=None)
+        start = time.perf_counter()
+        first = None
+        async for sentence in bot.wmh_stream_sentences(messages=[message], bot_response_mesg=response,
+                bot_info=bot_info):
+            if first is None:
+                first = time.perf_counter() - start
+        evaluated.append(bot.llm.last_stats['prompt_eval_count'])
+        first_sentence.append(first)
+    await bot.llm.close()
+    return evaluated, first_sentence, bot.prefill_tokens
+
+async def main():
+    LLM_main.datetime = Clock
+    server = await asyncio.start_server(stand_in_server, host, port)
+    print(f'{turns} turns, prompt eval {prompt_eval * 1000:.1f}ms per token, 1 server slot, append layout')
+    average = {}
+    for prefill in (False, True):
+        evaluated, first, prefilled = await conversation(prefill)
+        # the first turn has nothing to prefill
+        average[prefill] = sum(first[1:]) / (len(first) - 1) * 1000
+        print(f'    prefill {"on " if prefill else "off"}  prompt_eval_count avg {sum(evaluated[1:]) / (len(evaluated) - 1):5.0f} '
+              f'max {max(evaluated[1:]):5d}  first sentence avg {average[prefill]:6.1f}ms '
+              f'max {max(first[1:]) * 1000:6.1f}ms  prefilled {prefilled} tokens')
+    print(f'    saved {average[False] - average[True]:.1f}ms to the first sentence per turn')
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
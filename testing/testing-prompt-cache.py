@@ -0,0 +1,132 @@
+'''
+Benchmark for the prompt layout (LLM_prompt_layout): how much of each turn's
+prompt the LLM server has to evaluate again.
+
+The stand-in ollama server keeps the last prompt of each of its slots (2,
+OLLAMA_NUM_PARALLEL) and like llama.cpp / ollama reuses the cache of the
+longest common prefix, only the rest is evaluated (prompt_eval_count, 4
+characters a token) at prompt_eval ms per token before the first token.
+
+A voice chat of turns messages, 20 to 90 seconds apart on a simulated clock,
+goes through Bot_LLM.wmh_stream_sentences with the real prompts from
+data/prompts.json, once with the 'relative' layout ("2 minutes" in every
+history line) and once with 'append'.
+
+run from the repo root: python testing/testing-prompt-cache.py [turns] [prompt_eval ms per token]
+'''
+import asyncio, sys, time, json, random, os
+sys.path.append('.')
+
+from datetime import datetime, timedelta
+
+import scripts.LLM_main as LLM_main
+from scripts.LLM_main import Bot_LLM
+from scripts.datatypes import Discord_Message
+
+host = '127.0.0.1'
+port = 10401
+turns = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+prompt_eval = (float(sys.argv[2]) if len(sys.argv) > 2 else 0.2) / 1000
+server_slots = 2
+
+with open('data/prompts.json', 'r') as file:
+    prompts = json.load(file)
+
+config = {
+    'LLM_host': host, 'LLM_port': port, 'LLM_server_type': 'ollama', 'LLM_model': 'stand-in',
+    'LLM_context_length': '4096', 'LLM_temperature': '0.7', 'LLM_api_key': '', 'LLM_token_response': '256',
+    'LLM_prompt_format': 'chatml', 'LLM_SFW': '1', 'LLM_message_history_privacy': '1',
+    'LLM_token_cache': '', 'PROMPTS': prompts,
+}
+
+cache_slots: list[str] = ['' for _ in range(server_slots)]
+last_prompt_length = 0
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    global last_prompt_length
+    try:
+        while True:
+            if not await reader.readline():
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            prompt = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))['prompt']
+            common = [len(os.path.commonprefix([cached, prompt])) for cached in cache_slots]
+            slot = common.index(max(common))
+            cache_slots[slot] = prompt
+            last_prompt_length = len(prompt)
+            eval_count = (len(prompt) - common[slot] + 3) // 4
+            await asyncio.sleep(eval_count * prompt_eval)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n')
+            for token in ['Sure', ',', ' that', ' sounds', ' like', ' fun', '.', ' Tell', ' me', ' more', '.']:
+                line = json.dumps({'response': token, 'done': False}).encode() + b'\n'
+                writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                await writer.drain()
+            line = json.dumps({'response': '', 'done': True, 'prompt_eval_count': eval_count,
+                    'prompt_eval_duration': int(eval_count * prompt_eval * 1e9), 'eval_count': 11}).encode() + b'\n'
+            writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n0\r\n\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+class Clock(datetime):
+    '''simulated time for the prompts'''
+    current: datetime = datetime(2024, 6, 1, 20, 0, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+async def conversation(layout: str) -> list[tuple[int, float, int]]:
+    '''(prompt_eval_count, seconds to the first sentence, prompt length in tokens) per turn'''
+    for slot in range(server_slots):
+        cache_slots[slot] = ''
+    Clock.current = datetime(2024, 6, 1, 20, 0, 0)
+    bot = Bot_LLM(config=dict(config, LLM_prompt_layout=layout), message_store={}, message_listened_to={},
+            bot_name='StellaMae', bot_id=1234)
+    bot_info = bot.prompts.bot_info
+    users = {1001: 'Alice', 2002: 'Bob'}
+    bot_info.set_tokens('CHAT', len(bot.prompts.gen_prompt_chat(bot_info, set(users.values()))) // 4)
+    bot.llm.assistant_tokens = 5
+
+    rng = random.Random(1)
+    results = []
+    for turn in range(turns):
+        Clock.current += timedelta(seconds=rng.randint(20, 90))
+        user_id = rng.choice(list(users))
+        message = Discord_Message(user_name=users[user_id], user_id=user_id, bot_id=None, bot_name=None,
+                text=f'This is message {turn}, I am telling the others about my day and asking what they think.',
+                listener_ids={1001, 2002, 1234}, listener_names={'Alice', 'Bob', 'StellaMae'},
+                timestamp=Clock.current)
+        response = Discord_Message(user_name='StellaMae', user_id=1234, bot_id=None, bot_name=None)
+        start = time.perf_counter()
+        first = None
+        async for sentence in bot.wmh_stream_sentences(messages=[message], bot_response_mesg=response,
+                bot_info=bot_info):
+            if first is None:
+                first = time.perf_counter() - start
+        results.append((bot.llm.last_stats['prompt_eval_count'], first, last_prompt_length // 4))
+    await bot.llm.close()
+    return results
+
+async def main():
+    LLM_main.datetime = Clock
+    server = await asyncio.start_server(stand_in_server, host, port)
+    print(f'{turns} turns, prompt eval {prompt_eval * 1000:.1f}ms per token, {server_slots} server slots, '
+          f'LLM_context_length {config["LLM_context_length"]}')
+    for layout in ('relative', 'append'):
+        results = await conversation(layout)
+        evaluated = [result[0] for result in results]
+        first = [result[1] for result in results]
+        print(f'    {layout:<9} prompt_eval_count avg {sum(evaluated) / len(evaluated):6.0f} tokens '
+              f'(last 10 turns {sum(evaluated[-10:]) / 10:6.0f}, prompt ~{results[-1][2]} tokens)  '
+              f'first sentence avg {sum(first) / len(first) * 1000:6.1f}ms')
+        print(f'              prompt_eval_count per turn {evaluated}')
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
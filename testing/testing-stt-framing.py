@@ -0,0 +1,108 @@
+'''
+Benchmark for the Wyoming framing in transcribe(): the old framing (1000 byte
+slices copied with tobytes, the whole AudioChunk list built before the first
+write, a drain after every event) against audio_chunks + Batched_Writer at
+20/60/100ms per chunk.
+
+The stand-in server runs in its own process like a real one. "first chunk" is
+the time until it has read the first AudioChunk, "total" until the transcript
+is back, "peak" is the tracemalloc peak of the bot side (separate pass).
+
+run from the repo root: python testing/testing-stt-framing.py
+'''
+import asyncio, sys, time, tracemalloc, multiprocessing
+sys.path.append('.')
+
+import wyoming.asr as wyAsr
+import wyoming.audio as wyAudio
+import wyoming.client as wyClient
+from wyoming.event import async_read_event, async_write_event
+
+from scripts.STT_wfw import transcribe, stt_rate, stt_channels, stt_width
+
+host = '127.0.0.1'
+port = 10393
+rounds = 10
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    received = 0
+    first_chunk = 0.0
+    while True:
+        event = await async_read_event(reader)
+        if event is None:
+            break
+        if event.type == 'audio-chunk':
+            if not received:
+                # perf_counter is the system wide monotonic clock, comparable across processes
+                first_chunk = time.perf_counter()
+            received += len(event.payload)
+        elif event.type == 'audio-stop':
+            await async_write_event(wyAsr.Transcript(text=f'{first_chunk}').event(), writer)
+            break
+    writer.close()
+
+def run_server():
+    async def serve():
+        server = await asyncio.start_server(stand_in_server, host, port)
+        await server.serve_forever()
+    asyncio.run(serve())
+
+async def old_framing(audio_data: memoryview) -> str:
+    timestamp = 0
+    chunks = []
+    start = 0
+    while len(audio_data) > start:
+        end = start + 1000
+        chunks.append(wyAudio.AudioChunk(rate=stt_rate, width=stt_width, channels=stt_channels,
+                audio=audio_data[start:end].tobytes(), timestamp=timestamp))
+        timestamp += chunks[-1].timestamp + int(
+            len(chunks[-1].audio) / (stt_channels * stt_width * stt_rate) * 1000)
+        start = end
+    client = wyClient.AsyncTcpClient(host=host, port=port)
+    await client.connect()
+    try:
+        await client.write_event(wyAsr.Transcribe().event())
+        await client.write_event(wyAudio.AudioStart(rate=stt_rate, width=stt_width, channels=stt_channels).event())
+        for item in chunks:
+            await client.write_event(item.event())
+        await client.write_event(wyAudio.AudioStop().event())
+        return (await client.read_event()).data['text']
+    finally:
+        await client.disconnect()
+
+async def new_framing(audio_data: memoryview, chunk_ms: int) -> str:
+    return await transcribe(audio_data=audio_data, host=host, port=port, input_rate=stt_rate,
+            input_channels=stt_channels, input_width=stt_width, chunk_ms=chunk_ms)
+
+async def measure(send) -> tuple[float, float, int]:
+    totals, firsts = 0.0, 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        first_chunk = float(await send())
+        totals += time.perf_counter() - start
+        firsts += first_chunk - start
+    tracemalloc.start()
+    await send()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return firsts / rounds, totals / rounds, peak
+
+async def main():
+    for seconds in (5, 15, 30):
+        # 16khz mono, what the STT cog sends with STT_resample=1
+        audio = memoryview(bytes(stt_rate * stt_width * seconds))
+        print(f'{seconds:>3}s utterance')
+        cases = [('old 1000 byte', lambda: old_framing(audio))]
+        for chunk_ms in (20, 60, 100):
+            cases.append((f'new {chunk_ms}ms', lambda chunk_ms=chunk_ms: new_framing(audio, chunk_ms)))
+        for name, send in cases:
+            first, total, peak = await measure(send)
+            print(f'    {name:<14} first chunk {first * 1000:6.2f}ms  total {total * 1000:7.2f}ms  '
+                  f'peak {peak / 1e6:6.2f}MB')
+
+if __name__ == '__main__':
+    server = multiprocessing.Process(target=run_server, daemon=True)
+    server.start()
+    time.sleep(1)
+    asyncio.run(main())
+    server.terminate()
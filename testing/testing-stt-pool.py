@@ -0,0 +1,100 @@
+'''
+Benchmark for the STT connection pool: time from the end of an utterance to the
+transcript with a new connection per turn (old path) and with a Wyoming_Pool.
+Streamed turns (STT_Stream, STT_streaming=1) are timed from the first packet
+of a short utterance, the session is opened then.
+
+The stand-in server behaves like wyoming-faster-whisper: it answers Describe,
+closes the connection after each transcript and takes accept_delay to set up
+a new connection (handler and model lookup on a real server, plus the round
+trips on a remote host). Turns are spaced like a conversation so the pool has
+time to warm the next connection.
+
+run from the repo root: python testing/testing-stt-pool.py [accept_delay_ms]
+'''
+import asyncio, sys, time
+sys.path.append('.')
+
+from wyoming.event import async_read_event, async_write_event
+from wyoming.asr import Transcript
+from wyoming.info import Info
+
+from scripts.STT_wfw import transcribe, STT_Stream, stt_rate, stt_channels, stt_width
+from scripts.wyoming_pool import Wyoming_Pool
+
+host = '127.0.0.1'
+port = 10392
+turns = 20
+turn_gap = 0.2
+accept_delay = (float(sys.argv[1]) if len(sys.argv) > 1 else 5) / 1000
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    await asyncio.sleep(accept_delay)
+    while True:
+        event = await async_read_event(reader)
+        if event is None:
+            break
+        if event.type == 'describe':
+            await async_write_event(Info().event(), writer)
+        elif event.type == 'audio-stop':
+            await async_write_event(Transcript(text='hello').event(), writer)
+            break
+    writer.close()
+
+async def run_turns(pool: Wyoming_Pool) -> list[float]:
+    # 2 seconds of 16khz mono
+    audio = memoryview(bytes(stt_rate * stt_width * 2))
+    times = []
+    for _ in range(turns):
+        await asyncio.sleep(turn_gap)
+        start = time.perf_counter()
+        await transcribe(audio_data=audio, host=host, port=port, input_rate=stt_rate,
+                input_channels=stt_channels, input_width=stt_width, pool=pool)
+        times.append(time.perf_counter() - start)
+    return times
+
+async def run_streams(pool: Wyoming_Pool) -> list[float]:
+    # 0.5 seconds of 16khz mono, in 20ms packets
+    packet = bytes(stt_rate * stt_width // 50)
+    times = []
+    for _ in range(turns):
+        await asyncio.sleep(turn_gap)
+        start = time.perf_counter()
+        stream = STT_Stream(host=host, port=port, input_rate=stt_rate, input_channels=stt_channels,
+                input_width=stt_width, loop=asyncio.get_running_loop(), pool=pool)
+        for _ in range(25):
+            stream.feed(packet)
+        stream.finish()
+        await stream.transcript()
+        times.append(time.perf_counter() - start)
+    return times
+
+async def main():
+    server = await asyncio.start_server(stand_in_server, host, port)
+    print(f'{turns} turns, stand-in server accept delay {accept_delay * 1000:.0f}ms')
+
+    times = await run_turns(None)
+    print(f'    new connection per turn  avg {sum(times) / len(times) * 1000:6.2f}ms  '
+          f'max {max(times) * 1000:6.2f}ms')
+
+    pool = Wyoming_Pool(host=host, port=port)
+    pool.warm()
+    times = await run_turns(pool)
+    print(f'    Wyoming_Pool             avg {sum(times) / len(times) * 1000:6.2f}ms  '
+          f'max {max(times) * 1000:6.2f}ms  {pool}')
+
+    times = await run_streams(None)
+    print(f'    stream, own connection   avg {sum(times) / len(times) * 1000:6.2f}ms  '
+          f'max {max(times) * 1000:6.2f}ms')
+    times = await run_streams(pool)
+    print(f'    stream, Wyoming_Pool     avg {sum(times) / len(times) * 1000:6.2f}ms  '
+          f'max {max(times) * 1000:6.2f}ms  {pool}')
+    await pool.close()
+
+    # let the server see the pooled connections close
+    await asyncio.sleep(accept_delay + 0.1)
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+'''
+Microbenchmark for the STT conversion stage: sends an utterance to a local
+stand-in Wyoming server as 48khz stereo (old path) and as 16khz mono after
+Polyphase_Resampler (STT_resample=1). The server only counts the bytes, so
+this measures the bot side: framing, socket writes and the conversion.
+
+run from the repo root: python testing/testing-stt-resample.py
+'''
+import asyncio, sys, time
+sys.path.append('.')
+
+import numpy as np
+
+from wyoming.event import async_read_event, async_write_event
+from wyoming.asr import Transcript
+
+from scripts.STT_wfw import transcribe, stt_rate, stt_channels, stt_width
+from scripts.audio_resample import Polyphase_Resampler
+
+host = '127.0.0.1'
+port = 10391
+rounds = 20
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    received = 0
+    while True:
+        event = await async_read_event(reader)
+        if event is None:
+            break
+        if event.type == 'audio-chunk':
+            received += len(event.payload)
+        elif event.type == 'audio-stop':
+            await async_write_event(Transcript(text=f'{received}').event(), writer)
+            break
+    writer.close()
+
+def make_utterance(seconds: float) -> memoryview:
+    t = np.arange(int(48000 * seconds)) / 48000
+    mono = 8000 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2
+    mono += 300 * np.random.default_rng(0).standard_normal(len(t))
+    return memoryview(np.repeat(mono.astype(np.int16), 2).tobytes())
+
+async def old_path(audio: memoryview) -> str:
+    return await transcribe(audio_data=audio, host=host, port=port,
+            input_rate=48000, input_channels=2, input_width=2)
+
+async def new_path(audio: memoryview, resampler: Polyphase_Resampler) -> str:
+    converted = memoryview(await asyncio.to_thread(resampler.resample, audio))
+    return await transcribe(audio_data=converted, host=host, port=port,
+            input_rate=stt_rate, input_channels=stt_channels, input_width=stt_width)
+
+async def main():
+    server = await asyncio.start_server(stand_in_server, host, port)
+    resampler = Polyphase_Resampler(input_rate=48000, output_rate=stt_rate, input_channels=2)
+
+    for seconds in (2, 5, 15):
+        audio = make_utterance(seconds)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            resampler.resample(audio)
+        convert_time = (time.perf_counter() - start) / rounds
+
+        results = {}
+        for name in ('48k stereo', '16k mono'):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                if name == '16k mono':
+                    sent = await new_path(audio, resampler)
+                else:
+                    sent = await old_path(audio)
+            results[name] = ((time.perf_counter() - start) / rounds, sent)
+
+        print(f'{seconds:>3}s utterance - resample only {convert_time * 1000:.2f}ms')
+        for name, (elapsed, sent) in results.items():
+            print(f'    {name:<11} {elapsed * 1000:7.2f}ms per utterance, {int(sent):>9} bytes sent')
+
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,213 @@
+'''
+Behaviour check for long turns (com_segment_len / com_segment_pause): the sink
+splits a turn at its internal pauses and the STT cog puts the text of the
+segments back together in order.
+
+    - split: a 25 second turn with short pauses goes through the real
+      Speech_To_Text_Sink frame by frame. It has to come out as segments cut
+      at the first pause after com_segment_len of speech, one turn_id, 
+      numbered 0.., only the last one final.
+    - out of order: the segments go to the STT cog, the stand-in servers take
+      longer for the earlier segments so they finish last. The message has to
+      reach queues.llm once, with the text in the order it was spoken, and the
+      next turn after it.
+    - retry: the server that gets the first segment drops the connection, 
+      again on the retry on a new connection (transcribe), the STT cog has 
+      to run it on the other server. Same result expected.
+    - hang: the server that gets the first segment never answers, after
+      STT_timeout the STT cog has to run it on the other server and deliver
+      the turn and the one after it.
+
+The stand-in Wyoming servers answer every utterance with "s<turn>.<segment>",
+read from the first byte of the audio, after delay_ms * (3 - segment).
+Exits with an error if a check fails.
+
+run from the repo root: python testing/testing-stt-segments.py [delay_ms]
+'''
+import asyncio, sys
+sys.path.append('.')
+
+from datetime import datetime
+
+import numpy as np
+import discord
+from wyoming.event import async_read_event, async_write_event
+from wyoming.asr import Transcript
+from wyoming.info import Info
+
+from scripts.discord_ext import Discord_Container
+from scripts.datatypes import Discord_Message, Audio_Message
+
+import cogs.Audio as Audio
+import cogs.STT as STT
+
+host = '127.0.0.1'
+ports = (10394, 10395)
+delay = (float(sys.argv[1]) if len(sys.argv) > 1 else 40) / 1000
+frame_bytes = discord.opus.Decoder.FRAME_SIZE
+
+served: list[tuple[int, str]] = [] # (port, text) in the order the transcripts were sent
+fail: dict[str, int] = {} # text: times its request is dropped
+hang: dict[str, int] = {} # text: times its request is never answered
+dropped: list[tuple[int, str]] = []
+
+def stand_in_server(port: int):
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        marker = None
+        while True:
+            event = await async_read_event(reader)
+            if event is None:
+                break
+            if event.type == 'describe':
+                await async_write_event(Info().event(), writer)
+            elif (event.type == 'audio-chunk') and (marker is None):
+                marker = event.payload[0]
+            elif event.type == 'audio-stop':
+                turn, segment = marker >> 4, marker & 15
+                text = f's{turn}.{segment}'
+                if fail.get(text):
+                    fail[text] -= 1
+                    dropped.append((port, text))
+                    break
+                if hang.get(text):
+                    hang[text] -= 1
+                    dropped.append((port, text))
+                    # until the client gives up and closes the connection
+                    await reader.read()
+                    break
+                await asyncio.sleep(delay * (3 - segment))
+                served.append((port, text))
+                await async_write_event(Transcript(text=text).event(), writer)
+                break
+        writer.close()
+    return handler
+
+class Stand_In_Bot():
+    '''what the cogs use of Commands_Bot'''
+    def __init__(self, config: dict):
+        self.custom = Discord_Container(config=config)
+        self.loop = asyncio.get_running_loop()
+        self.events: list[tuple[str, dict]] = []
+
+    def dispatch(self, event: str, **kwargs) -> None:
+        self.events.append((event, kwargs))
+
+    def get_cog(self, name: str):
+        return None
+
+def speech_frame() -> bytes:
+    t = np.arange(frame_bytes // 4) / 48000
+    voice = 6000 * np.sin(2 * np.pi * 150 * t) + 2000 * np.sin(2 * np.pi * 450 * t)
+    return np.repeat(voice.astype(np.int16), 2).tobytes()
+
+async def split(bot: Stand_In_Bot) -> list[Audio_Message]:
+    sink = Audio.Speech_To_Text_Sink(bot=bot, end_speaking_delay=200, max_audio_len=30000,
+            segment_len=10000, segment_pause=100)
+    # not attached to a voice client, cleanup checks it
+    sink._voice_client = None
+    voice, pause = speech_frame(), bytes(frame_bytes)
+    # seconds of speech, then a 120ms pause (longer than com_segment_pause, shorter than the end)
+    plan = [4, 7, 6, 5, 3]
+    sequence = 0
+    now = bot.loop.time()
+    for index, seconds in enumerate(plan):
+        frames = [voice] * (seconds * 50) + ([pause] * 6 if index < len(plan) - 1 else [])
+        for pcm in frames:
+            sink._process_frame(Audio.Voice_Frame(user_id=7, member='alice', ssrc=1, sequence=sequence,
+                    pcm=pcm, opus=None, time=now))
+            sequence += 1
+    # the end of speech deadline
+    await asyncio.sleep(0.3)
+    return list(bot.custom.queues.audio_in)
+
+def check(name: str, ok: bool, detail: str = '') -> bool:
+    print(f'    {name:<52} {"ok" if ok else "WRONG"} {detail}')
+    return ok
+
+def marked(audio: Audio_Message) -> Audio_Message:
+    '''the first byte tells the stand-in server which segment it has'''
+    data = bytearray(audio.audio_data)
+    data[0] = (audio.turn_id << 4) | audio.segment
+    audio.audio_data = memoryview(bytes(data))
+    return audio
+
+async def stitch(bot: Stand_In_Bot, segments: list[Audio_Message]) -> list[str]:
+    served.clear()
+    stt = STT.STT(bot)
+    stt.STT_monitor.cancel()
+    # a second speaker's short turn right after the long one
+    other = Discord_Message(user_name='Bob', user_id=8, bot_id=None, bot_name=None,
+            listener_ids=set(), listener_names=set(), timestamp_Audio_End=datetime.now())
+    queue = bot.custom.queues.audio_in
+    queue.clear()
+    queue.extend(marked(audio) for audio in segments)
+    queue.append(marked(Audio_Message(audio_data=memoryview(bytes(16000)), message=other,
+            turn_id=segments[-1].turn_id + 1, segment=0)))
+    stt.dispatch_audio()
+    while stt.tasks:
+        await asyncio.sleep(0.01)
+    texts = [message.text for message in bot.custom.queues.llm]
+    bot.custom.queues.llm.clear()
+    await stt.cleanup()
+    return texts
+
+async def main():
+    servers = [await asyncio.start_server(stand_in_server(port), host, port) for port in ports]
+    config = {'STT_host': host, 'STT_port': ports[0], 'STT_servers': ','.join(f'{host}:{port}' for port in ports),
+            'STT_trim': '0', 'STT_resample': '0', 'behavior_time_between_messages': '0', 'STT_timeout': '1'}
+    passed = True
+
+    print('split at the pauses')
+    bot = Stand_In_Bot(config)
+    segments = await split(bot)
+    seconds = [round(len(audio.audio_data) / (frame_bytes * 50), 2) for audio in segments]
+    passed &= check('segments', len(segments) == 3, f'{seconds}s')
+    passed &= check('one turn_id, numbered 0..', {audio.turn_id for audio in segments} == {0}
+            and [audio.segment for audio in segments] == list(range(len(segments))))
+    passed &= check('one shared Discord_Message', len({id(audio.message) for audio in segments}) == 1)
+    passed &= check('only the last one final', [audio.final for audio in segments] == [False] * (len(segments) - 1) + [True])
+    # 5 frames of the pause close a segment, the 6th starts the next one
+    passed &= check('cut at the pauses', seconds == [11.22, 11.24, 3.02], '(4+7s, 6+5s and 3s of speech)')
+
+    print('stitch, segments finish out of order')
+    texts = await stitch(bot, segments)
+    order = [text for _, text in served]
+    passed &= check('the later segments finished first',
+            order.index('s0.2') < order.index('s0.1') < order.index('s0.0'), f'{order}')
+    passed &= check('text in the order spoken, next turn after it', texts == ['s0.0 s0.1 s0.2', 's1.0'], f'{texts}')
+
+    print('stitch, a segment retried on the other server')
+    for audio in segments:
+        audio.audio_data = memoryview(bytes(audio.audio_data))
+    fail['s0.0'] = 2
+    bot = Stand_In_Bot(config)
+    texts = await stitch(bot, segments)
+    retried = [port for port, text in served if text == 's0.0']
+    passed &= check('retried on the other server', (len({port for port, _ in dropped}) == 1)
+            and (retried == [port for port in ports if port != dropped[0][0]]),
+            f'dropped by {[port for port, _ in dropped]}, served by {retried}')
+    passed &= check('text in the order spoken, next turn after it', texts == ['s0.0 s0.1 s0.2', 's1.0'],
+            f'{texts} served by {served}')
+
+    print('stitch, a server hangs on a segment')
+    for audio in segments:
+        audio.audio_data = memoryview(bytes(audio.audio_data))
+    dropped.clear()
+    hang['s0.0'] = 1
+    bot = Stand_In_Bot(config)
+    start = bot.loop.time()
+    texts = await stitch(bot, segments)
+    retried = [port for port, text in served if text == 's0.0']
+    passed &= check('timed out, run on the other server', (len(dropped) == 1)
+            and (retried == [port for port in ports if port != dropped[0][0]]),
+            f'hung on {[port for port, _ in dropped]}, served by {retried}')
+    passed &= check('text in the order spoken, next turn after it', texts == ['s0.0 s0.1 s0.2', 's1.0'],
+            f'{texts} after {bot.loop.time() - start:.2f}s')
+
+    for server in servers:
+        server.close()
+    if not passed:
+        sys.exit('segmented turns handled wrong')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+'''
+Behaviour check for Silence_Trimmer (STT_trim): what is cut and what is dropped
+before an utterance goes to STT.
+
+Speech is synthesized at Discord's 48khz stereo: a 150hz voice with harmonics
+whose loudness follows syllables, 4 a second. The cases:
+
+    - continuous speech, no pause from start to end: kept whole
+    - speech with a second of near silence before and after: cut to the speech,
+      pad_ms kept on both sides
+    - pure noise, quiet hiss, a fan below com_vad_threshold and a noisy mic's 
+      hiss above it: dropped
+    - speech over the noisy mic's hiss: kept and cut to the speech
+
+Low rumble louder than com_vad_threshold is speech to Energy_VAD as well, the
+sink would not end the turn either, com_vad_threshold has to be raised then.
+
+Each case runs with the speaker's noise floor from the sink's Energy_VAD and
+without one (com_vad=0). The old floor (5th percentile + margin, no cap) is
+shown for comparison. Exits with an error if a case is not handled.
+
+run from the repo root: python testing/testing-stt-trim.py
+'''
+import sys
+sys.path.append('.')
+
+import numpy as np
+
+from scripts.audio_trim import Silence_Trimmer
+from scripts.audio_vad import Energy_VAD
+
+rate = 48000
+channels = 2
+frame_bytes = rate // 50 * channels * 2
+rng = np.random.default_rng(1)
+
+def to_pcm(mono: np.ndarray) -> bytes:
+    samples = np.clip(mono * 32767, -32768, 32767).astype(np.int16)
+    return np.repeat(samples, channels).tobytes()
+
+def level(db: float) -> float:
+    # peak amplitude for an rms of db dBFS (sine like)
+    return np.sqrt(2) * 10 ** (db / 20)
+
+def speech(seconds: float, loud_db: float = -18, quiet_db: float = -36) -> np.ndarray:
+    t = np.arange(int(seconds * rate)) / rate
+    voice = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 12))
+    voice /= np.sqrt(np.mean(np.square(voice)) * 2)
+    # syllables, the loudness moves between quiet_db and loud_db and never stops
+    syllables = (1 - np.cos(2 * np.pi * 4 * t)) / 2
+    envelope_db = quiet_db + (loud_db - quiet_db) * syllables
+    return voice * level(envelope_db)
+
+def hiss(seconds: float, db: float) -> np.ndarray:
+    return rng.normal(0, 10 ** (db / 20), int(seconds * rate))
+
+def rumble(seconds: float, db: float) -> np.ndarray:
+    # fan / room noise, mostly low frequencies (few zero crossings)
+    noise = np.cumsum(rng.normal(0, 1, int(seconds * rate)))
+    noise -= np.convolve(noise, np.ones(480) / 480, mode='same')
+    return noise / np.sqrt(np.mean(np.square(noise))) * 10 ** (db / 20)
+
+def sink_floor(mono: np.ndarray) -> float:
+    '''the noise floor the sink's Energy_VAD has for the speaker after this audio'''
+    vad = Energy_VAD(channels=channels)
+    pcm = to_pcm(mono)
+    for start in range(0, len(pcm) - frame_bytes + 1, frame_bytes):
+        vad.process(pcm[start:start + frame_bytes])
+    return vad.noise_floor_db
+
+def main():
+    trimmer = Silence_Trimmer(rate=rate, channels=channels)
+    old = Silence_Trimmer(rate=rate, channels=channels, max_noise_floor_db=0.0)
+    pad = trimmer.pad_frames * frame_bytes
+    background = hiss(3.0, -38)
+
+    cases = {
+        # name: (audio, speech start and end in seconds or None to drop, the speaker's floor)
+        'continuous speech': (speech(3.0), (0.0, 3.0), sink_floor(hiss(2.0, -75))),
+        'silence around speech': (np.concatenate([hiss(1.0, -75), speech(1.5), hiss(1.0, -75)]),
+                (1.0, 2.5), sink_floor(hiss(2.0, -75))),
+        'pure noise, hiss': (hiss(2.0, -60), None, sink_floor(hiss(2.0, -60))),
+        'pure noise, fan': (rumble(2.0, -50), None, sink_floor(rumble(2.0, -50))),
+        'pure noise, noisy mic': (hiss(2.0, -38), None, sink_floor(background)),
+        'speech over noisy mic': (np.concatenate([hiss(1.0, -38), speech(1.5) + hiss(1.5, -38), hiss(1.0, -38)]),
+                (1.0, 2.5), sink_floor(background)),
+    }
+    failed = 0
+    for name, (mono, expected, floor) in cases.items():
+        pcm = to_pcm(mono)
+        before = old.trim(pcm)
+        print(f'{name:<22} old    ratio {before["speech_ratio"]:4.0%}'
+              f'{"  dropped" if before["speech_ratio"] < old.min_speech_ratio else ""}')
+        for label, noise_floor_db in (('sink', floor), ('no vad', None)):
+            result = trimmer.trim(pcm, noise_floor_db)
+            dropped = result['speech_ratio'] < trimmer.min_speech_ratio
+            if expected is None:
+                ok = dropped
+            else:
+                # within 100ms, the quietest start of a syllable can be under the noise
+                start, end = (int(second * rate) // 960 * frame_bytes for second in expected)
+                ok = (not dropped) and (abs(result['start'] - max(0, start - pad)) <= 5 * frame_bytes) \
+                        and (abs(result['end'] - min(len(pcm), end + pad)) <= 5 * frame_bytes)
+            failed += not ok
+            kept = f'kept {result["start"] / frame_bytes / 50:.2f}s - {result["end"] / frame_bytes / 50:.2f}s'
+            print(f'{"":<22} {label:<6} ratio {result["speech_ratio"]:4.0%}  '
+                  f'{"dropped" if dropped else kept}  {"ok" if ok else "WRONG"}')
+    if failed:
+        sys.exit(f'{failed} cases handled wrong')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+'''
+Benchmark for the token counting service (scripts/token_counter.py).
+
+A stand-in ollama server answers /api/generate with num_predict 1 like a token
+count, taking eval_time per request and server_slots requests at a time
+(OLLAMA_NUM_PARALLEL). A conversation of messages, some short replies repeat,
+is counted
+    - one get_num_tokens request per message after another (old get_token_queue use)
+    - Token_Counter.drain in batches, cached by model and text
+and the CHAT / CTR / assistant prompt counts at startup, first start (3s wait
+for the model, 3 requests) and after a restart with the counts on disk.
+
+Last a server that answers without a count (no context, no prompt_eval_count):
+every message has to leave the queue with its estimate after max_attempts
+drains and nothing may be written to disk, exits with an error otherwise.
+
+run from the repo root: python testing/testing-token-counter.py [eval ms] [server_slots]
+'''
+import asyncio, sys, time, json, random, tempfile, os
+sys.path.append('.')
+
+from collections import deque
+
+from scripts.datatypes import Discord_Message
+from scripts.LLM_interface import LLM_Interface
+from scripts.token_counter import Token_Counter
+
+host = '127.0.0.1'
+port = 10400
+eval_time = (float(sys.argv[1]) if len(sys.argv) > 1 else 25) / 1000
+server_slots = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+num_messages = 200
+
+config = {
+    'LLM_host': host, 'LLM_port': port, 'LLM_server_type': 'ollama', 'LLM_model': 'stand-in',
+    'LLM_context_length': 8192, 'LLM_temperature': 0.7, 'LLM_api_key': '', 'LLM_token_response': 256,
+    'LLM_prompt_format': 'chatml',
+    'PROMPTS': {'PROMPTS': {'chatml': {
+        'system': '<|im_start|>system\n{system_prompt}<|im_end|>\n',
+        'user': '<|im_start|>user\n{user_prompt}<|im_end|>\n',
+        'assistant': '<|im_start|>assistant\n'}}},
+}
+
+requests = 0
+slots: asyncio.Semaphore = None
+no_count = False # answer without context / prompt_eval_count
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    global requests
+    try:
+        while True:
+            if not await reader.readline():
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            request = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+            async with slots:
+                await asyncio.sleep(eval_time)
+            requests += 1
+            tokens = len(request['prompt'].split())
+            body = json.dumps({'response': '.', 'done': True, 'prompt_eval_count': tokens,
+                    'context': list(range(tokens + 1)), 'eval_count': 1} if not no_count
+                    else {'response': '.', 'done': True}).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+
+def conversation() -> list[Discord_Message]:
+    rng = random.Random(1)
+    replies = ['Yeah.', 'What?', 'Okay.', 'Haha.', 'No way.', 'Really?', 'Sure.', 'Hmm.']
+    messages = []
+    for index in range(num_messages):
+        text = rng.choice(replies) if rng.random() < 0.3 else \
+                f'Message {index}, somebody is talking about their day at some length.'
+        messages.append(Discord_Message(user_name=rng.choice(['Alice', 'Bob']), user_id=1, bot_id=None, bot_name=None, text=text))
+    return messages
+
+def message_text(message: Discord_Message) -> str:
+    return f'{message.user_name} : {message.text}'
+
+async def main():
+    global slots, requests, no_count
+    slots = asyncio.Semaphore(server_slots)
+    server = await asyncio.start_server(stand_in_server, host, port)
+    llm = LLM_Interface(config)
+    print(f'{num_messages} messages, 30% repeated short replies, {eval_time * 1000:.0f}ms per count, '
+          f'{server_slots} at a time, LLM_connections {llm.connections}')
+
+    requests = 0
+    start = time.perf_counter()
+    for message in conversation():
+        message.tokens = await llm.get_num_tokens(prompt=message_text(message))
+    print(f'    one request per message   {(time.perf_counter() - start) * 1000:7.1f}ms  requests {requests}')
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, 'token_counts.json')
+        counter = Token_Counter(llm=llm, cache_file=cache_file)
+        queue = deque(conversation())
+        requests = 0
+        start = time.perf_counter()
+        while queue:
+            await counter.drain(queue, message_text)
+        print(f'    Token_Counter.drain       {(time.perf_counter() - start) * 1000:7.1f}ms  requests {requests}  {counter}')
+
+        prompts = ['You are StellaMae. ' * 300, 'Decide if StellaMae should respond. ' * 200, '<|im_start|>assistant\n']
+        for name in ('first start', 'after restart'):
+            counter = Token_Counter(llm=llm, cache_file=cache_file)
+            requests = 0
+            start = time.perf_counter()
+            if any(counter.get(text) is None for text in prompts):
+                await asyncio.sleep(3) # get_prompt_tokens waits for the model to load
+            await counter.count_many(prompts)
+            await asyncio.to_thread(counter.save)
+            print(f'    prompt counts, {name:<13}{(time.perf_counter() - start) * 1000:7.1f}ms  requests {requests}')
+
+        no_count = True
+        cache_file = os.path.join(cache_dir, 'no_counts.json')
+        counter = Token_Counter(llm=llm, cache_file=cache_file)
+        messages = conversation()[:counter.batch_size]
+        queue = deque(messages)
+        drains = 0
+        while queue and (drains < 10):
+            await counter.drain(queue, message_text)
+            await asyncio.to_thread(counter.save)
+            drains += 1
+        estimated = all(message.tokens == len(message_text(message)) // 4 for message in messages)
+        handled = (not queue) and (drains == counter.max_attempts) and estimated and not os.path.exists(cache_file)
+        print(f'    no count in the response   drains {drains}  queued {len(queue)}  estimates {estimated}  '
+              f'saved {os.path.exists(cache_file)}  {"ok" if handled else "WRONG"}')
+
+    await llm.close()
+    server.close()
+    await server.wait_closed()
+    return handled
+
+if __name__ == '__main__':
+    if not asyncio.run(main()):
+        sys.exit('missing token counts handled wrong')
@@ -0,0 +1,106 @@
+'''
+Benchmark for the TTS phrase cache (TTS_cache_mb / TTS_cache_dir): a bot
+conversation where short replies repeat ("Yeah.", "What?", greetings) between
+longer sentences that do not. Every sentence is either fetched from a stand-in
+piper server and resampled like the TTS cog does, or taken from TTS_Cache.
+
+Prints the hit rate and the time until a sentence's audio is ready for a hit
+and a miss, then starts a second cache on the same directory (a restart) to
+show the disk tier.
+
+run from the repo root: python testing/testing-tts-cache.py [synth ms per character]
+'''
+import asyncio, sys, time, random, tempfile
+sys.path.append('.')
+
+from wyoming.event import async_read_event, async_write_event
+from wyoming.audio import AudioStart, AudioChunk, AudioStop
+from wyoming.info import Info
+
+from scripts.TTS_Piper import request_TTS
+from scripts.wyoming_pool import Wyoming_Pool
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.tts_cache import TTS_Cache
+
+host = '127.0.0.1'
+port = 10395
+synth_time = (float(sys.argv[1]) if len(sys.argv) > 1 else 5) / 1000 # per character
+speech_time = 0.065 # seconds of audio per character
+turns = 200
+
+short_replies = ['Yeah.', 'What?', 'Hello there!', 'Okay.', 'Sure.', 'Hmm.', 'Good morning!',
+                 'No way.', 'Really?', 'Thanks!', 'Right.', 'I see.']
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while True:
+        event = await async_read_event(reader)
+        if event is None:
+            break
+        if event.type == 'describe':
+            await async_write_event(Info().event(), writer)
+        elif event.type == 'synthesize':
+            text = event.data['text']
+            await asyncio.sleep(synth_time * len(text))
+            audio = bytes(int(22050 * speech_time * len(text)) * 2)
+            await async_write_event(AudioStart(rate=22050, width=2, channels=1).event(), writer)
+            for start in range(0, len(audio), 2048):
+                await async_write_event(AudioChunk(rate=22050, width=2, channels=1,
+                        audio=audio[start:start + 2048]).event(), writer)
+            await async_write_event(AudioStop().event(), writer)
+    writer.close()
+
+def conversation(seed: int) -> list[str]:
+    rng = random.Random(seed)
+    sentences = []
+    for turn in range(turns):
+        if rng.random() < 0.4:
+            # a few replies are much more common than the rest
+            sentences.append(rng.choices(short_replies, weights=range(len(short_replies), 0, -1))[0])
+        else:
+            sentences.append(f'This is longer sentence {seed}-{turn} about something one of the users said, '
+                             f'it will not come up again.')
+    return sentences
+
+async def run(cache: TTS_Cache, pool: Wyoming_Pool, sentences: list[str]) -> tuple[list[float], list[float]]:
+    resampler = Polyphase_Resampler(input_rate=22050, output_rate=48000, output_channels=2)
+    hits, misses = [], []
+    for text in sentences:
+        start = time.perf_counter()
+        key = cache.key(text, None, 'pcm48000x2')
+        audio = await asyncio.to_thread(cache.get, key) if key else None
+        if audio is not None:
+            hits.append(time.perf_counter() - start)
+            continue
+        output = await request_TTS(text=text, voice=None, pool=pool)
+        audio = await asyncio.to_thread(resampler.resample, output['audio'])
+        misses.append(time.perf_counter() - start)
+        if key:
+            await asyncio.to_thread(cache.put, key, audio)
+    return hits, misses
+
+def report(name: str, cache: TTS_Cache, hits: list[float], misses: list[float]) -> None:
+    average = lambda times: sum(times) / len(times) * 1000 if times else 0.0
+    print(f'    {name:<14} {cache}')
+    print(f'    {"":<14} hit {average(hits):7.2f}ms avg  miss {average(misses):7.2f}ms avg to audio ready')
+
+async def main():
+    server = await asyncio.start_server(stand_in_server, host, port)
+    pool = Wyoming_Pool(host=host, port=port)
+    pool.warm()
+    await asyncio.sleep(0.1)
+    print(f'{turns} sentences, 40% short replies, synthesis {synth_time * 1000:.1f}ms per character')
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = TTS_Cache(cache_dir=cache_dir)
+        hits, misses = await run(cache, pool, conversation(1))
+        report('first run', cache, hits, misses)
+
+        # the bot restarts, memory is empty, the phrases are still on disk
+        cache = TTS_Cache(cache_dir=cache_dir)
+        hits, misses = await run(cache, pool, conversation(2))
+        report('after restart', cache, hits, misses)
+    await pool.close()
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
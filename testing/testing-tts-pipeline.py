@@ -0,0 +1,175 @@
+'''
+Benchmark for the TTS pipeline: sentences synthesized one after another on a new
+connection each (old tts_monitor loop) against concurrent requests on a
+Wyoming_Pool with the results put back in order (TTS_connections), and the same
+with the audio streamed to playback chunk by chunk (TTS_streaming).
+
+The stand-in server behaves like wyoming-piper: it keeps the connection open,
+takes accept_delay to set up a connection and synth_time per character to
+synthesize, server_slots sentences at a time (1 for a single piper voice process,
+more for several processes or servers behind one address). Audio is sent in
+1024 sample chunks as it is synthesized. After each sentence the bot side
+resamples it on the loop like resample_audio does, streamed chunks go through
+Polyphase_Resampler as they arrive.
+
+"first" is the time until the first sentence can play, "stalls" the silence
+between sentences while playing them back to back, which is what the users hear.
+
+run from the repo root: python testing/testing-tts-pipeline.py [connections] [synth ms per character] [server_slots]
+'''
+import asyncio, sys, time, copy
+sys.path.append('.')
+
+import numpy as np
+
+from wyoming.event import async_read_event, async_write_event
+from wyoming.audio import AudioStart, AudioChunk, AudioStop
+from wyoming.info import Info
+
+from scripts.TTS_Piper import request_TTS, stream_TTS
+from scripts.audio_resample import Polyphase_Resampler
+from scripts.wyoming_pool import Wyoming_Pool
+
+host = '127.0.0.1'
+port = 10394
+accept_delay = 0.005
+synth_time = (float(sys.argv[2]) if len(sys.argv) > 2 else 0.6) / 1000 # per character, 0.6 is ~100x real time
+speech_time = 0.065 # seconds of audio per character
+connections = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+server_slots = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+sentences = [
+    'Sure, I can help with that.',
+    'The library opens at nine in the morning on weekdays.',
+    'On weekends it opens a little later, usually around ten.',
+    'If you want, I can look up the holiday hours as well.',
+    'Just let me know.',
+    'Anything else on your mind?',
+]
+
+synth_slots: asyncio.Semaphore = None
+
+async def stand_in_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    await asyncio.sleep(accept_delay)
+    while True:
+        event = await async_read_event(reader)
+        if event is None:
+            break
+        if event.type == 'describe':
+            await async_write_event(Info().event(), writer)
+        elif event.type == 'synthesize':
+            text = event.data['text']
+            audio = bytes(int(22050 * speech_time * len(text)) * 2)
+            chunk_time = synth_time * len(text) * 2048 / len(audio)
+            async with synth_slots:
+                await async_write_event(AudioStart(rate=22050, width=2, channels=1).event(), writer)
+                for start in range(0, len(audio), 2048):
+                    await asyncio.sleep(chunk_time)
+                    await async_write_event(AudioChunk(rate=22050, width=2, channels=1,
+                            audio=audio[start:start + 2048]).event(), writer)
+                await async_write_event(AudioStop().event(), writer)
+    writer.close()
+
+def resample(audio) -> bytes:
+    '''linear resample and stereo on the loop, the old resample_audio'''
+    samples = np.array(audio, dtype=np.int16) / 32768
+    positions = np.arange(int(len(samples) * 48000 / 22050)) * 22050 / 48000
+    resampled = np.interp(positions, np.arange(len(samples)), samples)
+    return np.repeat(np.array(resampled * 32767, dtype=np.int16), 2).tobytes()
+
+def playback(pieces: list[tuple[float, float]]) -> tuple[float, float]:
+    '''
+    pieces - (time queued, seconds of audio) in playback order
+    returns (time to first audio, total silence after the first audio) when played back to back
+    '''
+    end = pieces[0][0]
+    stalls = 0.0
+    for when, duration in pieces:
+        stalls += max(0.0, when - end)
+        end = max(when, end) + duration
+    return pieces[0][0], stalls
+
+async def old_loop(start: float, pool: Wyoming_Pool) -> list[tuple[float, float]]:
+    pieces = []
+    for text in sentences:
+        output = await request_TTS(text=text, voice=None, host=host, port=port)
+        audio = resample(output['audio'])
+        pieces.append((time.perf_counter() - start, len(audio) / 192000))
+    return pieces
+
+async def concurrent(start: float, pool: Wyoming_Pool) -> list[tuple[float, float]]:
+    pieces = []
+    results = {}
+    next_ready = 0
+
+    async def synthesize(sequence: int, text: str):
+        nonlocal next_ready
+        output = await request_TTS(text=text, voice=None, pool=pool)
+        results[sequence] = resample(output['audio'])
+        # in order, like TTS.deliver_results
+        while next_ready in results:
+            pieces.append((time.perf_counter() - start, len(results.pop(next_ready)) / 192000))
+            next_ready += 1
+
+    await asyncio.gather(*(synthesize(sequence, text) for sequence, text in enumerate(sentences)))
+    return pieces
+
+async def streaming(start: float, pool: Wyoming_Pool) -> list[tuple[float, float]]:
+    pieces = []
+    streams = {sequence: [] for sequence in range(len(sentences))}
+    finished = set()
+    head = 0
+    base = Polyphase_Resampler(input_rate=22050, output_rate=48000, output_channels=2)
+
+    def deliver():
+        # the head sentence passes its chunks on, like TTS.deliver_results
+        nonlocal head
+        while head in streams:
+            for audio in streams[head]:
+                pieces.append((time.perf_counter() - start, len(audio) / 192000))
+            streams[head].clear()
+            if head not in finished:
+                return
+            del streams[head]
+            head += 1
+
+    async def synthesize(sequence: int, text: str):
+        # like the TTS cog, the filter is shared and the stream state is per sentence
+        resampler = copy.copy(base)
+        resampler.reset()
+        async for chunk in stream_TTS(text=text, voice=None, pool=pool):
+            streams[sequence].append(await asyncio.to_thread(resampler.process, chunk['audio']))
+            deliver()
+        finished.add(sequence)
+        deliver()
+
+    await asyncio.gather(*(synthesize(sequence, text) for sequence, text in enumerate(sentences)))
+    return pieces
+
+async def main():
+    global synth_slots
+    synth_slots = asyncio.Semaphore(server_slots)
+    server = await asyncio.start_server(stand_in_server, host, port)
+    print(f'{len(sentences)} sentences, {sum(speech_time * len(text) for text in sentences):.1f}s of speech, '
+          f'TTS_connections {connections}, '
+          f'synthesis {synth_time * 1000:.1f}ms per character, {server_slots} at a time')
+
+    cases = (('sequential, new connection', old_loop),
+             ('concurrent, Wyoming_Pool', concurrent),
+             ('concurrent, streaming', streaming))
+    for name, run in cases:
+        pool = Wyoming_Pool(host=host, port=port, max_connections=connections)
+        pool.warm()
+        await asyncio.sleep(0.1)
+        pieces = await run(time.perf_counter(), pool)
+        first, stalls = playback(pieces)
+        print(f'    {name:<27} first audio {first * 1000:6.1f}ms  all ready {pieces[-1][0] * 1000:6.1f}ms  '
+              f'stalls {stalls * 1000:6.1f}ms')
+        await pool.close()
+
+    await asyncio.sleep(accept_delay + 0.1)
+    server.close()
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    asyncio.run(main())
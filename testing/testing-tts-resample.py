@@ -0,0 +1,78 @@
+'''
+Benchmark for the TTS resampling: the old resample_audio (librosa linear on the
+loop, scaled back by 32786, np.repeat to stereo) against Polyphase_Resampler
+going 22050hz mono to 48khz interleaved stereo in one pass, for whole sentences
+and for a stream of 1024 sample chunks (TTS_streaming). Also prints the time
+it takes to import librosa, which the TTS cog no longer pays.
+
+librosa (and samplerate, which res_type='linear' uses) are not requirements
+any more, the librosa rows are skipped if they are not installed.
+
+run from the repo root: python testing/testing-tts-resample.py
+'''
+import sys, time, subprocess, copy
+sys.path.append('.')
+
+import numpy as np
+
+from scripts.audio_resample import Polyphase_Resampler
+
+rounds = 20
+
+def make_sentence(seconds: float) -> np.ndarray:
+    t = np.arange(int(22050 * seconds)) / 22050
+    voice = 8000 * np.sin(2 * np.pi * 180 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2
+    return voice.astype(np.int16)
+
+def old_resample(audio: np.ndarray) -> bytes:
+    import librosa
+    resampled = librosa.core.resample(np.divide(audio, 32768), orig_sr=22050, target_sr=48000, res_type='linear')
+    return np.repeat(np.array(np.multiply(resampled, 32786), dtype=np.int16), 2).tobytes()
+
+def timed(function, *args) -> float:
+    function(*args)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(*args)
+    return (time.perf_counter() - start) / rounds
+
+def stream(resampler: Polyphase_Resampler, audio: bytes) -> None:
+    resampler = copy.copy(resampler)
+    resampler.reset()
+    for start in range(0, len(audio), 2048):
+        resampler.process(audio[start:start + 2048])
+
+def main():
+    try:
+        import librosa, samplerate
+        have_librosa = True
+        command = [sys.executable, '-c', 'import time; t = time.perf_counter(); import librosa; '
+                'librosa.core.resample; print(time.perf_counter() - t)']
+        print(f'librosa import {float(subprocess.check_output(command)) * 1000:.0f}ms')
+    except ImportError:
+        have_librosa = False
+        print('librosa or samplerate not installed, only Polyphase_Resampler is timed')
+
+    start = time.perf_counter()
+    resampler = Polyphase_Resampler(input_rate=22050, output_rate=48000, output_channels=2)
+    print(f'Polyphase_Resampler filter design {(time.perf_counter() - start) * 1000:.1f}ms (once per voice format)')
+
+    for seconds in (1, 5, 15):
+        audio = make_sentence(seconds)
+        print(f'{seconds:>3}s sentence')
+        if have_librosa:
+            elapsed = timed(old_resample, audio)
+            print(f'    librosa linear + repeat   {elapsed * 1000:7.2f}ms  {seconds / elapsed:7.0f}x real time')
+        elapsed = timed(resampler.resample, audio)
+        print(f'    Polyphase, whole          {elapsed * 1000:7.2f}ms  {seconds / elapsed:7.0f}x real time')
+        elapsed = timed(stream, resampler, audio.tobytes())
+        print(f'    Polyphase, 1024 chunks    {elapsed * 1000:7.2f}ms  {seconds / elapsed:7.0f}x real time')
+
+    if have_librosa:
+        # the old scaling overshoots, full scale input wraps around
+        loud = np.full(2205, 32767, dtype=np.int16)
+        print(f'full scale input (32767): old path {np.frombuffer(old_resample(loud), dtype=np.int16)[100:-100].min()} '
+              f'(wrapped), Polyphase {np.frombuffer(resampler.resample(loud), dtype=np.int16)[100:-100].max()}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+'''
+Benchmark for TTS routing over several piper servers (TTS_servers, scripts/tts_router.py).
+
+Stand-in piper servers that keep model_slots voice models loaded, a sentence
+for a voice that is not loaded first pays load_time (least recently used model
+is dropped). Several bot personas talk with different voices, their sentences
+are sent like the TTS cog does (TTS_connections per server at once).
+
+Cases
+    - one server, every voice on it
+    - the same sentences round robin over the servers (no affinity)
+    - TTS_Router, voices stay on their server
+    - TTS_Router with the second server going down halfway through
+    - TTS_Router with the second server slow (delay before the audio) for
+      a while, then back to normal. It has to be avoided while slow and get
+      sentences again after the next probe(), the probe must not make it load
+      another model. Then the server stalls after the first chunk of a sentence,
+      the request has to fail after timeout. Exits with an error otherwise
+
+Prints the time to first audio per sentence (average / worst) and the model
+loads the servers had to do.
+
+run from the repo root: python testing/testing-tts-router.py [servers] [voices]
+'''
+import asyncio, sys, time, random, itertools
+sys.path.append('.')
+
+import wyoming.tts as wyTTS
+from wyoming.event import async_read_event, async_write_event
+from wyoming.audio import AudioStart, AudioChunk, AudioStop
+from wyoming.info import Info
+
+from scripts.TTS_Piper import stream_TTS
+from scripts.wyoming_pool import Wyoming_Pool
+from scripts.tts_router import TTS_Router
+
+host = '127.0.0.1'
+base_port = 10396
+num_servers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+num_voices = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+model_slots = 2
+load_time = 0.4
+synth_time = 0.6 / 1000 # per character
+sentences_per_run = 120
+
+class Stand_In_Server():
+    def __init__(self, port: int):
+        self.port = port
+        self.models: list[str] = []
+        self.loads = 0
+        self.requests = 0
+        self.delay = 0.0 # before every sentence, a server that is slow
+        self.stall = False # stops sending after the first chunk
+        self.lock = asyncio.Lock() # one piper process
+        self.server: asyncio.Server = None
+        self.writers: list[asyncio.StreamWriter] = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.append(writer)
+        while True:
+            try:
+                event = await async_read_event(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                break
+            if event is None:
+                break
+            if event.type == 'describe':
+                await async_write_event(Info().event(), writer)
+            elif event.type == 'synthesize':
+                text = event.data['text']
+                voice = (event.data.get('voice') or {}).get('name', 'default')
+                self.requests += 1
+                await asyncio.sleep(self.delay)
+                async with self.lock:
+                    if voice not in self.models:
+                        await asyncio.sleep(load_time)
+                        self.loads += 1
+                        self.models.append(voice)
+                        if len(self.models) > model_slots:
+                            self.models.pop(0)
+                    else:
+                        self.models.remove(voice)
+                        self.models.append(voice)
+                    audio = bytes(int(22050 * 0.065 * len(text)) * 2)
+                    try:
+                        await async_write_event(AudioStart(rate=22050, width=2, channels=1).event(), writer)
+                        for start in range(0, len(audio), 2048):
+                            if self.stall and start:
+                                await reader.read()
+                                break
+                            await asyncio.sleep(synth_time * len(text) * 2048 / len(audio))
+                            await async_write_event(AudioChunk(rate=22050, width=2, channels=1,
+                                    audio=audio[start:start + 2048]).event(), writer)
+                        await async_write_event(AudioStop().event(), writer)
+                    except OSError:
+                        # the probe hangs up after the first chunk
+                        break
+        writer.close()
+
+def conversation() -> list[tuple[str, wyTTS.SynthesizeVoice]]:
+    rng = random.Random(1)
+    voices = [wyTTS.SynthesizeVoice(name=f'voice_{index}') for index in range(num_voices)]
+    lines = []
+    while len(lines) < sentences_per_run:
+        # a persona answers with a few sentences, then another one
+        voice = rng.choice(voices)
+        for _ in range(rng.randint(1, 4)):
+            lines.append((f'Sentence {len(lines)} said by one of the bots, it is about this long.', voice))
+    return lines[:sentences_per_run]
+
+async def first_audio(chunks) -> float:
+    start = time.perf_counter()
+    first = None
+    async for _ in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+async def speak(lines, request) -> list[float]:
+    '''sentences of a reply are sent at once, replies one after another'''
+    times = []
+    for _, reply in itertools.groupby(lines, key=lambda line: line[1]):
+        results = await asyncio.gather(*(first_audio(request(text, voice)) for text, voice in reply),
+                return_exceptions=True)
+        times.extend(result for result in results if isinstance(result, float))
+    return times
+
+async def run_case(name: str, servers: list[Stand_In_Server], make_request, fail_halfway: bool = False):
+    lines = conversation()
+    for server in servers:
+        server.models.clear()
+        server.loads = 0
+    times = []
+    if fail_halfway:
+        times = await speak(lines[:len(lines) // 2], make_request)
+        await servers[1].stop()
+        times += await speak(lines[len(lines) // 2:], make_request)
+    else:
+        times = await speak(lines, make_request)
+    loads = sum(server.loads for server in servers)
+    print(f'    {name:<30} first audio avg {sum(times) / len(times) * 1000:6.1f}ms '
+          f'worst {max(times) * 1000:6.1f}ms  model loads {loads:3d}  sentences {len(times)}')
+
+async def slow_then_recovered(servers: list[Stand_In_Server]) -> bool:
+    lines = conversation()[:40]
+    slow = servers[1]
+    router = TTS_Router(servers=[(host, server.port) for server in servers], max_connections=2, slow_ms=1000)
+    pool = router.pools[(host, slow.port)]
+    print(f'    TTS_Router, server 2 slow then recovered')
+
+    slow.delay = 1.5
+    await speak(lines[:20], lambda text, voice: router.stream(text=text, voice=voice))
+    avoided = not router.usable(pool)
+    before = slow.requests
+    await speak(lines[20:30], lambda text, voice: router.stream(text=text, voice=voice))
+    print(f'        slow      {router}')
+    ok = avoided and (slow.requests == before)
+    print(f'        avoided while slow: {"ok" if ok else "WRONG"} ({slow.requests - before} sentences)')
+
+    slow.delay = 0.0
+    loads = slow.loads
+    await router.probe()
+    reloaded = slow.loads - loads
+    print(f'        probe with the loaded voice: {"ok" if not reloaded else "WRONG"} ({reloaded} model loads)')
+    before = slow.requests
+    await speak(lines[30:], lambda text, voice: router.stream(text=text, voice=voice))
+    print(f'        recovered {router}')
+    recovered = router.usable(pool) and (slow.requests > before)
+    print(f'        used again after the probe: {"ok" if recovered else "WRONG"} ({slow.requests - before} sentences)')
+
+    # a pinned server (alt_host / alt_port) is only used by the sentences naming it
+    pinned = router.get_pool(host, base_port + num_servers)
+    routed = {router.pick(voice) for _, voice in lines}
+    only_pinned = (pinned not in routed) and (pinned not in router.pools.values())
+    print(f'        pinned server not routed to: {"ok" if only_pinned else "WRONG"}')
+
+    # stalls in the middle of a sentence
+    slow.stall = True
+    router.timeout = 0.5
+    start = time.perf_counter()
+    try:
+        await first_audio(router.stream(text='A sentence that stops half way.', voice=None, host=host, port=slow.port))
+        stalled = False
+    except asyncio.TimeoutError:
+        stalled = True
+    slow.stall = False
+    print(f'        stall mid sentence fails: {"ok" if stalled else "WRONG"} ({time.perf_counter() - start:.2f}s)')
+    await router.close()
+    return ok and (not reloaded) and recovered and only_pinned and stalled
+
+async def main():
+    servers = [Stand_In_Server(base_port + index) for index in range(num_servers)]
+    for server in servers:
+        await server.start()
+    print(f'{num_servers} servers with {model_slots} models loaded each, {num_voices} voices, '
+          f'model load {load_time * 1000:.0f}ms, {sentences_per_run} sentences')
+
+    pool = Wyoming_Pool(host=host, port=base_port, max_connections=2)
+    await run_case('one server', servers[:1], lambda text, voice: stream_TTS(text=text, voice=voice, pool=pool))
+    await pool.close()
+
+    pools = [Wyoming_Pool(host=host, port=server.port, max_connections=2) for server in servers]
+    next_pool = itertools.cycle(pools)
+    await run_case('round robin', servers,
+            lambda text, voice: stream_TTS(text=text, voice=voice, pool=next(next_pool)))
+    for pool in pools:
+        await pool.close()
+
+    router = TTS_Router(servers=[(host, server.port) for server in servers], max_connections=2)
+    await run_case('TTS_Router', servers, lambda text, voice: router.stream(text=text, voice=voice))
+    print(f'        {router}')
+    await router.close()
+
+    if num_servers > 1:
+        router = TTS_Router(servers=[(host, server.port) for server in servers], max_connections=2, timeout=2)
+        await run_case('TTS_Router, server 2 down', servers,
+                lambda text, voice: router.stream(text=text, voice=voice), fail_halfway=True)
+        print(f'        {router}')
+        await router.close()
+
+    handled = True
+    if num_servers > 1:
+        # back up after the case above
+        await servers[1].start()
+        handled = await slow_then_recovered(servers)
+
+    for server in servers:
+        server.server.close()
+    if not handled:
+        sys.exit('slow server handled wrong')
+
+if __name__ == '__main__':
+    asyncio.run(main())